@@ -7,12 +7,46 @@
 
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify, abort
+    session, flash, jsonify, abort, g, Request
 )
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from markupsafe import Markup
+from array import array
+import atexit
+import base64
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+import csv
 from datetime import datetime
+from functools import wraps
+from itertools import chain
+import fcntl
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import mmap
 import os
-from uuid import uuid4
-from werkzeug.utils import secure_filename
+from operator import attrgetter, itemgetter
+import pickle
+import re
+import secrets
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+import click
+from uuid import uuid4, uuid5, NAMESPACE_URL
 
 # ---------------------------------------------------------
 # 🔧 CONFIGURACIÓN INICIAL
@@ -23,15 +57,2250 @@ app.secret_key = "windowshopping_secret_key_v3_9"
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-ALLOWED_DOC_EXTS = {".pdf", ".jpg", ".jpeg", ".png"}
+# Tamaño máximo de la petición (Flask responde 413 antes de leer más)
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("WS_MAX_SUBIDA_MB", 10)) * 1024 * 1024
+
+# ---------------------------------------------------------
+# 🔐 SESIONES DEL LADO DEL SERVIDOR
+# ---------------------------------------------------------
+# La cookie solo lleva un id opaco; los datos (clave del usuario, idioma,
+# flashes) viven en el backend elegido: "local" (en proceso) o "sqlite".
+# WS_MODO=compartido: todos los workers de gunicorn ven los mismos usuarios,
+# publicaciones, mensajes y carritos (almacenes y sesiones en SQLite).
+MODO_COMPARTIDO = os.environ.get("WS_MODO", "local") == "compartido"
+app.config["SESSION_BACKEND"] = os.environ.get("WS_SESSION_BACKEND",
+                                               "sqlite" if MODO_COMPARTIDO else "local")
+app.config["SESSION_TTL"] = int(os.environ.get("WS_SESSION_TTL", 7 * 24 * 3600))
+app.config["SESSION_DB"] = os.environ.get("WS_SESSION_DB", "sesiones.sqlite3")
+
+
+class SesionServidor(CallbackDict, SessionMixin):
+    """Diccionario de sesión que marca `modified` en cada escritura."""
+
+    def __init__(self, datos=None, sid=None, nueva=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, datos, on_update)
+        self.sid = sid
+        self.new = nueva
+        self.modified = False
+        self.sid_anterior = None
+
+    def regenerar(self):
+        """Cambia el id opaco (p.ej. al iniciar sesión) y descarta el anterior."""
+        self.sid_anterior = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class SesionesLocales:
+    """Backend en proceso con expiración deslizante (TTL) y purga incremental."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._datos = OrderedDict()  # sid -> (expira, datos), ordenado por último uso
+        self._lock = threading.Lock()
+
+    def cargar(self, sid):
+        ahora = time.time()
+        with self._lock:
+            entrada = self._datos.get(sid)
+            if entrada is None:
+                return None
+            if entrada[0] < ahora:
+                del self._datos[sid]
+                return None
+            self._datos[sid] = (ahora + self.ttl, entrada[1])
+            self._datos.move_to_end(sid)
+            return dict(entrada[1])
+
+    def guardar(self, sid, datos):
+        ahora = time.time()
+        with self._lock:
+            self._datos[sid] = (ahora + self.ttl, datos)
+            self._datos.move_to_end(sid)
+            # Las más antiguas están al principio: se purgan solo las vencidas
+            while self._datos:
+                primer_sid, (expira, _) = next(iter(self._datos.items()))
+                if expira >= ahora:
+                    break
+                del self._datos[primer_sid]
+
+    def borrar(self, sid):
+        with self._lock:
+            self._datos.pop(sid, None)
+
+
+try:
+    from gevent.monkey import get_original
+except ImportError:  # sin gevent (flask run, gunicorn gthread)
+    _LocalDelHilo = threading.local
+else:
+    # Con gevent parcheado threading.local es por greenlet: cada petición
+    # abriría su propia conexión. El _local original sigue siendo por hilo del
+    # SO, y los greenlets de un hilo comparten conexión (sqlite no cede el hub
+    # en medio de una transacción).
+    _LocalDelHilo = get_original("_thread", "_local")
+
+
+class SesionesSQLite:
+    """Backend en archivo SQLite (compartido entre workers) con TTL."""
+    PURGA_CADA = 200
+
+    def __init__(self, ruta, ttl):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.serializer = TaggedJSONSerializer()
+        self._local = _LocalDelHilo()
+        self._escrituras = 0
+        with self._conexion() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS sesiones ("
+                        "sid TEXT PRIMARY KEY, expira REAL NOT NULL, datos TEXT NOT NULL)")
+            con.execute("CREATE INDEX IF NOT EXISTS sesiones_expira ON sesiones(expira)")
+
+    def _conexion(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = sqlite3.connect(self.ruta, timeout=10)
+        return con
+
+    def cargar(self, sid):
+        ahora = time.time()
+        con = self._conexion()
+        fila = con.execute("SELECT expira, datos FROM sesiones WHERE sid = ?", (sid,)).fetchone()
+        if fila is None or fila[0] < ahora:
+            return None
+        # Expiración deslizante sin escribir en cada petición
+        if fila[0] - ahora < self.ttl / 2:
+            with con:
+                con.execute("UPDATE sesiones SET expira = ? WHERE sid = ?", (ahora + self.ttl, sid))
+        return self.serializer.loads(fila[1])
+
+    def guardar(self, sid, datos):
+        ahora = time.time()
+        con = self._conexion()
+        with con:
+            con.execute("INSERT OR REPLACE INTO sesiones (sid, expira, datos) VALUES (?, ?, ?)",
+                        (sid, ahora + self.ttl, self.serializer.dumps(datos)))
+            self._escrituras += 1
+            if self._escrituras % self.PURGA_CADA == 0:
+                con.execute("DELETE FROM sesiones WHERE expira < ?", (ahora,))
+
+    def borrar(self, sid):
+        con = self._conexion()
+        with con:
+            con.execute("DELETE FROM sesiones WHERE sid = ?", (sid,))
+
+
+class SesionServidorInterface(SessionInterface):
+    """SessionInterface de Flask que guarda los datos en un backend del servidor."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            datos = self.backend.cargar(sid)
+            if datos is not None:
+                return SesionServidor(datos, sid=sid)
+        return SesionServidor(sid=secrets.token_urlsafe(32), nueva=True)
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+
+        if session.sid_anterior:
+            self.backend.borrar(session.sid_anterior)
+
+        if not session:
+            if session.modified and not session.new:
+                self.backend.borrar(session.sid)
+                response.delete_cookie(nombre, domain=dominio, path=ruta)
+            return
+
+        if not session.modified:
+            return
+
+        self.backend.guardar(session.sid, dict(session))
+        response.vary.add("Cookie")
+        if not (session.new or session.sid_anterior):
+            return  # la cookie ya lleva este id
+        response.set_cookie(
+            nombre, session.sid,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=dominio, path=ruta,
+        )
+
+
+def crear_backend_sesiones(config):
+    if config["SESSION_BACKEND"] == "sqlite":
+        return SesionesSQLite(config["SESSION_DB"], config["SESSION_TTL"])
+    return SesionesLocales(config["SESSION_TTL"])
+
+
+app.session_interface = SesionServidorInterface(crear_backend_sesiones(app.config))
 
 # ---------------------------------------------------------
 # 🧩 ESTRUCTURAS DE DATOS
 # ---------------------------------------------------------
-USERS = {}
-PUBLICACIONES = []
-MENSAJES = []
-HIDDEN_COMPANIES = {}
+# Almacenes en memoria seguros con gunicorn --threads: los escritores toman un
+# lock corto, arman una copia del estado y la publican reemplazando una sola
+# referencia; los lectores toman el estado vigente una vez y lo recorren sin
+# lock (nadie lo modifica después de publicado).
+def anotado(metodo):
+    """
+    Escritura de un almacén en memoria que se anota en su diario (si tiene uno,
+    ver WS_DIARIO_DIR): aplicar y anotar bajo el lock del diario deja las
+    entradas en el mismo orden en que se aplicaron.
+    """
+    @wraps(metodo)
+    def envoltura(self, *args):
+        if self.diario is None:
+            return metodo(self, *args)
+        with self.diario.lock:
+            resultado = metodo(self, *args)
+            self.diario.anotar(self.NOMBRE, metodo.__name__, args)
+        return resultado
+    return envoltura
+
+
+FORMATO_FECHA = "%Y-%m-%d %H:%M"
+
+
+def _epoch(fecha):
+    """Epoch (hora local) de un texto FORMATO_FECHA; None si no se entiende."""
+    try:
+        return int(time.mktime(time.strptime(fecha, FORMATO_FECHA)))
+    except (TypeError, ValueError):
+        return None
+
+
+@app.template_filter("fecha")
+def texto_fecha(ts):
+    """Epoch -> texto FORMATO_FECHA en hora local (sólo para mostrar)."""
+    return time.strftime(FORMATO_FECHA, time.localtime(ts)) if ts is not None else None
+
+
+class _Registro(Mapping):
+    """
+    Registro compacto de sólo lectura: un slot por campo en lugar de un dict
+    por registro. Se lee como el dict de siempre (r["campo"], r.get(...),
+    dict(r)) y en plantillas como r.campo. La fecha se guarda como epoch
+    entero (`ts`) y `fecha` se deriva al leerla. Los campos de vocabulario
+    cerrado (TIPOS_ROLES, PERMISOS, unidades) y los emails se internan: todos
+    los registros apuntan al mismo objeto.
+    """
+    __slots__ = ()
+    INTERNADOS = frozenset()
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.CAMPOS = cls.__slots__ + ("fecha",)
+        cls._CLAVES = frozenset(cls.CAMPOS)
+        cls._fila = attrgetter(*cls.__slots__)
+
+    def __init__(self, *valores):
+        # Una fila de otro largo es una instantánea dañada o de otro esquema
+        if len(valores) != len(self.__slots__):
+            raise ValueError(f"{type(self).__name__}: {len(valores)} valores "
+                             f"para {len(self.__slots__)} campos")
+        for campo, valor in zip(self.__slots__, valores):
+            setattr(self, campo, sys.intern(valor)
+                    if campo in self.INTERNADOS and type(valor) is str else valor)
+
+    @classmethod
+    def desde(cls, datos):
+        """Registro a partir del dict de siempre o de una fila(); el mismo si ya lo es."""
+        if isinstance(datos, cls):
+            return datos
+        if isinstance(datos, tuple):
+            return cls(*datos)
+        return cls(*cls._valores(datos))
+
+    def fila(self):
+        """Valores en el orden de los slots (para serializar sin nombres de campo)."""
+        return self._fila(self)
+
+    def guardable(self):
+        """dict con los campos guardados (sin los derivados, como `fecha`)."""
+        return dict(zip(self.__slots__, self.fila()))
+
+    @property
+    def fecha(self):
+        return texto_fecha(self.ts)
+
+    def __getitem__(self, campo):
+        if campo in self._CLAVES:
+            return getattr(self, campo)
+        raise KeyError(campo)
+
+    def get(self, campo, defecto=None):
+        return getattr(self, campo) if campo in self._CLAVES else defecto
+
+    def __contains__(self, campo):
+        return campo in self._CLAVES
+
+    def __iter__(self):
+        return iter(self.CAMPOS)
+
+    def __len__(self):
+        return len(self.CAMPOS)
+
+    def __reduce__(self):
+        return type(self), self.fila()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+class Publicacion(_Registro):
+    __slots__ = ("id", "usuario", "empresa", "rol", "tipo", "subtipo", "categoria", "producto",
+                 "descripcion", "precio", "moneda", "monto", "unidad", "servicio_objetivo", "ts",
+                 "vence")
+    INTERNADOS = frozenset({"usuario", "empresa", "rol", "tipo", "subtipo", "categoria",
+                            "moneda", "unidad", "servicio_objetivo"})
+
+    @staticmethod
+    def _valores(pub):
+        # Publicaciones anteriores a los campos de precio: se leen del texto
+        precio = pub if "monto" in pub else campos_precio(pub.get("precio"))
+        ts = pub.get("ts")
+        return (pub.get("id"), pub.get("usuario"), pub.get("empresa"), pub.get("rol"), pub.get("tipo"),
+                pub.get("subtipo"), pub.get("categoria"), pub.get("producto"), pub.get("descripcion"),
+                pub.get("precio"), precio.get("moneda"), precio.get("monto"), precio.get("unidad"),
+                pub.get("servicio_objetivo"), ts if ts is not None else _epoch(pub.get("fecha")),
+                pub.get("vence"))
+
+
+class Mensaje(_Registro):
+    __slots__ = ("id", "origen", "destino", "contenido", "ts")
+    INTERNADOS = frozenset({"origen", "destino"})
+
+    @staticmethod
+    def _valores(msg):
+        ts = msg.get("ts")
+        return (msg.get("id"), msg.get("origen"), msg.get("destino"), msg.get("contenido"),
+                ts if ts is not None else _epoch(msg.get("fecha")))
+
+
+_BITS_ALTA = 32
+_MASCARA_ALTA = (1 << _BITS_ALTA) - 1
+_TODAS = (None, None)  # clave de la lista global en PublicacionStore._listas
+
+
+class _VistaPublicaciones:
+    """
+    Lo que publica cada escritura de PublicacionStore: cuántas altas existían,
+    la versión (para leer las bajas) y el dict de listas de orden vigente.
+    Un lector toma una vista y recorre con ella, sin lock.
+    """
+    __slots__ = ("altas", "version", "vivas", "listas")
+
+    def __init__(self, altas, version, vivas, listas):
+        self.altas = altas
+        self.version = version
+        self.vivas = vivas
+        self.listas = listas
+
+
+class PublicacionStore:
+    """
+    Publicaciones indexadas: acceso O(1) por id e índices secundarios
+    por categoria / rol / tipo / subtipo (listas de claves ordenadas por fecha).
+    Las que tienen `vence` quedan en un heap (vence, id) que consume el
+    barredor de vencidas.
+
+    Cada alta ocupa una posición nueva de `_altas` (sólo crece por el final) y
+    una baja no borra nada: anota en `_bajas` la versión desde la que ya no
+    está. Las claves de orden son ts << 32 | posición, así que el orden de las
+    claves es el orden por fecha y "desde X" es un bisect sobre X << 32. Las
+    listas de claves también sólo crecen por el final; una clave fuera de orden
+    o una compactación crean una lista nueva. Un lector con una vista ignora
+    las altas posteriores y las bajas de versiones más nuevas: ve siempre el
+    estado de un momento, y una escritura cuesta lo que toca, no lo que hay.
+    """
+    CAMPOS_INDICE = ("categoria", "rol", "tipo", "subtipo")
+    GRACIA = 60  # segundos que se conserva el registro de una baja para lectores en curso
+    NOMBRE = "publicaciones"
+    diario = None
+
+    def __init__(self):
+        self._altas = []     # posición -> Publicacion (None cuando ya pasó la gracia de su baja)
+        self._bajas = []     # posición -> 0 o versión desde la que está eliminada
+        self._pos_de = {}    # id -> posición vigente
+        self._cuantos = {campo: {} for campo in self.CAMPOS_INDICE}  # vivas por bucket
+        self._listas = {_TODAS: []}  # (campo, valor) -> claves ordenadas
+        self._reclamar = deque()     # (momento de la baja, posición)
+        self._vencen = []  # heap (vence, id); sólo escritores, bajo _lock
+        self._lock = threading.Lock()
+        self._vista = _VistaPublicaciones(0, 0, 0, self._listas)
+
+    @property
+    def version(self):
+        """Aumenta con cada escritura."""
+        return self._vista.version
+
+    def __len__(self):
+        return self._vista.vivas
+
+    def __iter__(self):
+        return self.recorrer()
+
+    def __contains__(self, pub_id):
+        return pub_id in self._pos_de
+
+    def get(self, pub_id):
+        pos = self._pos_de.get(pub_id)
+        return self._altas[pos] if pos is not None else None
+
+    def _leer(self, vista, pos):
+        """La publicación en `pos` tal como la ve `vista`, o None."""
+        if pos >= vista.altas:
+            return None
+        baja = self._bajas[pos]
+        if baja and baja <= vista.version:
+            return None
+        return self._altas[pos]
+
+    @contextmanager
+    def _escritura(self):
+        """Aplica la escritura en el lugar (sólo agrega) y publica una vista nueva."""
+        with self._lock:
+            version = self._vista.version + 1
+            pendientes, tocadas = {}, set()
+            try:
+                yield version, pendientes, tocadas
+            finally:
+                # También si falló a la mitad: lo ya agregado queda publicado y coherente
+                self._volcar(pendientes)
+                self._compactar(tocadas)
+                self._reclamar_bajas()
+                self._vista = _VistaPublicaciones(len(self._altas), version, len(self._pos_de),
+                                                  self._listas)
+
+    def _agregar(self, version, pendientes, tocadas, pub):
+        pub = Publicacion.desde(pub)
+        if pub.id in self._pos_de:
+            self._quitar(version, tocadas, pub.id)
+        pos = len(self._altas)
+        self._altas.append(pub)
+        self._bajas.append(0)
+        self._pos_de[pub.id] = pos
+        clave = (pub.ts or 0) << _BITS_ALTA | pos
+        pendientes.setdefault(_TODAS, []).append(clave)
+        for campo in self.CAMPOS_INDICE:
+            valor = getattr(pub, campo)
+            cuantos = self._cuantos[campo]
+            cuantos[valor] = cuantos.get(valor, 0) + 1
+            pendientes.setdefault((campo, valor), []).append(clave)
+        if pub.vence is not None:
+            heapq.heappush(self._vencen, (pub.vence, pub.id))
+        return pub
+
+    def _quitar(self, version, tocadas, pub_id):
+        pos = self._pos_de.pop(pub_id, None)
+        if pos is None:
+            return None
+        pub = self._altas[pos]
+        self._bajas[pos] = version
+        self._reclamar.append((time.monotonic(), pos))
+        tocadas.add(_TODAS)
+        for campo in self.CAMPOS_INDICE:
+            valor = getattr(pub, campo)
+            self._cuantos[campo][valor] -= 1
+            tocadas.add((campo, valor))
+        return pub
+
+    def _volcar(self, pendientes):
+        """Agrega las claves nuevas a sus listas: al final si son las más nuevas, si no en una copia."""
+        for llave, claves in pendientes.items():
+            claves.sort()
+            lista = self._listas.get(llave)
+            if lista is None:
+                self._listas[llave] = claves
+            elif not lista or claves[0] > lista[-1]:
+                lista.extend(claves)
+            else:
+                # Quien ya tiene la lista anterior la sigue viendo igual
+                self._listas[llave] = sorted(lista + claves)
+
+    def _compactar(self, tocadas):
+        """Listas con más bajas que vivas: se reemplazan por copias sólo con las vivas."""
+        nuevas = {}
+        for llave in tocadas:
+            lista = self._listas.get(llave)
+            vivas = len(self._pos_de) if llave == _TODAS else self._cuantos[llave[0]][llave[1]]
+            if lista is not None and len(lista) > 2 * vivas + 64:
+                bajas = self._bajas
+                nuevas[llave] = [c for c in lista if not bajas[c & _MASCARA_ALTA]]
+        if nuevas:
+            # dict nuevo: las vistas anteriores conservan sus listas (con esas bajas)
+            self._listas = dict(self._listas)
+            for llave, lista in nuevas.items():
+                if lista or llave == _TODAS:
+                    self._listas[llave] = lista
+                else:
+                    del self._listas[llave]
+                    del self._cuantos[llave[0]][llave[1]]
+
+    def _reclamar_bajas(self):
+        """Suelta los registros dados de baja hace más de GRACIA (ningún lector los recorre ya)."""
+        limite = time.monotonic() - self.GRACIA
+        while self._reclamar and self._reclamar[0][0] < limite:
+            self._altas[self._reclamar.popleft()[1]] = None
+
+    @anotado
+    def agregar(self, pub):
+        """Registra la publicación (como Publicacion) y actualiza los índices; la devuelve."""
+        with self._escritura() as (version, pendientes, tocadas):
+            return self._agregar(version, pendientes, tocadas, pub)
+
+    append = agregar
+
+    @anotado
+    def agregar_lote(self, pubs):
+        """Como agregar() para varias, publicadas juntas en una sola vista."""
+        with self._escritura() as (version, pendientes, tocadas):
+            return [self._agregar(version, pendientes, tocadas, pub) for pub in pubs]
+
+    def recorrer(self):
+        """Publicaciones en orden de alta, sin copiar la colección (para exportar)."""
+        vista = self._vista
+        altas, bajas, version = self._altas, self._bajas, vista.version
+        for pos in range(vista.altas):
+            baja = bajas[pos]
+            if not baja or baja > version:
+                pub = altas[pos]
+                if pub is not None:
+                    yield pub
+
+    @anotado
+    def eliminar(self, pub_id):
+        """Quita la publicación por id; devuelve la publicación o None."""
+        if pub_id not in self._pos_de:
+            return None
+        with self._escritura() as (version, _, tocadas):
+            return self._quitar(version, tocadas, pub_id)
+
+    def vencidas(self, ahora):
+        """Ids con `vence` <= ahora (el heap descarta las ya eliminadas o re-publicadas)."""
+        ids = []
+        with self._lock:
+            while self._vencen and self._vencen[0][0] <= ahora:
+                vence, pub_id = heapq.heappop(self._vencen)
+                pub = self.get(pub_id)
+                if pub is not None and pub.vence == vence:
+                    ids.append(pub_id)
+        return ids
+
+    def proximo_vencimiento(self):
+        with self._lock:
+            return self._vencen[0][0] if self._vencen else None
+
+    def instantanea(self):
+        """Filas de las publicaciones de la vista vigente, en orden de alta."""
+        return [pub.fila() for pub in self.recorrer()]
+
+    def restaurar(self, pubs):
+        self.agregar_lote.__wrapped__(self, pubs)
+
+    def _plan(self, vista, clausula):
+        """(lista del bucket más chico de la cláusula, resto de condiciones) o None si no hay."""
+        if not clausula:
+            return vista.listas[_TODAS], ()
+        campos = sorted(clausula.items(),
+                        key=lambda cv: self._cuantos[cv[0]].get(cv[1], 0))
+        lista = vista.listas.get(campos[0])
+        return (lista, campos[1:]) if lista is not None else None
+
+    def buscar(self, *clausulas, desde=None):
+        """
+        Cada cláusula es un dict campo -> valor (AND por intersección de índices);
+        varias cláusulas se combinan con OR. Ordenadas por fecha; `desde` (epoch)
+        deja sólo las publicadas desde ese momento.
+        """
+        vista = self._vista
+        inicio = 0 if desde is None else desde << _BITS_ALTA
+        parciales = []
+        for clausula in clausulas:
+            plan = self._plan(vista, clausula)
+            if plan is not None:
+                lista, resto = plan
+                vivas = self._vivas(vista, lista, inicio)
+                parciales.append(vivas if not resto else
+                                 [(c, pub) for c, pub in vivas
+                                  if all(getattr(pub, campo) == valor for campo, valor in resto)])
+
+        if len(parciales) == 1:  # una sola cláusula: ya viene ordenada y sin repetidos
+            return [pub for _, pub in parciales[0]]
+        visibles, ultima = [], None
+        for clave, pub in heapq.merge(*parciales, key=itemgetter(0)):
+            if clave != ultima:  # la misma publicación llega por varias cláusulas
+                ultima = clave
+                visibles.append(pub)
+        return visibles
+
+    def _vivas(self, vista, lista, inicio):
+        """[(clave, publicación)] vivas en `vista` desde `inicio`, de más vieja a más nueva."""
+        claves = lista[bisect_left(lista, inicio):] if inicio else lista[:]
+        # Lo de _leer(), en línea: es el recorrido completo de buscar()
+        altas, bajas, n, version = self._altas, self._bajas, vista.altas, vista.version
+        vivas = []
+        for clave in claves:
+            pos = clave & _MASCARA_ALTA
+            if pos < n:
+                baja = bajas[pos]
+                if not baja or baja > version:
+                    pub = altas[pos]
+                    if pub is not None:
+                        vivas.append((clave, pub))
+        return vivas
+
+    def _recorrer(self, vista, lista, antes, inicio=0):
+        """(clave, publicación) vivas en `vista`, de más nueva a más vieja, en [inicio, antes)."""
+        fin = len(lista) if antes is None else bisect_left(lista, antes)
+        tope = bisect_left(lista, inicio, hi=fin) if inicio else 0
+        altas, bajas, n, version = self._altas, self._bajas, vista.altas, vista.version
+        for i in range(fin - 1, tope - 1, -1):
+            clave = lista[i]
+            pos = clave & _MASCARA_ALTA
+            if pos < n:
+                baja = bajas[pos]
+                if not baja or baja > version:
+                    pub = altas[pos]
+                    if pub is not None:
+                        yield clave, pub
+
+    def pagina(self, *clausulas, antes=None, desde=None, limite=20):
+        """
+        Igual que buscar() pero de la más reciente a la más antigua y por cursor:
+        `antes` es la clave (exclusiva) devuelta como siguiente y `desde` un
+        epoch mínimo. Se detiene tras limite + 1 coincidencias; devuelve
+        (página, siguiente o None).
+        """
+        vista = self._vista
+        inicio = 0 if desde is None else desde << _BITS_ALTA
+        fuentes = []
+        for clausula in clausulas:
+            plan = self._plan(vista, clausula)
+            if plan is None:
+                continue
+            lista, resto = plan
+            recorrido = self._recorrer(vista, lista, antes, inicio)
+            fuentes.append(recorrido if not resto else
+                           ((c, pub) for c, pub in recorrido
+                            if all(getattr(pub, campo) == valor for campo, valor in resto)))
+
+        pagina, ultimo = [], None
+        mezcla = fuentes[0] if len(fuentes) == 1 else heapq.merge(*fuentes, key=lambda par: -par[0])
+        for clave, pub in mezcla:
+            if clave == ultimo:  # la misma publicación llega por varias cláusulas
+                continue
+            if len(pagina) == limite:
+                return pagina, ultimo
+            ultimo = clave
+            pagina.append(pub)
+        return pagina, None
+
+
+class MensajeStore:
+    """
+    Mensajes indexados por par (origen, destino) con la última fecha de envío
+    en epoch, y bandejas de entrada/salida por usuario ordenadas por id creciente.
+    Las listas sólo crecen por el final: basta un lock para los escritores.
+    Tras restaurar una instantánea, los mensajes anteriores quedan en `_base`
+    (archivo mapeado, cada uno se decodifica al leerlo) y las listas sólo
+    guardan los nuevos.
+    """
+    NOMBRE = "mensajes"
+    diario = None
+
+    def __init__(self):
+        self._base = None
+        self._todos = []
+        self._seq = 0
+        self._ultimo_envio = {}
+        self._entrada = {}
+        self._salida = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self):
+        return len(self._todos) + (len(self._base) if self._base is not None else 0)
+
+    def __iter__(self):
+        return chain(self._base if self._base is not None else (), list(self._todos))
+
+    @anotado
+    def agregar(self, msg):
+        """Registra el mensaje (asigna id y epoch 'ts' si faltan) y actualiza índices; devuelve el Mensaje."""
+        with self._lock:
+            self._seq += 1
+            # En el dict recibido: el diario lo anota con id y ts ya asignados
+            msg.setdefault("id", self._seq)
+            msg.setdefault("ts", int(time.time()))
+            msg = Mensaje.desde(msg)
+            self._todos.append(msg)
+            par = (msg.origen, msg.destino)
+            self._ultimo_envio[par] = max(msg.ts, self._ultimo_envio.get(par, 0))
+            self._entrada.setdefault(msg.destino, []).append(msg)
+            self._salida.setdefault(msg.origen, []).append(msg)
+            self.version += 1
+        return msg
+
+    append = agregar
+
+    def recorrer(self):
+        """Mensajes en orden de llegada, sin copiar la lista (para exportar)."""
+        if self._base is not None:
+            yield from self._base
+        pos = 0
+        while pos < len(self._todos):
+            yield self._todos[pos]
+            pos += 1
+
+    def instantanea(self):
+        """(base, mensajes nuevos hasta ahora, secuencia): la lista sólo crece, basta el largo."""
+        return self._base, self._todos[:], self._seq
+
+    def restaurar(self, base):
+        """Toma como base los mensajes mapeados de una instantánea (_MensajesMapeados)."""
+        with self._lock:
+            self._base = base
+            self._seq = max(self._seq, base.seq)
+            self.version += 1
+
+    def ultimo_envio(self, origen, destino):
+        """Epoch del último mensaje de origen a destino, o None."""
+        ts = self._ultimo_envio.get((origen, destino))
+        if self._base is not None:
+            previo = self._base.ultimo_envio(origen, destino)
+            if previo is not None:
+                ts = previo if ts is None else max(ts, previo)
+        return ts
+
+    @staticmethod
+    def _pagina(bandeja, antes, limite):
+        """Página más reciente primero; `antes` es el id cursor (exclusivo)."""
+        fin = len(bandeja) if antes is None else bisect_left(bandeja, antes, key=itemgetter("id"))
+        inicio = max(0, fin - limite)
+        pagina = bandeja[inicio:fin][::-1]
+        siguiente = bandeja[inicio]["id"] if inicio > 0 else None
+        return pagina, siguiente
+
+    def _bandeja(self, lado, email):
+        nuevos = (self._entrada if lado == "entrada" else self._salida).get(email, [])
+        if self._base is None:
+            return nuevos
+        return _Concatenada(self._base.bandeja(lado, email), nuevos)
+
+    def recibidos(self, email, antes=None, limite=20):
+        return self._pagina(self._bandeja("entrada", email), antes, limite)
+
+    def enviados(self, email, antes=None, limite=20):
+        return self._pagina(self._bandeja("salida", email), antes, limite)
+
+
+class _Concatenada:
+    """Secuencia de sólo lectura a + b sin copiar (mensajes mapeados + nuevos)."""
+
+    def __init__(self, a, b):
+        self.a, self.b = a, b
+
+    def __len__(self):
+        return len(self.a) + len(self.b)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        n = len(self.a)
+        return self.a[i] if i < n else self.b[i - n]
+
+
+def _id_item(email, pos):
+    """Id estable y determinista para los ítems sembrados sin id (USUARIOS_DEMO)."""
+    return f"item_{uuid5(NAMESPACE_URL, f'{email}#{pos}').hex[:8]}"
+
+def nuevo_id_item():
+    """Id de un ítem nuevo: nunca reutiliza el de otro, aunque ocupe su posición."""
+    return f"item_{uuid4().hex[:8]}"
+
+# Precio en texto libre ("USD 8.20/kg", "USD 85.00/caja", "USD 420", "Consultar")
+# -> moneda, monto y unidad. Se calcula una vez al escribir la publicación o el
+# ítem y se guarda junto al texto, que sigue siendo lo que se muestra.
+UNIDADES_PRECIO = {
+    "kg": ("kg", "kgs", "kilo", "kilos", "kilogramo", "kilogramos"),
+    "tons": ("t", "tn", "ton", "tons", "tonelada", "toneladas"),
+    "boxes": ("caja", "cajas", "box", "boxes"),
+    "pallets": ("pallet", "pallets", "palet", "palets"),
+    "units": ("u", "un", "und", "unidad", "unidades", "unit", "units"),
+}
+_UNIDAD_DE = {alias: unidad for unidad, alias_ in UNIDADES_PRECIO.items() for alias in alias_}
+CAMPOS_PRECIO = ("moneda", "monto", "unidad")
+_RE_PRECIO = re.compile(
+    r"^\s*(?P<antes>[a-z]{3}|us\$|\$)?\s*(?P<monto>\d+(?:[.,]\d+)*)\s*(?P<despues>[a-z]{3})?"
+    r"\s*(?:(?:/|por|per)\s*(?P<unidad>[a-z]+)\.?)?\s*$")
+
+def _monto(texto):
+    """'8.20' -> 8.2, '1.500' -> 1500, '1.234,5' -> 1234.5."""
+    separadores = [c for c in texto if c in ".,"]
+    if not separadores:
+        return float(texto)
+    entero, decimal, fraccion = texto.rpartition(separadores[-1])
+    solo_miles = len(set(separadores)) == 1 and (
+        len(separadores) > 1 or (len(fraccion) == 3 and not entero.startswith("0")))
+    if solo_miles:
+        return float(texto.replace(decimal, ""))
+    return float(entero.replace(".", "").replace(",", "") + "." + fraccion)
+
+def campos_precio(texto):
+    """{"moneda", "monto", "unidad"} leídos del texto; None en lo que no se entienda."""
+    m = _RE_PRECIO.match((texto or "").lower())
+    if not m:
+        return dict.fromkeys(CAMPOS_PRECIO)
+    moneda = m["antes"] or m["despues"]
+    return {
+        # Los precios del sitio se publican en dólares: "$" y "US$" son USD
+        "moneda": "USD" if moneda in ("$", "us$") else moneda and moneda.upper(),
+        "monto": _monto(m["monto"]),
+        # Sin unidad ("USD 420") es un precio por unidad (flete, servicio, ...)
+        "unidad": _UNIDAD_DE.get(m["unidad"]) if m["unidad"] else "units",
+    }
+
+def precio_de(registro):
+    """Campos de precio guardados al escribir; los registros anteriores se leen del texto."""
+    if "monto" in registro:
+        return {c: registro.get(c) for c in CAMPOS_PRECIO}
+    return campos_precio(registro.get("precio"))
+
+def _entrada_catalogo(info, item):
+    """Entrada de carrito (misma forma que una publicación) para un ítem de catálogo."""
+    return {
+        "id": item["id"],
+        "usuario": info["email"],
+        "empresa": info.get("empresa"),
+        "rol": info.get("rol"),
+        "tipo": info.get("tipo"),
+        "producto": item.get("nombre"),
+        "descripcion": item.get("detalle"),
+        "precio": item.get("precio", "Consultar"),
+        **precio_de(item),
+        "fecha": info.get("fecha"),
+    }
+
+
+def usuario_para_guardar(info):
+    """
+    Copia de `info` tal como se guarda: ítems copiados, con campos de precio
+    (los ítems nuevos traen su id; sólo los sembrados sin id usan _id_item).
+    Un usuario guardado no se vuelve a modificar (los lectores lo usan sin
+    lock): para cambiarlo se guarda una copia con los cambios.
+    """
+    info = dict(info)
+    if "items" in info:
+        email = info["email"]
+        info["items"] = [dict(item, id=item["id"] if "id" in item else _id_item(email, pos),
+                              **campos_precio(item.get("precio")))
+                         for pos, item in enumerate(info["items"] or [])]
+    return info
+
+
+def _clave_empresa(info):
+    """Clave de orden del directorio: (empresa en minúsculas, email) para desempatar."""
+    return ((info.get("empresa") or "").lower(), info["email"])
+
+
+class UsuarioStore:
+    """
+    Usuarios por email con índices mantenidos: username (minúsculas) -> email,
+    id de ítem de catálogo -> entrada lista para el carrito y lista ordenada
+    por empresa para paginar el directorio por cursor.
+    Los usuarios siguen siendo dicts, pero nunca se editan en el lugar:
+    guardar() guarda una copia (usuario_para_guardar) y la devuelve, y sólo se
+    internan sus campos repetidos en publicaciones y mensajes.
+    Escritores bajo lock y sin copiar el almacén: cada paso es una operación
+    atómica sobre un dict o sobre la lista del directorio, los lectores
+    consultan por clave y el directorio se recorre por clave de cursor, no por
+    posición (no hay bajas de usuarios).
+    """
+    NOMBRE = "usuarios"
+    INTERNADOS = ("email", "username", "empresa", "tipo", "rol", "pais")
+    diario = None
+
+    def __init__(self):
+        self._por_email = {}
+        self._usernames = {}
+        self._username_de = {}
+        self._catalogo = {}
+        self._items_de = {}
+        self._por_empresa = []
+        self._clave_de = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self):
+        return len(self._por_email)
+
+    def __iter__(self):
+        # list(dict) se arma sin soltar el GIL: una escritura no lo corta a la mitad
+        return iter(list(self._por_email))
+
+    def __contains__(self, email):
+        return email in self._por_email
+
+    def __getitem__(self, email):
+        return self._por_email[email]
+
+    def get(self, email, default=None):
+        return self._por_email.get(email, default)
+
+    def items(self):
+        return list(self._por_email.items())
+
+    def values(self):
+        return list(self._por_email.values())
+
+    def _guardar(self, info, claves_nuevas=None):
+        info = usuario_para_guardar(info)
+        for campo in self.INTERNADOS:
+            if type(info.get(campo)) is str:
+                info[campo] = sys.intern(info[campo])
+        email = info["email"]
+
+        # Ítems primero: cuando el usuario se vea, su catálogo ya está
+        ids = []
+        for item in info.get("items") or []:
+            ids.append(item["id"])
+            self._catalogo[item["id"]] = Publicacion.desde(_entrada_catalogo(info, item))
+        for item_id in set(self._items_de.get(email, ())) - set(ids):
+            self._catalogo.pop(item_id, None)
+        self._items_de[email] = ids
+
+        self._por_email[email] = info
+
+        uname = info.get("username", "").lower()
+        anterior = self._username_de.get(email)
+        self._usernames[uname] = email
+        self._username_de[email] = uname
+        if anterior is not None and anterior != uname and self._usernames.get(anterior) == email:
+            del self._usernames[anterior]
+
+        clave, anterior = _clave_empresa(info), self._clave_de.get(email)
+        if clave != anterior:
+            if anterior is not None:
+                del self._por_empresa[bisect_left(self._por_empresa, anterior)]
+            if claves_nuevas is None:
+                insort(self._por_empresa, clave)
+            else:
+                claves_nuevas.append(clave)
+            self._clave_de[email] = clave
+        return info
+
+    @anotado
+    def guardar(self, info):
+        """Inserta o actualiza el usuario y (re)indexa su username e ítems; devuelve el guardado."""
+        with self._lock:
+            info = self._guardar(info)
+            self.version += 1
+        return info
+
+    @anotado
+    def crear(self, info):
+        """Como guardar() pero sólo si el email no existe; None si ya estaba."""
+        with self._lock:
+            if info["email"] in self._por_email:
+                return None
+            info = self._guardar(info)
+            self.version += 1
+        return info
+
+    def instantanea(self):
+        return list(self._por_email.values())
+
+    def restaurar(self, infos):
+        """Carga masiva: el directorio se ordena una sola vez, en una lista nueva."""
+        with self._lock:
+            claves = []
+            # Un email repetido en el lote dejaría su clave vieja en `claves`
+            for info in {info["email"]: info for info in infos}.values():
+                self._guardar(info, claves)
+            self._por_empresa = sorted(self._por_empresa + claves)
+            self.version += 1
+
+    def por_username(self, username):
+        email = self._usernames.get((username or "").lower())
+        return self._por_email.get(email) if email else None
+
+    def item_catalogo(self, item_id):
+        return self._catalogo.get(item_id)
+
+    def por_empresa(self, despues=None):
+        """Usuarios en orden de empresa a partir del cursor `despues` (exclusivo), perezoso."""
+        clave = None if despues is None else tuple(despues)
+        while True:
+            lista = self._por_empresa
+            pos = 0 if clave is None else bisect_right(lista, clave)
+            try:
+                clave = lista[pos]
+            except IndexError:
+                return
+            info = self._por_email.get(clave[1])
+            if info is not None:
+                yield info
+
+
+class OcultosStore:
+    """Empresas (por username) que cada usuario ocultó de su vista."""
+    NOMBRE = "ocultos"
+    diario = None
+
+    def __init__(self):
+        self._por_email = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self):
+        return len(self._por_email)
+
+    def de(self, email):
+        return self._por_email.get(email, frozenset())
+
+    @anotado
+    def ocultar(self, email, username):
+        # Conjunto nuevo en vez de modificar el que otro hilo puede estar recorriendo
+        with self._lock:
+            self._por_email[email] = self._por_email.get(email, frozenset()) | {username.lower()}
+            self.version += 1
+
+    @anotado
+    def mostrar_todo(self, email):
+        """Vacía los ocultos del usuario; True si había alguno."""
+        with self._lock:
+            self.version += 1
+            return bool(self._por_email.pop(email, None))
+
+    def instantanea(self):
+        return {email: sorted(usernames) for email, usernames in self._por_email.items()}
+
+    def restaurar(self, por_email):
+        with self._lock:
+            self._por_email = {email: frozenset(u) for email, u in por_email.items()}
+            self.version += 1
+
+
+class CarritoStore:
+    """
+    Carrito de cada usuario como dict id de ítem -> cantidad: pertenencia en O(1)
+    y orden de inserción. Sólo se guardan ids; los datos y el precio se leen al
+    mostrarlo.
+    """
+    NOMBRE = "carritos"
+    diario = None
+
+    def __init__(self):
+        self._por_email = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._por_email)
+
+    def de(self, email):
+        """[(id, cantidad)] en el orden en que se agregaron."""
+        return list(self._por_email.get(email, {}).items())
+
+    def cuantos(self, email):
+        return len(self._por_email.get(email, ()))
+
+    @anotado
+    def agregar(self, email, ids, cantidad=1):
+        """Agrega los ids que no estaban; devuelve la lista de los nuevos."""
+        with self._lock:
+            carrito = self._por_email.setdefault(email, {})
+            nuevos = [i for i in dict.fromkeys(ids) if i not in carrito]
+            for item_id in nuevos:
+                carrito[item_id] = cantidad
+            return nuevos
+
+    @anotado
+    def fijar_cantidad(self, email, item_id, cantidad):
+        """Cambia la cantidad de un ítem del carrito; False si no estaba."""
+        with self._lock:
+            carrito = self._por_email.get(email, {})
+            if item_id not in carrito:
+                return False
+            carrito[item_id] = cantidad
+            return True
+
+    @anotado
+    def quitar(self, email, item_id):
+        with self._lock:
+            return self._por_email.get(email, {}).pop(item_id, None) is not None
+
+    @anotado
+    def vaciar(self, email):
+        """Vacía el carrito del usuario; True si tenía algo."""
+        with self._lock:
+            return bool(self._por_email.pop(email, None))
+
+    def instantanea(self):
+        with self._lock:
+            return {email: list(carrito.items()) for email, carrito in self._por_email.items()}
+
+    def restaurar(self, por_email):
+        with self._lock:
+            self._por_email = {email: dict(items) for email, items in por_email.items()}
+
+
+class DocumentoStore:
+    """Referencias por sha256 a los documentos guardados en disco."""
+    NOMBRE = "documentos"
+    diario = None
+
+    def __init__(self):
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._refs)
+
+    def refs(self, sha256):
+        return self._refs.get(sha256, 0)
+
+    @anotado
+    def referenciar(self, sha256):
+        """Suma una referencia; devuelve el total."""
+        with self._lock:
+            self._refs[sha256] = self._refs.get(sha256, 0) + 1
+            return self._refs[sha256]
+
+    @anotado
+    def liberar(self, sha256):
+        """Resta una referencia; devuelve las que quedan (0 = ya nadie lo usa)."""
+        with self._lock:
+            quedan = self._refs.get(sha256, 0) - 1
+            if quedan > 0:
+                self._refs[sha256] = quedan
+            else:
+                self._refs.pop(sha256, None)
+            return max(quedan, 0)
+
+    def instantanea(self):
+        with self._lock:
+            return dict(self._refs)
+
+    def restaurar(self, refs):
+        with self._lock:
+            self._refs = dict(refs)
+
+
+# ---------------------------------------------------------
+# 🗄️ BACKEND SQLITE (WAL) PARA LOS ALMACENES
+# ---------------------------------------------------------
+# Mismas interfaces que los almacenes en memoria; cada registro se guarda como
+# JSON junto a las columnas que usan las rutas para filtrar (email, username,
+# categoria/rol, par de mensajes), todas indexadas.
+ESQUEMA_SQLITE = """
+CREATE TABLE IF NOT EXISTS usuarios (
+    email TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    tipo TEXT,
+    rol TEXT,
+    empresa_orden TEXT,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usuarios_username ON usuarios(username);
+CREATE INDEX IF NOT EXISTS usuarios_tipo_rol ON usuarios(tipo, rol);
+CREATE INDEX IF NOT EXISTS usuarios_empresa ON usuarios(empresa_orden, email);
+
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_email ON items(email);
+
+CREATE TABLE IF NOT EXISTS publicaciones (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    usuario TEXT,
+    categoria TEXT,
+    rol TEXT,
+    tipo TEXT,
+    subtipo TEXT,
+    ts INTEGER,
+    vence INTEGER,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS publicaciones_categoria_rol ON publicaciones(categoria, rol);
+CREATE INDEX IF NOT EXISTS publicaciones_rol ON publicaciones(rol);
+CREATE INDEX IF NOT EXISTS publicaciones_tipo ON publicaciones(tipo);
+CREATE INDEX IF NOT EXISTS publicaciones_subtipo ON publicaciones(subtipo);
+CREATE INDEX IF NOT EXISTS publicaciones_ts ON publicaciones(ts);
+CREATE INDEX IF NOT EXISTS publicaciones_vence ON publicaciones(vence) WHERE vence IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS mensajes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origen TEXT NOT NULL,
+    destino TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    datos TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mensajes_par ON mensajes(origen, destino, ts);
+CREATE INDEX IF NOT EXISTS mensajes_destino ON mensajes(destino, id);
+CREATE INDEX IF NOT EXISTS mensajes_origen ON mensajes(origen, id);
+
+CREATE TABLE IF NOT EXISTS ocultos (
+    email TEXT NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (email, username)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS documentos (
+    sha256 TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS carritos (
+    seq INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    cantidad INTEGER NOT NULL,
+    UNIQUE (email, item_id)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+# PRAGMA data_version sólo es comparable dentro de una conexión; para una versión
+# común a todos los workers (ETags, cachés) cada escritura incrementa la fila
+# meta 'version:<tabla>' de su tabla: un mensaje no invalida lo que depende
+# sólo de usuarios y publicaciones.
+TABLAS_VERSIONADAS = ("usuarios", "publicaciones", "mensajes", "ocultos")
+ESQUEMA_SQLITE += "".join(
+    f"INSERT OR IGNORE INTO meta (clave, valor) VALUES ('version:{tabla}', 0);\n"
+    for tabla in TABLAS_VERSIONADAS)
+ESQUEMA_SQLITE += "".join(
+    f"CREATE TRIGGER IF NOT EXISTS {tabla}_{op.lower()}_version_tabla AFTER {op} ON {tabla} "
+    f"BEGIN UPDATE meta SET valor = valor + 1 WHERE clave = 'version:{tabla}'; END;\n"
+    for tabla in TABLAS_VERSIONADAS
+    for op in ("INSERT", "UPDATE", "DELETE"))
+
+
+class ConexionesSQLite:
+    """
+    Pool por worker: una conexión por hilo del SO (no por greenlet), recreada
+    tras un fork. Con WAL los lectores trabajan sobre su propia instantánea y
+    nunca esperan al escritor.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._pid = os.getpid()
+        self._local = _LocalDelHilo()
+        with self() as con:
+            con.executescript(ESQUEMA_SQLITE)
+        self.cache = CacheLectura(ruta)
+
+    def __call__(self):
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._local = _LocalDelHilo()
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.ruta, timeout=30, cached_statements=256)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+
+class CacheLectura:
+    """
+    Caché de lecturas local al worker. Se vacía cuando cambia PRAGMA data_version
+    en una conexión vigía que nunca escribe: así detecta, con una consulta
+    barata, los commits de cualquier otra conexión de este u otro proceso.
+    Entonces relee las filas 'version:<tabla>' de meta, compartidas entre procesos.
+    """
+    SQL_VERSIONES = "SELECT clave, valor FROM meta WHERE clave LIKE 'version:%'"
+    MAX_ENTRADAS = 2048
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._pid = None
+        self._vigia = None
+        self._version = None
+        self._versiones = {}
+        self._datos = {}
+
+    def _comprobar_version(self):
+        if self._pid != os.getpid():
+            self._vigia = sqlite3.connect(self.ruta, check_same_thread=False)
+            self._pid = os.getpid()
+            self._version = None
+        version = self._vigia.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._datos.clear()
+            self._version = version
+            self._versiones = dict(self._vigia.execute(self.SQL_VERSIONES).fetchall())
+
+    def version(self, tabla):
+        """Versión de `tabla` en la base: igual en todos los workers para los mismos datos."""
+        with self._lock:
+            self._comprobar_version()
+            return self._versiones.get("version:" + tabla, 0)
+
+    def obtener(self, clave, calcular):
+        with self._lock:
+            self._comprobar_version()
+            if clave in self._datos:
+                return self._datos[clave]
+            version = self._version
+        valor = calcular()
+        with self._lock:
+            # Si otro hilo ya vio un commit posterior, este valor podría ser viejo
+            if self._version == version:
+                if len(self._datos) >= self.MAX_ENTRADAS:
+                    self._datos.pop(next(iter(self._datos)))
+                self._datos[clave] = valor
+        return valor
+
+
+def _a_json(registro):
+    if isinstance(registro, _Registro):
+        registro = registro.guardable()
+    return json.dumps(registro, ensure_ascii=False)
+
+
+class UsuarioSQLite:
+    SQL_CONTAR = "SELECT COUNT(*) FROM usuarios"
+    SQL_EMAILS = "SELECT email FROM usuarios ORDER BY rowid"
+    SQL_TODOS = "SELECT datos FROM usuarios ORDER BY rowid"
+    SQL_GET = "SELECT datos FROM usuarios WHERE email = ?"
+    SQL_EXISTE = "SELECT 1 FROM usuarios WHERE email = ?"
+    SQL_POR_USERNAME = "SELECT datos FROM usuarios WHERE username = ? ORDER BY rowid DESC LIMIT 1"
+    SQL_GUARDAR = ("INSERT INTO usuarios (email, username, tipo, rol, empresa_orden, datos) "
+                   "VALUES (?, ?, ?, ?, ?, ?) "
+                   "ON CONFLICT(email) DO UPDATE SET username = excluded.username, "
+                   "tipo = excluded.tipo, rol = excluded.rol, "
+                   "empresa_orden = excluded.empresa_orden, datos = excluded.datos")
+    SQL_CREAR = ("INSERT OR IGNORE INTO usuarios (email, username, tipo, rol, empresa_orden, datos) "
+                 "VALUES (?, ?, ?, ?, ?, ?)")
+    SQL_POR_EMPRESA = ("SELECT empresa_orden, email, datos FROM usuarios "
+                       "WHERE (empresa_orden, email) > (?, ?) ORDER BY empresa_orden, email LIMIT ?")
+    LOTE_EMPRESAS = 64
+    SQL_BORRAR_ITEMS = "DELETE FROM items WHERE email = ?"
+    SQL_INSERTAR_ITEM = "INSERT OR REPLACE INTO items (id, email) VALUES (?, ?)"
+    SQL_ITEM = "SELECT u.datos FROM items i JOIN usuarios u ON u.email = i.email WHERE i.id = ?"
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+        self._cache = conexiones.cache
+
+    @property
+    def version(self):
+        return self._cache.version("usuarios")
+
+    def __len__(self):
+        return self._cache.obtener(("usuarios_len",),
+                                   lambda: self._con().execute(self.SQL_CONTAR).fetchone()[0])
+
+    def __iter__(self):
+        return (fila[0] for fila in self._con().execute(self.SQL_EMAILS))
+
+    def __contains__(self, email):
+        return self._json(email) is not None
+
+    def _json(self, email):
+        def leer():
+            fila = self._con().execute(self.SQL_GET, (email,)).fetchone()
+            return fila[0] if fila else None
+        return self._cache.obtener(("usuario", email), leer)
+
+    def __getitem__(self, email):
+        info = self.get(email)
+        if info is None:
+            raise KeyError(email)
+        return info
+
+    def get(self, email, default=None):
+        # Se devuelve una copia nueva: las rutas la modifican antes de guardar()
+        datos = self._json(email)
+        return json.loads(datos) if datos is not None else default
+
+    def values(self):
+        return list(self._cache.obtener(
+            ("usuarios",),
+            lambda: [json.loads(fila[0]) for fila in self._con().execute(self.SQL_TODOS)]))
+
+    def items(self):
+        return [(info["email"], info) for info in self.values()]
+
+    def _escribir(self, sql, info):
+        info = usuario_para_guardar(info)
+        email = info["email"]
+        con = self._con()
+        with con:
+            cursor = con.execute(sql, (email, info.get("username", "").lower(),
+                                       info.get("tipo"), info.get("rol"),
+                                       _clave_empresa(info)[0], _a_json(info)))
+            if cursor.rowcount == 0:
+                return None
+            con.execute(self.SQL_BORRAR_ITEMS, (email,))
+            con.executemany(self.SQL_INSERTAR_ITEM,
+                            [(item["id"], email) for item in info.get("items") or []])
+        return info
+
+    def guardar(self, info):
+        return self._escribir(self.SQL_GUARDAR, info)
+
+    def crear(self, info):
+        return self._escribir(self.SQL_CREAR, info)
+
+    def por_username(self, username):
+        username = (username or "").lower()
+        def leer():
+            fila = self._con().execute(self.SQL_POR_USERNAME, (username,)).fetchone()
+            return fila[0] if fila else None
+        datos = self._cache.obtener(("username", username), leer)
+        return json.loads(datos) if datos is not None else None
+
+    def item_catalogo(self, item_id):
+        def leer():
+            fila = self._con().execute(self.SQL_ITEM, (item_id,)).fetchone()
+            if not fila:
+                return None
+            info = json.loads(fila[0])
+            item = next((i for i in info.get("items") or [] if i.get("id") == item_id), None)
+            return _entrada_catalogo(info, item) if item else None
+        entrada = self._cache.obtener(("item", item_id), leer)
+        return dict(entrada) if entrada else None
+
+    def por_empresa(self, despues=None):
+        """Keyset sobre (empresa_orden, email), leído en lotes a medida que se consume."""
+        despues = tuple(despues) if despues is not None else ("", "")
+        while True:
+            filas = self._con().execute(self.SQL_POR_EMPRESA, (*despues, self.LOTE_EMPRESAS)).fetchall()
+            for empresa, email, datos in filas:
+                yield json.loads(datos)
+            if len(filas) < self.LOTE_EMPRESAS:
+                return
+            despues = filas[-1][:2]
+
+
+class PublicacionSQLite:
+    CAMPOS_INDICE = PublicacionStore.CAMPOS_INDICE
+    SQL_CONTAR = "SELECT COUNT(*) FROM publicaciones"
+    SQL_TODAS = "SELECT datos FROM publicaciones ORDER BY seq"
+    SQL_GET = "SELECT datos FROM publicaciones WHERE id = ?"
+    SQL_BORRAR = "DELETE FROM publicaciones WHERE id = ?"
+    SQL_INSERTAR = ("INSERT INTO publicaciones (id, usuario, categoria, rol, tipo, subtipo, ts, vence, datos) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    SQL_VENCIDAS = "SELECT id FROM publicaciones WHERE vence <= ?"
+    SQL_PROXIMO = "SELECT MIN(vence) FROM publicaciones WHERE vence IS NOT NULL"
+    SQL_RECORRER = "SELECT seq, datos FROM publicaciones WHERE seq > ? ORDER BY seq LIMIT ?"
+    LOTE_RECORRER = 256
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+        self._cache = conexiones.cache
+
+    @property
+    def version(self):
+        return self._cache.version("publicaciones")
+
+    def __len__(self):
+        return self._cache.obtener(("publicaciones_len",),
+                                   lambda: self._con().execute(self.SQL_CONTAR).fetchone()[0])
+
+    def __iter__(self):
+        return (Publicacion.desde(json.loads(fila[0])) for fila in self._con().execute(self.SQL_TODAS))
+
+    def __contains__(self, pub_id):
+        return self.get(pub_id) is not None
+
+    def get(self, pub_id):
+        def leer():
+            fila = self._con().execute(self.SQL_GET, (pub_id,)).fetchone()
+            return fila[0] if fila else None
+        datos = self._cache.obtener(("publicacion", pub_id), leer)
+        return Publicacion.desde(json.loads(datos)) if datos is not None else None
+
+    def agregar(self, pub):
+        return self.agregar_lote([pub])[0]
+
+    append = agregar
+
+    def agregar_lote(self, pubs):
+        """Todas las publicaciones en una sola transacción; devuelve las Publicacion guardadas."""
+        pubs = [Publicacion.desde(pub) for pub in pubs]
+        con = self._con()
+        with con:
+            con.executemany(self.SQL_BORRAR, [(pub.id,) for pub in pubs])
+            con.executemany(self.SQL_INSERTAR, [(pub.id, pub.usuario, pub.categoria, pub.rol, pub.tipo,
+                                                 pub.subtipo, pub.ts, pub.vence, _a_json(pub))
+                                                for pub in pubs])
+        return pubs
+
+    def recorrer(self):
+        """Keyset sobre seq en lotes: no retiene una lectura abierta entre lotes."""
+        desde = 0
+        while True:
+            filas = self._con().execute(self.SQL_RECORRER, (desde, self.LOTE_RECORRER)).fetchall()
+            for _, datos in filas:
+                yield Publicacion.desde(json.loads(datos))
+            if len(filas) < self.LOTE_RECORRER:
+                return
+            desde = filas[-1][0]
+
+    def vencidas(self, ahora):
+        return [fila[0] for fila in self._con().execute(self.SQL_VENCIDAS, (ahora,))]
+
+    def proximo_vencimiento(self):
+        return self._con().execute(self.SQL_PROXIMO).fetchone()[0]
+
+    def eliminar(self, pub_id):
+        pub = self.get(pub_id)
+        if pub is not None:
+            con = self._con()
+            with con:
+                con.execute(self.SQL_BORRAR, (pub_id,))
+        return pub
+
+    def _condiciones(self, clausulas):
+        """Cláusulas OR-de-AND -> (expresión WHERE, parámetros), o (None, []) si no hay."""
+        condiciones, params = [], []
+        for clausula in clausulas:
+            partes = []
+            for campo, valor in clausula.items():
+                if campo not in self.CAMPOS_INDICE:
+                    raise ValueError(f"Campo no indexado: {campo}")
+                if valor is None:
+                    partes.append(f"{campo} IS NULL")
+                else:
+                    partes.append(f"{campo} = ?")
+                    params.append(valor)
+            condiciones.append("(" + " AND ".join(partes) + ")" if partes else "1")
+        return (" OR ".join(condiciones) if condiciones else None), params
+
+    def buscar(self, *clausulas, desde=None):
+        """Mismas cláusulas OR-de-AND que PublicacionStore.buscar, resueltas con índices SQL."""
+        where, params = self._condiciones(clausulas)
+        if where is None:
+            return []
+        if desde is not None:
+            where, params = f"({where}) AND ts >= ?", params + [desde]
+        # Las altas llevan la hora actual: el orden de seq es el orden por fecha
+        sql = f"SELECT datos FROM publicaciones WHERE {where} ORDER BY seq"
+        clave = ("buscar", sql, tuple(params))
+        return list(self._cache.obtener(
+            clave, lambda: [Publicacion.desde(json.loads(fila[0]))
+                            for fila in self._con().execute(sql, params)]))
+
+    def pagina(self, *clausulas, antes=None, desde=None, limite=20):
+        """Como PublicacionStore.pagina: keyset sobre seq con LIMIT página + 1."""
+        where, params = self._condiciones(clausulas)
+        if where is None:
+            return [], None
+        if desde is not None:
+            where, params = f"({where}) AND ts >= ?", params + [desde]
+        sql = f"SELECT seq, datos FROM publicaciones WHERE ({where}) AND seq < ? ORDER BY seq DESC LIMIT ?"
+        params = params + [antes if antes is not None else 2 ** 63 - 1, limite + 1]
+        filas = self._cache.obtener(("pagina", sql, tuple(params)),
+                                    lambda: self._con().execute(sql, params).fetchall())
+        pagina = [Publicacion.desde(json.loads(datos)) for _, datos in filas[:limite]]
+        siguiente = filas[limite - 1][0] if len(filas) > limite else None
+        return pagina, siguiente
+
+
+class MensajeSQLite:
+    SQL_CONTAR = "SELECT COUNT(*) FROM mensajes"
+    SQL_TODOS = "SELECT id, datos FROM mensajes ORDER BY id"
+    SQL_INSERTAR = "INSERT INTO mensajes (origen, destino, ts, datos) VALUES (?, ?, ?, ?)"
+    SQL_ULTIMO = "SELECT MAX(ts) FROM mensajes WHERE origen = ? AND destino = ?"
+    SQL_RECORRER = "SELECT id, datos FROM mensajes WHERE id > ? ORDER BY id LIMIT ?"
+    LOTE_RECORRER = 256
+    SQL_PAGINA = {
+        "destino": "SELECT id, datos FROM mensajes WHERE destino = ? AND id < ? ORDER BY id DESC LIMIT ?",
+        "origen": "SELECT id, datos FROM mensajes WHERE origen = ? AND id < ? ORDER BY id DESC LIMIT ?",
+    }
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+
+    @property
+    def version(self):
+        return self._con.cache.version("mensajes")
+
+    def __len__(self):
+        return self._con().execute(self.SQL_CONTAR).fetchone()[0]
+
+    def __iter__(self):
+        return (Mensaje.desde(dict(json.loads(datos), id=msg_id))
+                for msg_id, datos in self._con().execute(self.SQL_TODOS))
+
+    def agregar(self, msg):
+        msg.setdefault("ts", int(time.time()))
+        con = self._con()
+        with con:
+            cur = con.execute(self.SQL_INSERTAR, (msg["origen"], msg["destino"], msg["ts"],
+                                                  _a_json({k: v for k, v in msg.items() if k != "id"})))
+        msg["id"] = cur.lastrowid
+        return Mensaje.desde(msg)
+
+    append = agregar
+
+    def recorrer(self):
+        desde = 0
+        while True:
+            filas = self._con().execute(self.SQL_RECORRER, (desde, self.LOTE_RECORRER)).fetchall()
+            for msg_id, datos in filas:
+                yield Mensaje.desde(dict(json.loads(datos), id=msg_id))
+            if len(filas) < self.LOTE_RECORRER:
+                return
+            desde = filas[-1][0]
+
+    def ultimo_envio(self, origen, destino):
+        return self._con().execute(self.SQL_ULTIMO, (origen, destino)).fetchone()[0]
+
+    def _pagina(self, columna, email, antes, limite):
+        antes = antes if antes is not None else 2 ** 63 - 1
+        filas = self._con().execute(self.SQL_PAGINA[columna], (email, antes, limite + 1)).fetchall()
+        pagina = [Mensaje.desde(dict(json.loads(datos), id=msg_id)) for msg_id, datos in filas[:limite]]
+        siguiente = pagina[-1]["id"] if len(filas) > limite else None
+        return pagina, siguiente
+
+    def recibidos(self, email, antes=None, limite=20):
+        return self._pagina("destino", email, antes, limite)
+
+    def enviados(self, email, antes=None, limite=20):
+        return self._pagina("origen", email, antes, limite)
+
+
+class OcultosSQLite:
+    SQL_CONTAR = "SELECT COUNT(DISTINCT email) FROM ocultos"
+    SQL_DE = "SELECT username FROM ocultos WHERE email = ?"
+    SQL_OCULTAR = "INSERT OR IGNORE INTO ocultos (email, username) VALUES (?, ?)"
+    SQL_MOSTRAR_TODO = "DELETE FROM ocultos WHERE email = ?"
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+
+    @property
+    def version(self):
+        return self._con.cache.version("ocultos")
+
+    def __len__(self):
+        return self._con().execute(self.SQL_CONTAR).fetchone()[0]
+
+    def de(self, email):
+        return {fila[0] for fila in self._con().execute(self.SQL_DE, (email,))}
+
+    def ocultar(self, email, username):
+        con = self._con()
+        with con:
+            con.execute(self.SQL_OCULTAR, (email, username.lower()))
+
+    def mostrar_todo(self, email):
+        con = self._con()
+        with con:
+            return con.execute(self.SQL_MOSTRAR_TODO, (email,)).rowcount > 0
+
+
+class CarritoSQLite:
+    SQL_CONTAR = "SELECT COUNT(DISTINCT email) FROM carritos"
+    SQL_DE = "SELECT item_id, cantidad FROM carritos WHERE email = ? ORDER BY seq"
+    SQL_CUANTOS = "SELECT COUNT(*) FROM carritos WHERE email = ?"
+    SQL_AGREGAR = ("INSERT OR IGNORE INTO carritos (email, item_id, cantidad) "
+                   "VALUES (?, ?, ?) RETURNING item_id")
+    SQL_CANTIDAD = "UPDATE carritos SET cantidad = ? WHERE email = ? AND item_id = ?"
+    SQL_QUITAR = "DELETE FROM carritos WHERE email = ? AND item_id = ?"
+    SQL_VACIAR = "DELETE FROM carritos WHERE email = ?"
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+
+    def __len__(self):
+        return self._con().execute(self.SQL_CONTAR).fetchone()[0]
+
+    def de(self, email):
+        return self._con().execute(self.SQL_DE, (email,)).fetchall()
+
+    def cuantos(self, email):
+        return self._con().execute(self.SQL_CUANTOS, (email,)).fetchone()[0]
+
+    def agregar(self, email, ids, cantidad=1):
+        # UNIQUE (email, item_id) descarta los repetidos; RETURNING sólo trae los nuevos
+        con = self._con()
+        with con:
+            return [fila[0] for item_id in dict.fromkeys(ids)
+                    for fila in con.execute(self.SQL_AGREGAR, (email, item_id, cantidad))]
+
+    def fijar_cantidad(self, email, item_id, cantidad):
+        con = self._con()
+        with con:
+            return con.execute(self.SQL_CANTIDAD, (cantidad, email, item_id)).rowcount > 0
+
+    def quitar(self, email, item_id):
+        con = self._con()
+        with con:
+            return con.execute(self.SQL_QUITAR, (email, item_id)).rowcount > 0
+
+    def vaciar(self, email):
+        con = self._con()
+        with con:
+            return con.execute(self.SQL_VACIAR, (email,)).rowcount > 0
+
+
+class DocumentoSQLite:
+    SQL_CONTAR = "SELECT COUNT(*) FROM documentos"
+    SQL_REFS = "SELECT refs FROM documentos WHERE sha256 = ?"
+    SQL_REFERENCIAR = ("INSERT INTO documentos (sha256, refs) VALUES (?, 1) "
+                       "ON CONFLICT(sha256) DO UPDATE SET refs = refs + 1 RETURNING refs")
+    SQL_LIBERAR = "UPDATE documentos SET refs = refs - 1 WHERE sha256 = ? RETURNING refs"
+    SQL_BORRAR = "DELETE FROM documentos WHERE sha256 = ? AND refs <= 0"
+
+    def __init__(self, conexiones):
+        self._con = conexiones
+
+    def __len__(self):
+        return self._con().execute(self.SQL_CONTAR).fetchone()[0]
+
+    def refs(self, sha256):
+        fila = self._con().execute(self.SQL_REFS, (sha256,)).fetchone()
+        return fila[0] if fila else 0
+
+    def referenciar(self, sha256):
+        con = self._con()
+        with con:
+            return con.execute(self.SQL_REFERENCIAR, (sha256,)).fetchone()[0]
+
+    def liberar(self, sha256):
+        con = self._con()
+        with con:
+            fila = con.execute(self.SQL_LIBERAR, (sha256,)).fetchone()
+            con.execute(self.SQL_BORRAR, (sha256,))
+        return max(fila[0], 0) if fila else 0
+
+
+def crear_almacenes(config):
+    """(USERS, PUBLICACIONES, MENSAJES, HIDDEN_COMPANIES, DOCUMENTOS, CARRITOS) según STORAGE_BACKEND."""
+    if config["STORAGE_BACKEND"] == "sqlite":
+        conexiones = ConexionesSQLite(config["STORAGE_DB"])
+        return (UsuarioSQLite(conexiones), PublicacionSQLite(conexiones),
+                MensajeSQLite(conexiones), OcultosSQLite(conexiones), DocumentoSQLite(conexiones),
+                CarritoSQLite(conexiones))
+    return (UsuarioStore(), PublicacionStore(), MensajeStore(), OcultosStore(), DocumentoStore(),
+            CarritoStore())
+
+
+# "memoria" (por defecto, y el usado en pruebas) o "sqlite"
+app.config["STORAGE_BACKEND"] = os.environ.get("WS_STORAGE",
+                                               "sqlite" if MODO_COMPARTIDO else "memoria")
+app.config["STORAGE_DB"] = os.environ.get("WS_DB", "windowshopping.sqlite3")
+USERS, PUBLICACIONES, MENSAJES, HIDDEN_COMPANIES, DOCUMENTOS, CARRITOS = crear_almacenes(app.config)
+
+def version_datos():
+    """
+    Versión de lo que alimenta los índices derivados (usuarios y publicaciones).
+    Mensajes y empresas ocultas no cuentan: lo oculto se filtra al consultar.
+    """
+    return (USERS.version, PUBLICACIONES.version)
+
+# ---------------------------------------------------------
+# 💾 DIARIO E INSTANTÁNEAS (persistencia del backend en memoria)
+# ---------------------------------------------------------
+# Con WS_DIARIO_DIR cada escritura de los almacenes en memoria se agrega a un
+# diario (`diario-NNNNNN.log`, entradas [largo, crc32] + pickle) con os.write;
+# un hilo hace fsync en lote cada WS_DIARIO_FSYNC_MS (0 = fsync en cada
+# escritura). Cada WS_INSTANTANEA_CADA segundos otro hilo rota el diario y
+# escribe una instantánea binaria (`instantanea.bin`, temporal + rename); los
+# segmentos anteriores se borran. Al arrancar se mapea la instantánea (los
+# mensajes quedan en el mmap y se decodifican al leerlos) y se reaplica sólo
+# la cola del diario. Con WS_STORAGE=sqlite no hace falta: la base ya persiste.
+DIARIO_DIR = os.environ.get("WS_DIARIO_DIR", "")
+DIARIO_FSYNC_MS = int(os.environ.get("WS_DIARIO_FSYNC_MS", 50))
+INSTANTANEA_CADA = int(os.environ.get("WS_INSTANTANEA_CADA", 300))
+# Además del intervalo: no dejar crecer la cola a reaplicar más allá de esto
+INSTANTANEA_ENTRADAS = int(os.environ.get("WS_INSTANTANEA_ENTRADAS", 200_000))
+
+_ENTRADA_DIARIO = struct.Struct("<II")
+_MAGIA_INSTANTANEA = b"WSSNAP01"
+_CABECERA_INSTANTANEA = struct.Struct("<QI")
+_SECCION_INSTANTANEA = struct.Struct("<16sQQI")
+_CABECERA_MENSAJES = struct.Struct("<QQQQ")
+_ALMACENES_ANOTADOS = (UsuarioStore, PublicacionStore, MensajeStore, OcultosStore, CarritoStore,
+                       DocumentoStore)
+
+
+class Diario:
+    """Segmentos de sólo agregar con fsync en lote; se rota al hacer cada instantánea."""
+
+    def __init__(self, directorio, fsync_ms=DIARIO_FSYNC_MS):
+        self.directorio = directorio
+        self.fsync_ms = fsync_ms
+        self.lock = threading.RLock()
+        self.entradas = 0
+        self.segmento = 0
+        self.resumen = {}
+        self._fd = None
+        self._sucio = False
+        self._cerrado = threading.Event()
+        os.makedirs(directorio, exist_ok=True)
+        # Un solo proceso por directorio: dos escribiendo el mismo diario lo corrompen
+        self._fd_lock = os.open(os.path.join(directorio, "LOCK"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._fd_lock)
+            raise RuntimeError(f"{directorio} ya está en uso por otro proceso "
+                               "(el diario es para un solo proceso; para varios workers usar WS_STORAGE=sqlite)")
+
+    def ruta(self, segmento):
+        return os.path.join(self.directorio, f"diario-{segmento:06d}.log")
+
+    def segmentos(self):
+        """Números de segmento presentes en el directorio, en orden."""
+        return sorted(int(nombre[7:13]) for nombre in os.listdir(self.directorio)
+                      if re.fullmatch(r"diario-\d{6}\.log", nombre))
+
+    @staticmethod
+    def leer(ruta):
+        """Entradas (almacen, metodo, args) del segmento; corta en la primera incompleta o dañada."""
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        pos = 0
+        while pos + _ENTRADA_DIARIO.size <= len(datos):
+            largo, crc = _ENTRADA_DIARIO.unpack_from(datos, pos)
+            cuerpo = datos[pos + _ENTRADA_DIARIO.size:pos + _ENTRADA_DIARIO.size + largo]
+            if len(cuerpo) < largo or zlib.crc32(cuerpo) != crc:
+                break  # cola rota por un corte a mitad de escritura
+            yield pickle.loads(cuerpo)
+            pos += _ENTRADA_DIARIO.size + largo
+
+    def abrir(self, segmento):
+        with self.lock:
+            anterior = self._fd
+            self._fd = os.open(self.ruta(segmento), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.segmento = segmento
+            self.entradas = 0
+            _fsync_directorio(self.directorio)
+        if anterior is not None:
+            os.fsync(anterior)
+            os.close(anterior)
+
+    def rotar(self):
+        """Abre el segmento siguiente; devuelve su número (la instantánea lo cubre hasta ahí)."""
+        with self.lock:
+            self.abrir(self.segmento + 1)
+            return self.segmento
+
+    def anotar(self, almacen, metodo, args):
+        cuerpo = pickle.dumps((almacen, metodo, args), protocol=pickle.HIGHEST_PROTOCOL)
+        os.write(self._fd, _ENTRADA_DIARIO.pack(len(cuerpo), zlib.crc32(cuerpo)) + cuerpo)
+        self.entradas += 1
+        if self.fsync_ms <= 0:
+            os.fsync(self._fd)
+        else:
+            self._sucio = True
+
+    def sincronizar(self):
+        """fsync de lo escrito hasta ahora (sobre un dup: la rotación puede cerrar el fd)."""
+        with self.lock:
+            if not self._sucio or self._fd is None:
+                return
+            self._sucio = False
+            fd = os.dup(self._fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _hilo_fsync(self):
+        while not self._cerrado.wait(self.fsync_ms / 1000):
+            self.sincronizar()
+
+    def iniciar(self):
+        if self.fsync_ms > 0:
+            threading.Thread(target=self._hilo_fsync, daemon=True, name="ws-diario").start()
+
+    def cerrar(self):
+        self._cerrado.set()
+        with self.lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+
+def _fsync_directorio(directorio):
+    fd = os.open(directorio, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _MensajesMapeados:
+    """
+    Mensajes de una instantánea sobre el mmap: offsets, bandejas y último envío
+    por par son arreglos (memoryview.cast) y cada mensaje se decodifica recién
+    al pedirlo.
+    """
+
+    def __init__(self, buf):
+        self.n, self.seq, largo, self.m = _CABECERA_MENSAJES.unpack_from(buf, 0)
+        pos = _CABECERA_MENSAJES.size
+        self.emails, rangos = pickle.loads(buf[pos:pos + largo])
+        self.posicion = {email: i for i, email in enumerate(self.emails)}
+        self.rangos = dict(zip(self.emails, rangos))
+        pos = _alinear(pos + largo)
+        self.offsets, pos = buf[pos:pos + 8 * (self.n + 1)].cast("Q"), pos + 8 * (self.n + 1)
+        # Pares (origen << 32 | destino, por posición en emails) ordenados, con su último ts
+        self.pares, pos = buf[pos:pos + 8 * self.m].cast("Q"), pos + 8 * self.m
+        self.ultimos, pos = buf[pos:pos + 8 * self.m].cast("q"), pos + 8 * self.m
+        self.entrada, pos = buf[pos:pos + 4 * self.n].cast("I"), pos + 4 * self.n
+        self.salida, pos = buf[pos:pos + 4 * self.n].cast("I"), pos + 4 * self.n
+        self.blobs = buf[_alinear(pos):]
+
+    def __len__(self):
+        return self.n
+
+    def registro(self, i):
+        return Mensaje.desde(pickle.loads(self.blobs[self.offsets[i]:self.offsets[i + 1]]))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return self.registro(i)
+
+    def __iter__(self):
+        return map(self.registro, range(self.n))
+
+    def bandeja(self, lado, email):
+        rango = self.rangos.get(email)
+        if rango is None:
+            return ()
+        inicio, fin = rango[0:2] if lado == "entrada" else rango[2:4]
+        return _BandejaMapeada(self, (self.entrada if lado == "entrada" else self.salida)[inicio:fin])
+
+    def ultimo_envio(self, origen, destino):
+        if origen not in self.posicion or destino not in self.posicion:
+            return None
+        clave = self.posicion[origen] << 32 | self.posicion[destino]
+        i = bisect_left(self.pares, clave)
+        return self.ultimos[i] if i < self.m and self.pares[i] == clave else None
+
+
+class _BandejaMapeada:
+    """Bandeja de un usuario dentro de la instantánea: índices a mensajes mapeados."""
+
+    def __init__(self, mensajes, indices):
+        self.mensajes, self.indices = mensajes, indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return self.mensajes.registro(self.indices[i])
+
+
+def _alinear(pos):
+    return (pos + 7) & ~7
+
+
+def _seccion_mensajes(base, nuevos, seq):
+    """Serializa mensajes (base mapeada + nuevos) en el formato de _MensajesMapeados."""
+    n_base = len(base) if base is not None else 0
+    n = n_base + len(nuevos)
+    emails = list(base.emails) if base is not None else []
+    posicion = {email: i for i, email in enumerate(emails)}
+    entrada, salida = [[] for _ in emails], [[] for _ in emails]
+    ultimos = dict(zip(base.pares.tolist(), base.ultimos.tolist())) if base is not None else {}
+    # Los mensajes de la base se copian en bloque, sin decodificarlos
+    blobs = [bytes(base.blobs[:base.offsets[n_base]])] if n_base else []
+    offsets = array("Q", [0])
+    if n_base:
+        offsets = array("Q")
+        offsets.frombytes(base.offsets.cast("B"))
+    fin = offsets[-1]
+    for j, msg in enumerate(nuevos, n_base):
+        for email in (msg.origen, msg.destino):
+            if email not in posicion:
+                posicion[email] = len(emails)
+                emails.append(email)
+                entrada.append([])
+                salida.append([])
+        entrada[posicion[msg.destino]].append(j)
+        salida[posicion[msg.origen]].append(j)
+        par = posicion[msg.origen] << 32 | posicion[msg.destino]
+        ultimos[par] = max(msg.ts, ultimos.get(par, msg.ts))
+        blob = pickle.dumps(msg.fila(), protocol=pickle.HIGHEST_PROTOCOL)
+        blobs.append(blob)
+        fin += len(blob)
+        offsets.append(fin)
+    arreglos = {"entrada": array("I"), "salida": array("I")}
+    rangos = []
+    for i, email in enumerate(emails):
+        rango = []
+        for lado, nuevos_lado in (("entrada", entrada[i]), ("salida", salida[i])):
+            destino = arreglos[lado]
+            rango.append(len(destino))
+            if base is not None and email in base.rangos:
+                inicio, fin_base = base.rangos[email][0:2] if lado == "entrada" else base.rangos[email][2:4]
+                mapeados = base.entrada if lado == "entrada" else base.salida
+                destino.frombytes(mapeados[inicio:fin_base].cast("B"))
+            destino.extend(nuevos_lado)
+            rango.append(len(destino))
+        rangos.append(tuple(rango))
+    pares = sorted(ultimos)
+    directorio = pickle.dumps((emails, rangos), protocol=pickle.HIGHEST_PROTOCOL)
+    largo = _CABECERA_MENSAJES.size + len(directorio)
+    partes = [_CABECERA_MENSAJES.pack(n, seq, len(directorio), len(pares)), directorio,
+              b"\0" * (_alinear(largo) - largo), offsets.tobytes(), array("Q", pares).tobytes(),
+              array("q", map(ultimos.__getitem__, pares)).tobytes(),
+              arreglos["entrada"].tobytes(), arreglos["salida"].tobytes()]
+    largo = _alinear(largo) + 8 * (n + 1) + 16 * len(pares) + 8 * n
+    partes.append(b"\0" * (_alinear(largo) - largo))
+    return b"".join(partes + blobs)
+
+
+def escribir_instantanea(diario):
+    """
+    Rota el diario y escribe la instantánea de los almacenes en memoria.
+    Bajo el lock del diario sólo se capturan los estados (los pequeños ya en
+    bytes); publicaciones (estado copy-on-write) y mensajes (listas que sólo
+    crecen) se serializan después sin frenar a los escritores.
+    """
+    inicio = time.perf_counter()
+    with diario.lock:
+        segmento = diario.rotar()
+        secciones = {nombre: pickle.dumps(almacen.instantanea(), protocol=pickle.HIGHEST_PROTOCOL)
+                     for nombre, almacen in (("usuarios", USERS), ("ocultos", HIDDEN_COMPANIES),
+                                             ("carritos", CARRITOS), ("documentos", DOCUMENTOS))}
+        publicaciones = PUBLICACIONES.instantanea()
+        mensajes = MENSAJES.instantanea()
+    secciones["publicaciones"] = pickle.dumps(list(publicaciones), protocol=pickle.HIGHEST_PROTOCOL)
+    secciones["mensajes"] = _seccion_mensajes(*mensajes)
+
+    ruta = os.path.join(diario.directorio, "instantanea.bin")
+    tabla = _CABECERA_INSTANTANEA.size + len(_MAGIA_INSTANTANEA) + _SECCION_INSTANTANEA.size * len(secciones)
+    pos, entradas = _alinear(tabla), []
+    for nombre, datos in secciones.items():
+        entradas.append(_SECCION_INSTANTANEA.pack(nombre.encode(), pos, len(datos), zlib.crc32(datos)))
+        pos = _alinear(pos + len(datos))
+    with tempfile.NamedTemporaryFile(dir=diario.directorio, prefix=".instantanea-", delete=False) as f:
+        f.write(_MAGIA_INSTANTANEA + _CABECERA_INSTANTANEA.pack(segmento, len(secciones)) + b"".join(entradas))
+        for datos in secciones.values():
+            f.write(b"\0" * (_alinear(f.tell()) - f.tell()))
+            f.write(datos)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, ruta)
+    _fsync_directorio(diario.directorio)
+    # La instantánea ya cubre todo lo anterior al segmento nuevo
+    for viejo in diario.segmentos():
+        if viejo < segmento:
+            os.remove(diario.ruta(viejo))
+    return {"segmento": segmento, "bytes": os.path.getsize(ruta),
+            "segundos": round(time.perf_counter() - inicio, 3)}
+
+
+def leer_instantanea(ruta):
+    """(segmento, {sección: memoryview}) sobre el archivo mapeado; None si no hay instantánea."""
+    try:
+        with open(ruta, "rb") as f:
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    buf = memoryview(mapa)
+    if bytes(buf[:len(_MAGIA_INSTANTANEA)]) != _MAGIA_INSTANTANEA:
+        raise RuntimeError(f"{ruta} no es una instantánea válida")
+    segmento, cuantas = _CABECERA_INSTANTANEA.unpack_from(buf, len(_MAGIA_INSTANTANEA))
+    secciones, pos = {}, len(_MAGIA_INSTANTANEA) + _CABECERA_INSTANTANEA.size
+    for _ in range(cuantas):
+        nombre, inicio, largo, crc = _SECCION_INSTANTANEA.unpack_from(buf, pos)
+        pos += _SECCION_INSTANTANEA.size
+        secciones[nombre.rstrip(b"\0").decode()] = (buf[inicio:inicio + largo], crc)
+    # Las secciones que se cargan enteras se verifican; los mensajes se leen a demanda
+    for nombre, (datos, crc) in secciones.items():
+        if nombre != "mensajes" and zlib.crc32(datos) != crc:
+            raise RuntimeError(f"{ruta}: sección {nombre} dañada")
+    return segmento, {nombre: datos for nombre, (datos, _) in secciones.items()}
+
+
+def restaurar_almacenes(diario):
+    """Carga la instantánea y reaplica la cola del diario; devuelve un resumen."""
+    inicio = time.perf_counter()
+    almacenes = {almacen.NOMBRE: almacen
+                 for almacen in (USERS, PUBLICACIONES, MENSAJES, HIDDEN_COMPANIES, CARRITOS, DOCUMENTOS)}
+    leida = leer_instantanea(os.path.join(diario.directorio, "instantanea.bin"))
+    segmento = 0
+    if leida is not None:
+        segmento, secciones = leida
+        for nombre, datos in secciones.items():
+            if nombre == "mensajes":
+                MENSAJES.restaurar(_MensajesMapeados(datos))
+            else:
+                almacenes[nombre].restaurar(pickle.loads(datos))
+    reaplicadas = 0
+    for numero in diario.segmentos():
+        if numero < segmento:
+            continue
+        for almacen, metodo, args in Diario.leer(diario.ruta(numero)):
+            # Sin pasar por @anotado: no se vuelve a escribir lo que se está leyendo
+            getattr(type(almacenes[almacen]), metodo).__wrapped__(almacenes[almacen], *args)
+            reaplicadas += 1
+    diario.abrir(max([segmento] + diario.segmentos()) + 1)
+    return {"instantanea": leida is not None, "reaplicadas": reaplicadas,
+            "segundos": round(time.perf_counter() - inicio, 3)}
+
+
+def _hilo_instantaneas(diario):
+    ultima = time.monotonic()
+    while not diario._cerrado.wait(1):
+        if diario.entradas and (time.monotonic() - ultima >= INSTANTANEA_CADA
+                                or diario.entradas >= INSTANTANEA_ENTRADAS):
+            try:
+                escribir_instantanea(diario)
+            except Exception:  # el diario sigue creciendo; se reintenta en la próxima vuelta
+                app.logger.exception("No se pudo escribir la instantánea")
+            ultima = time.monotonic()
+
+
+def activar_diario(directorio):
+    """Restaura los almacenes en memoria desde `directorio` y empieza a anotar sus escrituras."""
+    diario = Diario(directorio)
+    resumen = restaurar_almacenes(diario)
+    for clase in _ALMACENES_ANOTADOS:
+        clase.diario = diario
+    atexit.register(diario.cerrar)
+    diario.resumen = resumen
+    app.logger.info("Diario en %s: %s", directorio, resumen)
+    return diario
+
+
+def iniciar_hilos_diario(diario):
+    """fsync periódico e instantáneas en segundo plano (los arranca iniciar_hilos_de_fondo)."""
+    diario.iniciar()
+    threading.Thread(target=_hilo_instantaneas, args=(diario,), daemon=True,
+                     name="ws-instantaneas").start()
+
+
+def construir_al_arrancar(indice):
+    """
+    Índices derivados (búsqueda, precios): con datos restaurados del diario se
+    arman en segundo plano para no demorar el arranque; mientras tanto quien
+    los consulte espera a que terminen de armarse.
+    """
+    if DIARIO is None:
+        indice.reconstruir()
+    else:
+        threading.Thread(target=indice.reconstruir, daemon=True, name="ws-indices").start()
+
+
+DIARIO = None
+if DIARIO_DIR and app.config["STORAGE_BACKEND"] == "memoria":
+    DIARIO = activar_diario(DIARIO_DIR)
+
+# ---------------------------------------------------------
+# 📎 DOCUMENTOS SUBIDOS (direccionados por contenido)
+# ---------------------------------------------------------
+# Werkzeug escribe cada archivo del formulario directamente en un temporal junto
+# al almacén mientras calculamos su sha256; al aceptarlo sólo queda validar la
+# firma y renombrarlo a uploads/docs/ab/cd/<sha256>.<ext> (una copia por contenido).
+DOCS_DIR = os.path.join(UPLOAD_FOLDER, "docs")
+SUBIDAS_TMP = os.path.join(UPLOAD_FOLDER, ".tmp")
+os.makedirs(SUBIDAS_TMP, exist_ok=True)
+FIRMAS_DOCUMENTO = (
+    (b"%PDF-", ".pdf"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+)
+
+
+class SubidaHasheada:
+    """Temporal en disco que acumula sha256, tamaño y primeros bytes al escribirse."""
+    LARGO_CABECERA = 16
+
+    def __init__(self):
+        self._archivo = tempfile.NamedTemporaryFile(dir=SUBIDAS_TMP, prefix="subida-", delete=False)
+        self.ruta = self._archivo.name
+        self.hash = hashlib.sha256()
+        self.cabecera = b""
+        self.tamano = 0
+
+    def write(self, datos):
+        self.hash.update(datos)
+        self.tamano += len(datos)
+        if len(self.cabecera) < self.LARGO_CABECERA:
+            self.cabecera += bytes(datos[:self.LARGO_CABECERA - len(self.cabecera)])
+        return self._archivo.write(datos)
+
+    def __getattr__(self, nombre):
+        return getattr(self._archivo, nombre)
+
+    def descartar(self):
+        self._archivo.close()
+        try:
+            os.unlink(self.ruta)
+        except FileNotFoundError:
+            pass
+
+
+class PeticionWS(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        subida = SubidaHasheada()
+        g.setdefault("subidas", []).append(subida)
+        return subida
+
+app.request_class = PeticionWS
+
+@app.teardown_request
+def limpiar_subidas(exc):
+    # Los temporales aceptados ya se renombraron; el resto se borra aquí
+    for subida in g.pop("subidas", []):
+        subida.descartar()
+
+def guardar_documento(archivo):
+    """
+    Valida la firma (PDF/JPEG/PNG) del archivo subido y lo deja en el almacén
+    por contenido con una referencia más. Devuelve la ruta relativa a static/ o
+    None si no es un documento válido.
+    """
+    subida = archivo.stream
+    if not isinstance(subida, SubidaHasheada) or not subida.tamano:
+        return None
+    ext = next((e for firma, e in FIRMAS_DOCUMENTO if subida.cabecera.startswith(firma)), None)
+    if ext is None:
+        return None
+    sha = subida.hash.hexdigest()
+    relativa = os.path.join("docs", sha[:2], sha[2:4], sha + ext)
+    destino = os.path.join(UPLOAD_FOLDER, relativa)
+    DOCUMENTOS.referenciar(sha)
+    if not os.path.exists(destino):
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        subida.flush()
+        os.replace(subida.ruta, destino)
+    return "uploads/" + relativa.replace(os.sep, "/")
+
+def liberar_documento(ruta):
+    """Quita una referencia; el archivo se borra cuando ya nadie lo usa."""
+    sha = os.path.splitext(os.path.basename(ruta))[0]
+    if DOCUMENTOS.liberar(sha) == 0:
+        try:
+            os.unlink(os.path.join("static", ruta))
+        except FileNotFoundError:
+            pass
 
 # ---------------------------------------------------------
 # 🌍 TRADUCCIÓN / i18n
@@ -71,23 +2340,132 @@ TRANSLATIONS = {
     },
 }
 
-def t(text, en=None, zh=None):
-    """Traducción automática según idioma activo."""
-    lang = session.get("lang", "es")
+# ---------------------------------------------------------
+# 📚 CATÁLOGOS COMPILADOS POR IDIOMA
+# ---------------------------------------------------------
+# i18n/<lang>.json contiene las ternas t("es", "en", "zh") extraídas de app.py
+# y de las plantillas (`flask compilar-traducciones`); TRANSLATIONS se fusiona
+# por debajo. Cada idioma queda como una tabla plana texto -> traducción.
+I18N_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "i18n")
+TRADUCCIONES_FALTANTES = {lang: Counter() for lang in LANGS}
+TRADUCTORES = {}
+
+def _crear_traductor(lang, tabla):
+    """Función t() especializada para un idioma (sin leer la sesión)."""
     if lang == "es":
+        def traducir(text, en=None, zh=None):
+            return text
+        return traducir
+
+    buscar = tabla.get
+    faltantes = TRADUCCIONES_FALTANTES[lang]
+
+    def traducir(text, en=None, zh=None):
+        traducido = buscar(text)
+        if traducido is not None:
+            return traducido
+        # Textos dinámicos (f-strings) no están en el catálogo: usar la terna en línea
+        en_linea = en if lang == "en" else zh if lang == "zh" else None
+        if en_linea:
+            return en_linea
+        faltantes[text] += 1
         return text
-    if en or zh:
-        if lang == "en" and en:
-            return en
-        if lang == "zh" and zh:
-            return zh
-    if text in TRANSLATIONS:
-        return TRANSLATIONS[text].get(lang, text)
-    return text
+    return traducir
+
+def cargar_catalogos():
+    """(Re)carga i18n/<lang>.json + TRANSLATIONS y regenera los traductores."""
+    for lang in LANGS:
+        tabla = {}
+        if lang != "es":
+            tabla = {texto: trad[lang] for texto, trad in TRANSLATIONS.items() if trad.get(lang)}
+            ruta = os.path.join(I18N_DIR, f"{lang}.json")
+            if os.path.exists(ruta):
+                with open(ruta, encoding="utf-8") as f:
+                    tabla.update(json.load(f))
+        TRADUCTORES[lang] = _crear_traductor(lang, tabla)
+
+cargar_catalogos()
 
-# Permitir que todos los textos se traduzcan dentro de plantillas
-app.jinja_env.globals.update(t=t)
-app.jinja_env.filters['t'] = t
+@app.before_request
+def resolver_idioma():
+    """Resuelve el idioma una sola vez por petición."""
+    lang = session.get("lang", "es")
+    g.lang = lang if lang in TRADUCTORES else "es"
+    g.t = TRADUCTORES[g.lang]
+
+def t(text, en=None, zh=None):
+    """Traducción automática según idioma activo."""
+    traductor = g.get("t")
+    if traductor is None:
+        resolver_idioma()
+        traductor = g.t
+    return traductor(text, en, zh)
+
+@app.context_processor
+def inject_traductor():
+    # Las plantillas llaman directamente al traductor del idioma de la petición
+    return {"t": g.get("t") or t}
+
+@app.route("/status/traducciones")
+def status_traducciones():
+    """Textos sin traducción más solicitados por idioma."""
+    return jsonify({lang: dict(contador.most_common(50))
+                    for lang, contador in TRADUCCIONES_FALTANTES.items() if lang != "es"})
+
+@app.cli.command("compilar-traducciones")
+def compilar_traducciones():
+    """Extrae las ternas t("es", "en", "zh") de app.py y plantillas a i18n/<lang>.json."""
+    import ast
+    from jinja2 import nodes
+
+    ternas = []  # (texto, en, zh, origen)
+
+    def constante(nodo):
+        valor = getattr(nodo, "value", None)
+        es_const = isinstance(nodo, (ast.Constant, nodes.Const))
+        return valor if es_const and isinstance(valor, str) else None
+
+    with open(os.path.abspath(__file__), encoding="utf-8") as f:
+        arbol = ast.parse(f.read())
+    for nodo in ast.walk(arbol):
+        if isinstance(nodo, ast.Call) and isinstance(nodo.func, ast.Name) and nodo.func.id == "t":
+            args = [constante(a) for a in nodo.args] + [None, None]
+            if args[0]:
+                ternas.append((args[0], args[1], args[2], f"app.py:{nodo.lineno}"))
+
+    for nombre in app.jinja_env.list_templates(extensions=["html"]):
+        fuente = app.jinja_loader.get_source(app.jinja_env, nombre)[0]
+        arbol = app.jinja_env.parse(fuente)
+        for nodo in arbol.find_all(nodes.Call):
+            if isinstance(nodo.node, nodes.Name) and nodo.node.name == "t":
+                args = [constante(a) for a in nodo.args] + [None, None]
+                if args[0]:
+                    ternas.append((args[0], args[1], args[2], f"{nombre}:{nodo.lineno}"))
+        for nodo in arbol.find_all(nodes.Filter):
+            if nodo.name == "t" and constante(nodo.node):
+                ternas.append((nodo.node.value, None, None, f"{nombre}:{nodo.lineno}"))
+
+    catalogos = {lang: {} for lang in LANGS if lang != "es"}
+    origen_de = {}
+    for texto, en, zh, origen in ternas:
+        for lang, valor in (("en", en), ("zh", zh)):
+            if not valor:
+                continue
+            previo = catalogos[lang].setdefault(texto, valor)
+            origen_de.setdefault((lang, texto), origen)
+            if previo != valor:
+                click.echo(f"⚠️  {lang} {texto!r}: {origen} difiere de {origen_de[(lang, texto)]}")
+
+    os.makedirs(I18N_DIR, exist_ok=True)
+    for lang, tabla in catalogos.items():
+        with open(os.path.join(I18N_DIR, f"{lang}.json"), "w", encoding="utf-8") as f:
+            json.dump(tabla, f, ensure_ascii=False, indent=1, sort_keys=True)
+            f.write("\n")
+        click.echo(f"{lang}: {len(tabla)} textos")
+    sin_traducir = {texto for texto, en, zh, _ in ternas
+                    if not (en or zh) and texto not in TRANSLATIONS}
+    click.echo(f"{len(ternas)} llamadas a t(), {len(sin_traducir)} textos sin traducción")
+    cargar_catalogos()
 
 # ---------------------------------------------------------
 # 🌐 CONTROL DE IDIOMA
@@ -98,7 +2476,7 @@ def set_lang(lang):
     return redirect(request.referrer or url_for("home"))
 
 # 👥 USUARIOS FICTICIOS — alineados a TIPOS_ROLES y PERMISOS
-USERS = {
+USUARIOS_DEMO = {
     # ======================================================
     # 🔹 ADMINISTRACIÓN (pueden crear usuarios)
     # ======================================================
@@ -320,19 +2698,40 @@ USERS = {
     }
 }
 
+# Se siembran solo si el almacén está vacío (p.ej. primera vez con SQLite)
+if not len(USERS):
+    for _info in USUARIOS_DEMO.values():
+        USERS.guardar(_info)
+
 # ---------------------------------------------------------
 # 🏠 PÁGINA PRINCIPAL (INDEX)
 # ---------------------------------------------------------
-@app.route("/")
-def home():
+def _pagina_home():
     titulo = t("Bienvenido a Window Shopping")
     return render_template("index.html", titulo=titulo)
 
+@app.route("/")
+def home():
+    return servir_estatica("home") or _pagina_home()
+
 # ---------------------------------------------------------
 # 🧷 PERFIL (stub editable)
 # ---------------------------------------------------------
 def get_user():
-    return session.get("user")
+    """Registro del usuario logueado, cargado una sola vez por petición."""
+    if "user" not in g:
+        email = session.get("user_key")
+        g.user = USERS.get(email) if email else None
+        if email and g.user is None:
+            session.pop("user_key", None)
+            flash(t("Sesión expirada, por favor vuelva a iniciar sesión",
+                    "Session expired, please log in again",
+                    "会话已过期，请重新登录"), "error")
+    return g.user
+
+@app.context_processor
+def inject_usuario_actual():
+    return {"usuario_actual": get_user()}
 
 @app.route("/perfil", methods=["GET", "POST"])
 def perfil():
@@ -343,10 +2742,15 @@ def perfil():
         return redirect(url_for("login"))
 
     if request.method == "POST":
-        for campo in ["empresa", "pais", "direccion", "telefono", "descripcion"]:
-            if campo in request.form:
-                user[campo] = request.form.get(campo).strip()
-        session["user"] = user
+        # Copia con los cambios: el registro publicado no se toca
+        user = dict(user, **{campo: request.form.get(campo).strip()
+                             for campo in ["empresa", "pais", "direccion", "telefono", "descripcion"]
+                             if campo in request.form})
+        with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura(), DIRECTORIO.escritura():
+            user = USERS.guardar(user)
+            INDICE_BUSQUEDA.indexar_usuario(user)
+            INDICE_PRECIOS.indexar_usuario(user)
+            DIRECTORIO.actualizar(user)
         flash(t("Perfil actualizado correctamente",
                 "Profile updated successfully", "個人資料已更新"), "success")
         return redirect(url_for("perfil"))
@@ -416,7 +2820,8 @@ def login():
         elif user.get("password") != password:
             flash(t("Contraseña incorrecta", "Incorrect password", "密码错误"), "error")
         else:
-            session["user"] = user
+            session.regenerar()
+            session["user_key"] = email
             flash(t("Inicio de sesión exitoso", "Login successful", "登录成功"), "success")
             return redirect(url_for("dashboard_router"))
     return render_template("login.html", titulo=t("Iniciar sesión"))
@@ -426,7 +2831,7 @@ def login():
 # ---------------------------------------------------------
 @app.route("/logout")
 def logout():
-    session.pop("user", None)
+    session.pop("user_key", None)
     flash(t("Sesión cerrada correctamente", "Session closed", "已注销"), "success")
     return redirect(url_for("home"))
 
@@ -450,7 +2855,7 @@ def register_form(tipo):
 
     # 🔧 Solución: fijar tipo de cuenta en sesión de forma persistente
     session["register_tipo"] = tipo_norm
-    session.modified = True  # obliga a guardar en cookie
+    session.modified = True  # obliga a guardar la sesión
     
     tipos_ctx = {titulo_tipo(tipo_norm): TIPOS_ROLES[tipo_norm]}
     return render_template(
@@ -473,15 +2878,6 @@ def register():
     direccion = (request.form.get("direccion") or "").strip()
     telefono = (request.form.get("telefono") or "").strip()
 
-    # 📎 Nuevo: archivo de documento adjunto (RUT, USCI, etc.)
-    rut_doc_path = ""
-    if "rut_doc" in request.files:
-        file = request.files["rut_doc"]
-        if file and os.path.splitext(file.filename)[1].lower() in ALLOWED_DOC_EXTS:
-            filename = secure_filename(f"{uuid4().hex}_{file.filename}")
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-            rut_doc_path = f"uploads/{filename}"
-
     # 1️⃣ Validar email único
     if email in USERS:
         flash(t("El usuario ya existe", "User already exists", "用户已存在"), "error")
@@ -505,6 +2901,16 @@ def register():
                 "Foreign profile must be 'Foreign Client'", "海外用户的角色必须为“客户（海外）”"), "error")
         return redirect(url_for("register_form", tipo=tipo_norm))
 
+    # 📎 Documento adjunto (RUT, USCI, etc.): ya está en disco y hasheado
+    rut_doc_path = ""
+    archivo = request.files.get("rut_doc")
+    if archivo and archivo.filename:
+        rut_doc_path = guardar_documento(archivo)
+        if not rut_doc_path:
+            flash(t("El documento debe ser PDF, JPG o PNG",
+                    "The document must be a PDF, JPG or PNG file", "文件必须为 PDF、JPG 或 PNG"), "error")
+            return redirect(url_for("register_form", tipo=tipo_norm))
+
     # 5️⃣ Crear usuario
     new_user = {
         "nombre": empresa,
@@ -519,10 +2925,28 @@ def register():
         "pais": pais,
         "direccion": direccion,
         "telefono": telefono,
-        "rut_doc": "",
+        "rut_doc": rut_doc_path,
         "items": [],
     }
-    USERS[email] = new_user
+    try:
+        with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura(), DIRECTORIO.escritura():
+            # crear() y no guardar(): dos registros simultáneos del mismo email
+            # pasan ambos la validación de arriba, pero sólo uno queda
+            creado = USERS.crear(new_user)
+            if creado is not None:
+                INDICE_BUSQUEDA.indexar_usuario(creado)
+                INDICE_PRECIOS.indexar_usuario(creado)
+                DIRECTORIO.actualizar(creado)
+    except Exception:
+        if rut_doc_path:
+            liberar_documento(rut_doc_path)
+        raise
+    if creado is None:
+        if rut_doc_path:
+            liberar_documento(rut_doc_path)
+        flash(t("El usuario ya existe", "User already exists", "用户已存在"), "error")
+        return redirect(url_for("register_router"))
+    FRAGMENTOS.invalidar()
 
     session.pop("register_tipo", None)
     flash(t("Usuario registrado correctamente", "User registered successfully", "注册成功"), "success")
@@ -629,9 +3053,10 @@ def puede_publicar(usuario):
 
     return False
 
-def puede_ver_publicacion(usuario, publicacion):
+def _puede_ver_publicacion_reglas(usuario, publicacion):
     """
-    Reglas de visibilidad mejoradas:
+    Reglas de visibilidad mejoradas (implementación regla a regla; fuente de
+    verdad con la que se compila la matriz de `puede_ver_publicacion`):
     - Exportadores pueden ver DEMANDAS de clientes extranjeros.
     - Proveedores de servicios (Transporte, Aduana, Extraportuarios, etc.)
       pueden ver DEMANDAS DE SERVICIO cuando el 'servicio_objetivo' coincide con su rol.
@@ -682,6 +3107,127 @@ def puede_ver_publicacion(usuario, publicacion):
     # 🚫 En cualquier otro caso, denegar visibilidad
     return False
 
+# ---------------------------------------------------------
+# 🧮 MATRIZ DE VISIBILIDAD PRECOMPILADA
+# ---------------------------------------------------------
+# Las entradas de las reglas son un conjunto cerrado: (tipo, rol) del usuario ×
+# (tipo, rol, subtipo, categoria) de la publicación. Cualquier valor fuera del
+# vocabulario se comporta igual en todas las reglas, así que se colapsa en _OTRO.
+# Las celdas están en un solo dict con la clave plana de 6 textos internados.
+# Quien cambie PERMISOS o TIPOS_ROLES llama a recompilar_visibilidad(); la
+# versión de la matriz avisa a los derivados (DirectorioEmpresas).
+_OTRO = "\x00otro"
+_SEGUN_OBJETIVO = "objetivo"
+SUBTIPOS_PUBLICACION = ("oferta", "demanda")
+CATEGORIAS_PUBLICACION = ("venta", "compra", "servicio")
+_MATRIZ_VISIBILIDAD = {"version": 0}
+
+def _vocabulario_visibilidad():
+    tipos = set(TIPOS_ROLES) | set(PERMISOS)
+    roles = {"Administrador"}
+    for lista in TIPOS_ROLES.values():
+        roles.update(lista)
+    for por_rol in PERMISOS.values():
+        for rol, reglas in por_rol.items():
+            roles.add(rol)
+            for destinos in reglas.values():
+                roles.update(destinos)
+    return tipos, roles
+
+def _compilar_matriz_visibilidad():
+    """
+    Evalúa _puede_ver_publicacion_reglas para cada combinación del vocabulario.
+    Las celdas que dependen de 'servicio_objetivo' quedan como _SEGUN_OBJETIVO.
+    """
+    tipos, roles = _vocabulario_visibilidad()
+    tipos = {sys.intern(tipo) for tipo in tipos}
+    roles = {sys.intern(rol) for rol in roles}
+    tipos_x, roles_x = sorted(tipos) + [_OTRO], sorted(roles) + [_OTRO]
+    subtipos_x = [sys.intern(s) for s in SUBTIPOS_PUBLICACION] + [_OTRO]
+    categorias_x = [sys.intern(c) for c in CATEGORIAS_PUBLICACION] + [_OTRO]
+
+    celdas = {}
+    for tipo_u in tipos_x:
+        for rol_u in roles_x:
+            usuario = {"tipo": tipo_u, "rol": rol_u}
+            for tipo_pub in tipos_x:
+                for rol_pub in roles_x:
+                    for subtipo in subtipos_x:
+                        for categoria in categorias_x:
+                            pub = {"tipo": tipo_pub, "rol": rol_pub,
+                                   "subtipo": subtipo, "categoria": categoria}
+                            sin_objetivo = _puede_ver_publicacion_reglas(usuario, pub)
+                            con_objetivo = _puede_ver_publicacion_reglas(
+                                usuario, dict(pub, servicio_objetivo=rol_u))
+                            if sin_objetivo != con_objetivo:
+                                valor = _SEGUN_OBJETIVO
+                            else:
+                                valor = sin_objetivo
+                            celdas[(tipo_u, rol_u, tipo_pub, rol_pub, subtipo, categoria)] = valor
+
+    tipos, roles = frozenset(tipos), frozenset(roles)
+    _MATRIZ_VISIBILIDAD.update(
+        version=_MATRIZ_VISIBILIDAD["version"] + 1,
+        vocabulario=(tipos, roles, tipos, roles, frozenset(SUBTIPOS_PUBLICACION),
+                     frozenset(CATEGORIAS_PUBLICACION)),
+        celdas=celdas,
+        alias={},
+    )
+    return _MATRIZ_VISIBILIDAD
+
+def recompilar_visibilidad():
+    """Vuelve a compilar la matriz tras cambiar PERMISOS o TIPOS_ROLES en caliente."""
+    _compilar_matriz_visibilidad()
+
+_CLAVE_USUARIO = itemgetter("tipo", "rol")
+_CLAVE_PUBLICACION = itemgetter("tipo", "rol", "subtipo", "categoria")
+_CLAVE_REGISTRO = attrgetter("tipo", "rol", "subtipo", "categoria")  # Publicacion: sin __getitem__
+
+_MAX_ALIAS_VISIBILIDAD = 4096
+
+def _clave_normalizada(clave, vocabularios, alias):
+    """Colapsa valores fuera de vocabulario en _OTRO (memoizado y acotado)."""
+    normal = alias.get(clave)
+    if normal is None:
+        normal = tuple(v if v in vocab else _OTRO for v, vocab in zip(clave, vocabularios))
+        if len(alias) < _MAX_ALIAS_VISIBILIDAD:
+            alias[clave] = normal
+    return normal
+
+def puede_ver_publicacion(usuario, publicacion):
+    """
+    Misma semántica que _puede_ver_publicacion_reglas, resuelta con una
+    búsqueda en la matriz precompilada (ver tests/test_visibilidad.py).
+    """
+    if not usuario:
+        return False
+    if type(publicacion) is Publicacion:  # siempre verdadera; len() del Mapping es lento
+        clave_p = _CLAVE_REGISTRO(publicacion)
+    elif not publicacion:
+        return False
+    else:
+        try:
+            clave_p = _CLAVE_PUBLICACION(publicacion)
+        except KeyError:
+            clave_p = (publicacion.get("tipo", ""), publicacion.get("rol", ""),
+                       publicacion.get("subtipo", ""), publicacion.get("categoria", ""))
+    try:
+        clave_u = _CLAVE_USUARIO(usuario)
+    except KeyError:
+        clave_u = (usuario.get("tipo", ""), usuario.get("rol", ""))
+    clave = clave_u + clave_p
+    m = _MATRIZ_VISIBILIDAD
+    valor = m["celdas"].get(clave)
+    if valor is None:
+        valor = m["celdas"][_clave_normalizada(clave, m["vocabulario"], m["alias"])]
+
+    if valor is _SEGUN_OBJETIVO:
+        objetivo = publicacion.get("servicio_objetivo")
+        return bool(objetivo) and objetivo.strip().lower() == (clave_u[1] or "").strip().lower()
+    return valor
+
+_compilar_matriz_visibilidad()
+
 def puede_mostrar_dashboard(usuario):
     """Determina qué dashboard mostrar según el tipo y rol."""
     if not usuario:
@@ -703,25 +3249,6 @@ def puede_mostrar_dashboard(usuario):
     else:
         return "dashboard"
 
-# ---------------------------------------------------------
-# 🔄 MIDDLEWARE: Verificación de sesión válida
-# ---------------------------------------------------------
-@app.before_request
-def check_session_integrity():
-    """Verifica que el usuario logueado siga existiendo en USERS."""
-    user = session.get("user")
-    if user:
-        email = user.get("email")
-        if email not in USERS:
-            session.pop("user", None)
-            flash(
-                t("Sesión expirada, por favor vuelva a iniciar sesión",
-                  "Session expired, please log in again",
-                  "会话已过期，请重新登录"),
-                "error"
-            )
-            return redirect(url_for("login"))
-
 # ⚙️ Debe ir justo antes de esta línea:
 # def _publicaciones_visibles_para(user):
 
@@ -766,46 +3293,191 @@ def dashboard_admin():
 # =========================================================
 # 📦 Lógica de visibilidad de publicaciones por tipo de usuario
 # =========================================================
-def _publicaciones_visibles_para(user):
-    """Filtra las publicaciones visibles según tipo y permisos del usuario."""
-    tipo = user.get("tipo")
-    rol = user.get("rol")
-    visibles = []
+def _criterios_visibilidad(tipo, rol):
+    """
+    Traduce la cadena de reglas por tipo/rol a cláusulas OR sobre los índices
+    de PUBLICACIONES (lista vacía = no ve nada, [{}] = ve todo).
+    """
+    # --- Productor ---
+    if rol == "Productor" and tipo in ["compraventa"]:
+        return [{"categoria": "servicio"}, {"categoria": "compra"}]
 
-    for p in PUBLICACIONES:
-        autor_tipo = p.get("tipo")
-        autor_rol = p.get("rol")
+    # --- Exportador ---
+    if rol == "Exportador":
+        return [{"categoria": "venta"}, {"categoria": "servicio"}, {"categoria": "compra"}]
 
-        # --- Productor ---
-        if rol == "Productor" and tipo in ["compraventa"]:
-            if p["categoria"] in ["servicio", "compra"]:
-                visibles.append(p)
+    # --- Packing / Frigorífico ---
+    if rol in ["Packing", "Frigorífico"]:
+        return [{"categoria": "servicio"}, {"categoria": "venta"}, {"categoria": "compra"}]
 
-        # --- Exportador ---
-        elif rol == "Exportador":
-            if p["categoria"] in ["venta", "servicio", "compra"]:
-                visibles.append(p)
+    # --- Mixto ---
+    if tipo == "mixto":
+        return [{}]
 
-        # --- Packing / Frigorífico ---
-        elif rol in ["Packing", "Frigorífico"]:
-            if p["categoria"] in ["servicio", "venta", "compra"]:
-                visibles.append(p)
+    # --- Servicio (transporte, aduana, etc.) ---
+    if tipo == "servicio":
+        return [{"categoria": "servicio"}]
 
-        # --- Mixto ---
-        elif tipo == "mixto":
-            visibles.append(p)
+    # --- Cliente extranjero: sólo ve exportadores con venta ---
+    if tipo == "extranjero":
+        return [{"rol": "Exportador", "categoria": "venta"}]
 
-        # --- Servicio (transporte, aduana, etc.) ---
-        elif tipo == "servicio":
-            if p["categoria"] == "servicio":
-                visibles.append(p)
+    return []
 
-        # --- Cliente extranjero: sólo ve exportadores con venta ---
-        elif tipo == "extranjero":
-            if autor_rol == "Exportador" and p["categoria"] == "venta":
-                visibles.append(p)
+def _clausulas_visibles_para(user, **extra):
+    """Cláusulas de visibilidad del usuario con `extra` añadido (AND) a cada una."""
+    # Cláusulas contradictorias (p.ej. categoria venta AND servicio) no aportan nada
+    return [dict(c, **extra)
+            for c in _criterios_visibilidad(user.get("tipo"), user.get("rol"))
+            if all(c.get(k, v) == v for k, v in extra.items())]
 
-    return visibles
+def _publicaciones_visibles_para(user, **extra):
+    """
+    Publicaciones visibles según tipo y permisos del usuario, resueltas por
+    intersección de índices. `extra` añade condiciones (AND) a cada cláusula.
+    """
+    clausulas = _clausulas_visibles_para(user, **extra)
+    return PUBLICACIONES.buscar(*clausulas) if clausulas else []
+
+# ---------------------------------------------------------
+# 📄 PAGINACIÓN POR CURSOR
+# ---------------------------------------------------------
+# Tamaño de página por defecto (WS_TAMANO_PAGINA); ?n= lo ajusta hasta el máximo.
+app.config["TAMANO_PAGINA"] = int(os.environ.get("WS_TAMANO_PAGINA", 24))
+TAMANO_PAGINA_MAX = 100
+
+def tamano_pagina():
+    n = request.args.get("n", type=int) or app.config["TAMANO_PAGINA"]
+    return max(1, min(n, TAMANO_PAGINA_MAX))
+
+def cursor_a_texto(valor):
+    """Cursor opaco para la URL (JSON en base64 urlsafe)."""
+    if valor is None:
+        return None
+    crudo = json.dumps(valor, ensure_ascii=False, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(crudo).decode().rstrip("=")
+
+def cursor_de_texto(texto):
+    """Inverso de cursor_a_texto; None si falta o no es válido."""
+    if not texto:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4)))
+    except ValueError:
+        return None
+
+def _pagina_publicaciones_para(user, **extra):
+    """Página (más recientes primero) de publicaciones visibles según ?antes=, ?desde= (epoch) y ?n=."""
+    clausulas = _clausulas_visibles_para(user, **extra)
+    if not clausulas:
+        return [], None
+    return PUBLICACIONES.pagina(*clausulas,
+                                antes=request.args.get("antes", type=int),
+                                desde=request.args.get("desde", type=int),
+                                limite=tamano_pagina())
+
+# ---------------------------------------------------------
+# 🧊 CACHÉ DE FRAGMENTOS RENDERIZADOS
+# ---------------------------------------------------------
+class CacheFragmentos:
+    """
+    HTML renderizado por clave, etiquetado con la versión de datos con la que se
+    generó. LRU con tope en bytes; un solo render por clave a la vez (los demás
+    esperan o, si hay una versión vieja reciente, la reciben mientras tanto).
+    """
+    ESPERA_MAX = 10  # segundos esperando el render de otro hilo
+
+    def __init__(self, max_bytes, max_obsoleto):
+        self.max_bytes = max_bytes
+        self.max_obsoleto = max_obsoleto  # segundos sirviendo la versión anterior
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # clave -> [version, html, obsoleto_desde]
+        self._bytes = 0
+        self._en_vuelo = {}
+        self.aciertos = self.fallos = self.obsoletos = 0
+
+    def __len__(self):
+        return len(self._datos)
+
+    def obtener(self, clave, version, renderizar):
+        while True:
+            with self._lock:
+                entrada = self._datos.get(clave)
+                if entrada is not None:
+                    self._datos.move_to_end(clave)
+                    if entrada[0] == version:
+                        self.aciertos += 1
+                        return entrada[1]
+                    entrada[2] = entrada[2] or time.monotonic()
+                vuelo = self._en_vuelo.get(clave)
+                if vuelo is None:
+                    vuelo = self._en_vuelo[clave] = threading.Event()
+                    self.fallos += 1
+                    break
+                if entrada is not None and time.monotonic() - entrada[2] <= self.max_obsoleto:
+                    self.obsoletos += 1
+                    return entrada[1]
+            if not vuelo.wait(self.ESPERA_MAX):
+                return renderizar()
+
+        try:
+            html = renderizar()
+            self._guardar(clave, version, html)
+            return html
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+            vuelo.set()
+
+    def _guardar(self, clave, version, html):
+        tamano = len(html)
+        if tamano > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._datos.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= len(anterior[1])
+            self._datos[clave] = [version, html, None]
+            self._bytes += tamano
+            while self._bytes > self.max_bytes:
+                _, (_, viejo, _) = self._datos.popitem(last=False)
+                self._bytes -= len(viejo)
+
+    def invalidar(self):
+        """Descarta todo (tras escrituras en este worker: sin servir versiones viejas)."""
+        with self._lock:
+            self._datos.clear()
+            self._bytes = 0
+
+
+app.config["FRAGMENTOS_MAX_BYTES"] = int(os.environ.get("WS_FRAGMENTOS_MB", 16)) * 1024 * 1024
+app.config["FRAGMENTOS_MAX_OBSOLETO"] = float(os.environ.get("WS_FRAGMENTOS_OBSOLETO", 5))
+FRAGMENTOS = CacheFragmentos(app.config["FRAGMENTOS_MAX_BYTES"], app.config["FRAGMENTOS_MAX_OBSOLETO"])
+
+def _render_dashboard(plantilla, user, titulo, **extra):
+    """
+    El listado de publicaciones sólo depende de (vista, tipo, rol, idioma, página,
+    desde), así que se comparte entre usuarios; la versión de PUBLICACIONES lo invalida.
+    """
+    antes = request.args.get("antes", type=int)
+    desde = request.args.get("desde", type=int)
+    n = request.args.get("n", type=int)
+
+    def renderizar():
+        pubs, siguiente = _pagina_publicaciones_para(user, **extra)
+        return render_template("_publicaciones.html",
+                               publicaciones=pubs,
+                               siguiente=siguiente,
+                               antes=antes,
+                               desde=desde,
+                               n=n)
+
+    clave = (request.endpoint, user.get("tipo"), user.get("rol"), g.lang, antes, desde, n)
+    listado = FRAGMENTOS.obtener(clave, PUBLICACIONES.version, renderizar)
+    return render_template(plantilla,
+                           user=user,
+                           listado_publicaciones=Markup(listado),
+                           titulo=titulo)
 
 # ---------------------------------------------------------
 # 📊 DASHBOARDS POR PERFIL (corregidos)
@@ -815,11 +3487,7 @@ def dashboard_compra():
     user = get_user()
     if not user:
         return redirect(url_for("login"))
-    pubs = _publicaciones_visibles_para(user)
-    return render_template("dashboard_compra.html",
-                           user=user,
-                           publicaciones=pubs,
-                           titulo=t("Panel de Compraventa"))
+    return _render_dashboard("dashboard_compra.html", user, t("Panel de Compraventa"))
 
 @app.route("/dashboard_servicio")
 def dashboard_servicio():
@@ -827,11 +3495,7 @@ def dashboard_servicio():
     if not user:
         return redirect(url_for("login"))
     # ✅ Mostrar solo publicaciones de categoría servicio
-    pubs = [p for p in _publicaciones_visibles_para(user) if p.get("categoria") == "servicio"]
-    return render_template("dashboard_servicio.html",
-                           user=user,
-                           publicaciones=pubs,
-                           titulo=t("Panel de Servicios"))
+    return _render_dashboard("dashboard_servicio.html", user, t("Panel de Servicios"), categoria="servicio")
 
 @app.route("/dashboard_mixto")
 def dashboard_mixto():
@@ -839,11 +3503,7 @@ def dashboard_mixto():
     if not user:
         return redirect(url_for("login"))
     # ✅ Mixto ve todas las publicaciones (por rol combinado)
-    pubs = _publicaciones_visibles_para(user)
-    return render_template("dashboard_mixto.html",
-                           user=user,
-                           publicaciones=pubs,
-                           titulo=t("Panel Mixto"))
+    return _render_dashboard("dashboard_mixto.html", user, t("Panel Mixto"))
 
 @app.route("/dashboard_extranjero")
 def dashboard_extranjero():
@@ -851,16 +3511,88 @@ def dashboard_extranjero():
     if not user:
         return redirect(url_for("login"))
     # ✅ Extranjero solo ve exportadores con venta
-    pubs = [p for p in _publicaciones_visibles_para(user)
-            if p.get("rol") == "Exportador" and p.get("categoria") == "venta"]
-    return render_template("dashboard_ext.html",
-                           user=user,
-                           publicaciones=pubs,
-                           titulo=t("Panel Cliente Extranjero"))
+    return _render_dashboard("dashboard_ext.html", user, t("Panel Cliente Extranjero"), rol="Exportador", categoria="venta")
 
 # ---------------------------------------------------------
 # 📰 PUBLICACIONES (crear / eliminar)
 # ---------------------------------------------------------
+def opciones_publicacion(tipo_usuario):
+    """(subtipos, categorías) que el tipo de usuario puede publicar."""
+    if tipo_usuario == "extranjero":
+        return ["demanda"], ["compra"]
+    if tipo_usuario in ["compraventa", "mixto"]:
+        return ["oferta", "demanda"], ["venta", "compra", "servicio"]
+    return ["oferta"], ["venta", "servicio"]
+
+ERRORES_PUBLICACION = {
+    "sin_permiso": ("No tienes permisos para publicar.",
+                    "You do not have permission to publish.", "無權限發布"),
+    "incompleta": ("Completa todos los campos requeridos",
+                   "Complete all required fields", "請填寫所有必填欄位"),
+    "subtipo": ("Subtipo no permitido para tu tipo de cuenta",
+                "Subtype not allowed for your account type", "您的帳戶類型不允許此子類型"),
+    "categoria": ("Categoría no permitida para tu tipo de cuenta",
+                  "Category not allowed for your account type", "您的帳戶類型不允許此類別"),
+    "vence": ("La fecha de vencimiento no es válida o ya pasó",
+              "The expiry date is invalid or already past", "到期日期無效或已過"),
+}
+
+def leer_vence(texto, ahora):
+    """
+    Epoch de vencimiento desde un texto: fecha AAAA-MM-DD (vence al terminar ese
+    día, hora local) o epoch en segundos. None si viene vacío; ValueError si no
+    se entiende o no es futuro.
+    """
+    texto = (texto or "").strip()
+    if not texto:
+        return None
+    if texto.isdigit():
+        vence = int(texto)
+    else:
+        dia = time.strptime(texto, "%Y-%m-%d")
+        vence = int(time.mktime((dia.tm_year, dia.tm_mon, dia.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+    if vence <= ahora:
+        raise ValueError(texto)
+    return vence
+
+def construir_publicacion(user, datos):
+    """
+    Valida `datos` (subtipo, categoria, producto, descripcion, precio,
+    servicio_objetivo, vence opcional) con las reglas de /publicar. Devuelve
+    (publicación, None) o (None, clave de ERRORES_PUBLICACION).
+    """
+    if not puede_publicar(user):
+        return None, "sin_permiso"
+    producto, descripcion = datos.get("producto"), datos.get("descripcion")
+    if not producto or not descripcion:
+        return None, "incompleta"
+    subtipos, categorias = opciones_publicacion(user.get("tipo", ""))
+    if datos.get("subtipo") not in subtipos:
+        return None, "subtipo"
+    if datos.get("categoria") not in categorias:
+        return None, "categoria"
+    ahora = int(time.time())
+    try:
+        vence = leer_vence(datos.get("vence"), ahora)
+    except ValueError:
+        return None, "vence"
+    return {
+        "id": f"pub_{uuid4().hex[:8]}",
+        "usuario": user["email"],
+        "empresa": user.get("empresa"),
+        "rol": user.get("rol"),
+        "tipo": user.get("tipo"),
+        "subtipo": datos["subtipo"],
+        "categoria": datos["categoria"],
+        "producto": producto,
+        "descripcion": descripcion,
+        "precio": datos.get("precio") or "Consultar",
+        **campos_precio(datos.get("precio")),
+        "servicio_objetivo": datos.get("servicio_objetivo"),
+        "ts": ahora,
+        "vence": vence,
+    }, None
+
 @app.route("/publicar", methods=["GET", "POST"])
 def publicar():
     user = get_user()
@@ -877,45 +3609,30 @@ def publicar():
         return redirect(url_for("dashboard_router"))
 
     # 🧩 Configuración dinámica según tipo de usuario
-    tipo_usuario = user.get("tipo", "")
-    if tipo_usuario == "extranjero":
-        subtipo_permitidos = ["demanda"]
-        tipos_publicacion = ["compra"]
-    elif tipo_usuario in ["compraventa", "mixto"]:
-        subtipo_permitidos = ["oferta", "demanda"]
-        tipos_publicacion = ["venta", "compra", "servicio"]
-    else:
-        subtipo_permitidos = ["oferta"]
-        tipos_publicacion = ["venta", "servicio"]
+    subtipo_permitidos, tipos_publicacion = opciones_publicacion(user.get("tipo", ""))
 
     if request.method == "POST":
-        subtipo = request.form.get("subtipo")
-        tipo_publicacion = request.form.get("tipo_publicacion")
-        producto = request.form.get("producto")
-        descripcion = request.form.get("descripcion")
-        precio = request.form.get("precio") or "Consultar"
-        servicio_objetivo = request.form.get("servicio_objetivo")
-
-        if not producto or not descripcion:
-            flash(t("Completa todos los campos requeridos",
-                    "Complete all required fields", "請填寫所有必填欄位"), "error")
+        nueva_pub, error = construir_publicacion(user, {
+            "subtipo": request.form.get("subtipo"),
+            "categoria": request.form.get("tipo_publicacion"),
+            "producto": request.form.get("producto"),
+            "descripcion": request.form.get("descripcion"),
+            "precio": request.form.get("precio"),
+            "servicio_objetivo": request.form.get("servicio_objetivo"),
+            "vence": request.form.get("vence"),
+        })
+        if error:
+            flash(t(*ERRORES_PUBLICACION[error]), "error")
             return redirect(url_for("publicar"))
 
-        nueva_pub = {
-            "id": f"pub_{uuid4().hex[:8]}",
-            "usuario": user["email"],
-            "empresa": user.get("empresa"),
-            "rol": user.get("rol"),
-            "tipo": user.get("tipo"),
-            "subtipo": subtipo,
-            "categoria": tipo_publicacion,
-            "producto": producto,
-            "descripcion": descripcion,
-            "precio": precio,
-            "servicio_objetivo": servicio_objetivo,
-            "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
-        }
-        PUBLICACIONES.append(nueva_pub)
+        with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura():
+            nueva_pub = PUBLICACIONES.agregar(nueva_pub)
+            INDICE_BUSQUEDA.indexar_publicacion(nueva_pub)
+            INDICE_PRECIOS.indexar_publicacion(nueva_pub)
+        FRAGMENTOS.invalidar()
+        if nueva_pub.vence is not None:
+            BARREDOR.avisar()
+        publicar_evento("publicacion", dict(nueva_pub, username=user.get("username", "")))
         flash(t("Publicación creada correctamente",
                 "Post created successfully", "發布成功"), "success")
         return redirect(url_for("dashboard_router"))
@@ -934,11 +3651,9 @@ def eliminar_publicacion(pub_id):
     if not user:
         return redirect(url_for("login"))
 
-    antes = len(PUBLICACIONES)
-    PUBLICACIONES[:] = [
-        p for p in PUBLICACIONES if not (p["id"] == pub_id and p["usuario"] == user["email"])
-    ]
-    if len(PUBLICACIONES) < antes:
+    pub = PUBLICACIONES.get(pub_id)
+    if pub and pub["usuario"] == user["email"]:
+        retirar_publicacion(pub_id)
         flash(t("Publicación eliminada", "Post deleted", "發布已刪除"), "success")
     else:
         flash(t("No encontrada o sin permiso", "Not found or unauthorized", "未找到或無權限"), "warning")
@@ -947,13 +3662,97 @@ def eliminar_publicacion(pub_id):
 # ---------------------------------------------------------
 # 🛒 CARRITO DE COMPRAS
 # ---------------------------------------------------------
+# El carrito vive en CARRITOS por email (no en la sesión): sólo ids y cantidades,
+# así no crece la sesión, no se duplican ítems y los precios siempre son los
+# vigentes. Se quita por id, no por posición, para que dos pestañas no se pisen.
+app.config["CARRITO_MAX_ITEMS"] = int(os.environ.get("WS_CARRITO_MAX_ITEMS", 200))
+app.config["CARRITO_MAX_CANTIDAD"] = 9999
+
+ERRORES_CARRITO = {
+    "formato": ("Formato inválido", "Invalid format", "格式無效"),
+    "empresa": ("Empresa no encontrada", "Company not found", "找不到公司"),
+    "item": ("Ítem no disponible", "Item not available", "項目不可用"),
+    "no_encontrada": ("Publicación no encontrada", "Item not found", "找不到項目"),
+    "sin_permiso": ("No tienes permiso para comprar este ítem",
+                    "You are not allowed to buy this item", "無權購買此項目"),
+    "propio": ("No puedes agregar tus propios ítems al carrito",
+               "You cannot add your own items to the cart", "不能將自己的項目加入購物車"),
+}
+
+def entrada_carrito(pub_id):
+    """(publicación o ítem de catálogo, None) o (None, clave de ERRORES_CARRITO)."""
+    pub = PUBLICACIONES.get(pub_id) or USERS.item_catalogo(pub_id)
+
+    # 🔁 Compatibilidad con enlaces antiguos direct-<username>-<n>
+    if not pub and pub_id.startswith("direct-"):
+        try:
+            _, uname, idx_str = pub_id.split("-", 2)
+            idx = int(idx_str) - 1
+        except ValueError:
+            return None, "formato"
+
+        c = USERS.por_username(uname)
+        if not c:
+            return None, "empresa"
+
+        items = c.get("items") or []
+        if not (0 <= idx < len(items)):
+            return None, "item"
+        pub = USERS.item_catalogo(items[idx].get("id"))
+
+    return (pub, None) if pub else (None, "no_encontrada")
+
+def agregar_al_carrito(user, ids, cantidad=1):
+    """
+    Valida y agrega ids al carrito del usuario.
+    Devuelve (agregados, repetidos, rechazados) con rechazados = [(id, clave)].
+    """
+    validos, rechazados = [], []
+    for pub_id in dict.fromkeys(ids):
+        pub, error = entrada_carrito(pub_id)
+        if pub and pub.get("usuario") == user["email"]:
+            pub, error = None, "propio"
+        elif pub and not puede_ver_publicacion(user, {"rol": pub["rol"], "tipo": pub["tipo"]}):
+            pub, error = None, "sin_permiso"
+        if pub:
+            validos.append(pub["id"])
+        else:
+            rechazados.append((pub_id, error))
+
+    libres = app.config["CARRITO_MAX_ITEMS"] - CARRITOS.cuantos(user["email"])
+    validos = list(dict.fromkeys(validos))
+    if len(validos) > libres:
+        rechazados += [(i, "lleno") for i in validos[max(libres, 0):]]
+        validos = validos[:max(libres, 0)]
+    agregados = CARRITOS.agregar(user["email"], validos, cantidad)
+    nuevos = set(agregados)
+    return agregados, [i for i in validos if i not in nuevos], rechazados
+
+def contenido_carrito(email):
+    """Entradas del carrito resueltas ahora (precio vigente) con su cantidad."""
+    cart = []
+    for item_id, cantidad in CARRITOS.de(email):
+        pub = PUBLICACIONES.get(item_id) or USERS.item_catalogo(item_id)
+        if pub:
+            cart.append(dict(pub, cantidad=cantidad, disponible=True))
+        else:
+            cart.append({"id": item_id, "cantidad": cantidad, "disponible": False})
+    return cart
+
+def _cantidad(valor):
+    """Cantidad pedida acotada a [1, CARRITO_MAX_CANTIDAD]; 1 si no es un entero."""
+    try:
+        return min(max(int(valor), 1), app.config["CARRITO_MAX_CANTIDAD"])
+    except (TypeError, ValueError):
+        return 1
+
 @app.route("/carrito")
 def carrito():
     user = get_user()
     if not user:
         return redirect(url_for("login"))
-    carrito = user.setdefault("carrito", [])
-    return render_template("carrito.html", user=user, cart=carrito, titulo=t("Carrito de Compras"))
+    return render_template("carrito.html", user=user, cart=contenido_carrito(user["email"]),
+                           titulo=t("Carrito de Compras"))
 
 @app.route("/carrito/agregar/<pub_id>")
 def carrito_agregar(pub_id):
@@ -961,72 +3760,82 @@ def carrito_agregar(pub_id):
     if not user:
         return redirect(url_for("login"))
 
-    pub = next((p for p in PUBLICACIONES if p["id"] == pub_id), None)
+    agregados, repetidos, rechazados = agregar_al_carrito(
+        user, [pub_id], _cantidad(request.args.get("cantidad")))
+    if rechazados:
+        error = rechazados[0][1]
+        if error == "lleno":
+            flash(t("El carrito está lleno", "The cart is full", "購物車已滿"), "warning")
+            return redirect(url_for("carrito"))
+        flash(t(*ERRORES_CARRITO[error]), "error")
+        return redirect(url_for("carrito" if error in ("formato", "empresa", "item")
+                                else "dashboard_router"))
+    if repetidos:
+        flash(t("El ítem ya está en el carrito", "Item already in cart", "項目已在購物車中"), "warning")
+    else:
+        flash(t("Agregado al carrito", "Added to cart", "已加入購物車"), "success")
+    return redirect(url_for("carrito"))
 
-    if not pub:
-        if pub_id.startswith("direct-"):
-            try:
-                _, uname, idx_str = pub_id.split("-", 2)
-                idx = int(idx_str) - 1
-            except Exception:
-                flash(t("Formato inválido", "Invalid format", "格式無效"), "error")
-                return redirect(url_for("carrito"))
-
-            email_map = {u["username"]: e for e, u in USERS.items()}
-            email = email_map.get(uname)
-            if not email or email not in USERS:
-                flash(t("Empresa no encontrada", "Company not found", "找不到公司"), "error")
-                return redirect(url_for("carrito"))
-
-            c = USERS[email]
-            if not c.get("items") or not (0 <= idx < len(c["items"])):
-                flash(t("Ítem no disponible", "Item not available", "項目不可用"), "error")
-                return redirect(url_for("carrito"))
-
-            item = c["items"][idx]
-            pub = {
-                "id": pub_id,
-                "usuario": email,
-                "empresa": c.get("empresa"),
-                "rol": c.get("rol"),
-                "tipo": "oferta" if c.get("tipo") in ("compraventa", "mixto") else "servicio",
-                "producto": item.get("nombre"),
-                "descripcion": item.get("detalle"),
-                "precio": item.get("precio", "Consultar"),
-                "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            }
+@app.route("/carrito/agregar", methods=["POST"])
+def carrito_agregar_varios():
+    """
+    Agrega varios ítems en una sola petición: campos "ids" repetidos o separados
+    por comas (formulario), o {"ids": [...], "cantidad": n} en JSON.
+    """
+    user = get_user()
+    if not user:
+        if request.is_json:
+            return _error_api(401, "Sesión requerida")
+        return redirect(url_for("login"))
 
-    if not pub:
-        flash(t("Publicación no encontrada", "Item not found", "找不到項目"), "error")
-        return redirect(url_for("dashboard_router"))
+    if request.is_json:
+        datos = request.get_json(silent=True) or {}
+        ids = datos.get("ids") if isinstance(datos.get("ids"), list) else []
+        ids = [str(i) for i in ids]
+        cantidad = datos.get("cantidad")
+    else:
+        ids = [i for campo in request.form.getlist("ids") for i in campo.split(",")]
+        cantidad = request.form.get("cantidad")
+    ids = [i.strip() for i in ids if i.strip()][:app.config["CARRITO_MAX_ITEMS"]]
+
+    agregados, repetidos, rechazados = agregar_al_carrito(user, ids, _cantidad(cantidad))
+    if request.is_json:
+        return jsonify({"agregados": agregados, "repetidos": repetidos,
+                        "rechazados": [{"id": i, "error": e} for i, e in rechazados]})
+
+    if agregados:
+        flash(t("Ítems agregados al carrito", "Items added to cart", "項目已加入購物車")
+              + f": {len(agregados)}", "success")
+    if repetidos:
+        flash(t("Ya estaban en el carrito", "Already in cart", "已在購物車中")
+              + f": {len(repetidos)}", "warning")
+    if rechazados:
+        flash(t("No se pudieron agregar", "Could not be added", "無法加入")
+              + f": {len(rechazados)}", "error")
+    return redirect(url_for("carrito"))
 
-    if not puede_ver_publicacion(user, {"rol": pub["rol"], "tipo": pub["tipo"]}):
-        flash(t("No tienes permiso para comprar este ítem",
-                "You are not allowed to buy this item", "無權購買此項目"), "error")
-        return redirect(url_for("dashboard_router"))
+@app.route("/carrito/cantidad/<item_id>", methods=["POST"])
+def carrito_cantidad(item_id):
+    user = get_user()
+    if not user:
+        return redirect(url_for("login"))
 
-    carrito = user.setdefault("carrito", [])
-    if any(item["id"] == pub["id"] for item in carrito):
-        flash(t("El ítem ya está en el carrito", "Item already in cart", "項目已在購物車中"), "warning")
+    if CARRITOS.fijar_cantidad(user["email"], item_id, _cantidad(request.form.get("cantidad"))):
+        flash(t("Cantidad actualizada", "Quantity updated", "數量已更新"), "success")
     else:
-        carrito.append(pub)
-        flash(t("Agregado al carrito", "Added to cart", "已加入購物車"), "success")
-    session["user"] = user
+        flash(t("El ítem no está en el carrito", "Item not in cart", "項目不在購物車中"), "warning")
     return redirect(url_for("carrito"))
 
-@app.route("/carrito/eliminar/<int:index>", methods=["POST"])
-def carrito_eliminar(index):
+@app.route("/carrito/eliminar/<item_id>", methods=["POST"])
+def carrito_eliminar(item_id):
     user = get_user()
     if not user:
         return redirect(url_for("login"))
 
-    carrito = user.setdefault("carrito", [])
-    if 0 <= index < len(carrito):
-        carrito.pop(index)
+    if CARRITOS.quitar(user["email"], item_id):
         flash(t("Ítem eliminado", "Item removed", "已刪除項目"), "info")
     else:
-        flash(t("Índice inválido", "Invalid index", "索引無效"), "warning")
-    session["user"] = user
+        flash(t("El ítem no está en el carrito", "Item not in cart", "項目不在購物車中"), "warning")
     return redirect(url_for("carrito"))
 
 @app.route("/carrito/vaciar", methods=["POST"])
@@ -1034,11 +3843,137 @@ def carrito_vaciar():
     user = get_user()
     if not user:
         return redirect(url_for("login"))
-    user["carrito"] = []
-    session["user"] = user
+    CARRITOS.vaciar(user["email"])
     flash(t("Carrito vaciado", "Cart cleared", "購物車已清空"), "success")
     return redirect(url_for("carrito"))
 
+# ---------------------------------------------------------
+# 🗂️ DIRECTORIO DE EMPRESAS PRE-CALCULADO
+# ---------------------------------------------------------
+# Filtro de /clientes -> claves de PERMISOS con los roles de empresa que muestra.
+FILTROS_CLIENTES = {
+    "compra": ("puede_vender_a",),      # empresas que me compran
+    "venta": ("puede_comprar_de",),     # empresas que me venden
+    "servicio": ("puede_comprar_servicios", "puede_vender_servicios_a"),
+}
+# En perfiles de servicio lo que se "vende" son servicios
+FILTROS_CLIENTES_SERVICIO = dict(FILTROS_CLIENTES, compra=(),
+                                 servicio=FILTROS_CLIENTES["servicio"] + ("puede_vender_a",))
+
+def roles_por_filtro():
+    """{(tipo, rol, filtro): roles de empresa visibles} derivado de PERMISOS."""
+    tabla = {}
+    for tipo, por_rol in PERMISOS.items():
+        claves_filtro = FILTROS_CLIENTES_SERVICIO if tipo == "servicio" else FILTROS_CLIENTES
+        for rol, reglas in por_rol.items():
+            for filtro, claves in claves_filtro.items():
+                tabla[(tipo, rol, filtro)] = frozenset(r for c in claves for r in reglas.get(c, ()))
+    return tabla
+
+
+class DirectorioEmpresas:
+    """
+    Para cada perfil que mira (tipo, rol) y filtro ('' = sin filtro, según
+    puede_ver_publicacion) una lista de empresas ya ordenada por (empresa, email).
+    Los perfiles se arman al primer uso y luego se mantienen en cada alta o
+    cambio de empresa; los ocultos del usuario se descartan al recorrer.
+    """
+    FILTROS = ("",) + tuple(FILTROS_CLIENTES)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._info = {}       # email -> registro del usuario
+        self._buckets = {}    # (tipo, rol, filtro) -> [clave_empresa]
+        self._roles = {}
+        self.version_matriz = None
+        self.version_sincronizada = None
+
+    def _incluye(self, perfil, filtro, info):
+        if filtro:
+            return info.get("rol", "") in self._roles.get(perfil + (filtro,), ())
+        tipo_u, rol_u = perfil
+        return puede_ver_publicacion({"tipo": tipo_u, "rol": rol_u},
+                                     {"rol": info.get("rol"), "tipo": info.get("tipo")})
+
+    def _perfiles(self):
+        return {clave[:2] for clave in self._buckets}
+
+    def reconstruir(self):
+        with self._lock:
+            version, perfiles = USERS.version, self._perfiles()
+            self._roles = roles_por_filtro()
+            self.version_matriz = _MATRIZ_VISIBILIDAD["version"]
+            # Copias: en memoria las rutas modifican el registro antes de actualizar()
+            self._info = {info["email"]: dict(info) for info in USERS.por_empresa()}
+            self._buckets = {}
+            for perfil in perfiles:
+                self._armar(perfil)
+            self.version_sincronizada = version
+
+    def _armar(self, perfil):
+        # _info se llenó en orden de empresa: basta con filtrar
+        for filtro in self.FILTROS:
+            self._buckets[perfil + (filtro,)] = [_clave_empresa(info) for info in self._info.values()
+                                                 if self._incluye(perfil, filtro, info)]
+
+    def sincronizar(self):
+        """Reconstruye si USERS cambió por fuera (otro worker) o si cambiaron los permisos."""
+        if self.version_sincronizada != USERS.version or self.version_matriz != _MATRIZ_VISIBILIDAD["version"]:
+            self.reconstruir()
+
+    @contextmanager
+    def escritura(self):
+        """Como IndiceBusqueda.escritura: una escritura propia aplicada en línea."""
+        with self._lock:
+            al_dia = self.version_sincronizada == USERS.version
+            yield
+            if al_dia:
+                self.version_sincronizada = USERS.version
+
+    def actualizar(self, info):
+        """
+        Reubica la empresa en los buckets tras register/perfil. Copia al
+        escribir: recorrer() sigue su lista fuera del lock, así que cada bucket
+        que cambia se reemplaza por una lista nueva en vez de tocarlo en sitio.
+        """
+        with self._lock:
+            anterior = self._info.get(info["email"])
+            nuevo = dict(info)
+            for clave, bucket in list(self._buckets.items()):
+                perfil, filtro = clave[:2], clave[2]
+                copia = bucket
+                if anterior is not None and self._incluye(perfil, filtro, anterior):
+                    pos = bisect_left(bucket, _clave_empresa(anterior))
+                    if pos < len(bucket) and bucket[pos] == _clave_empresa(anterior):
+                        copia = bucket[:pos] + bucket[pos + 1:]
+                if self._incluye(perfil, filtro, nuevo):
+                    if copia is bucket:
+                        copia = list(bucket)
+                    insort(copia, _clave_empresa(nuevo))
+                if copia is not bucket:
+                    self._buckets[clave] = copia
+            self._info[info["email"]] = nuevo
+
+    def recorrer(self, tipo, rol, filtro, despues=None):
+        """Registros del bucket del perfil desde el cursor `despues` (exclusivo)."""
+        with self._lock:
+            self.sincronizar()
+            if filtro not in self.FILTROS:
+                return
+            clave = (tipo, rol, filtro)
+            if clave not in self._buckets:
+                self._armar((tipo, rol))
+            bucket, info = self._buckets[clave], self._info
+        pos = 0 if despues is None else bisect_right(bucket, tuple(despues))
+        while pos < len(bucket):
+            registro = info.get(bucket[pos][1])
+            if registro is not None:
+                yield registro
+            pos += 1
+
+
+DIRECTORIO = DirectorioEmpresas()
+
 # ---------------------------------------------------------
 # 🧾 CLIENTES / EMPRESAS VISIBLES SEGÚN PERMISOS
 # ---------------------------------------------------------
@@ -1049,103 +3984,28 @@ def clientes():
         return redirect(url_for("login"))
 
     filtro = (request.args.get("filtro") or "").strip().lower()
-    ocultos = HIDDEN_COMPANIES.get(user["email"], set())
-    visibles = []
-
-    tipo_u = user.get("tipo", "")
-    rol_u = user.get("rol", "")
-
-    def incluir_empresa(info):
-        tipo = info.get("tipo", "")
-        rol = info.get("rol", "")
-
-        # 🔹 COMPRAVENTA
-        if tipo_u == "compraventa":
-            if rol_u == "Productor":
-                if filtro == "compra" and rol in ["Packing", "Frigorífico", "Exportador"]:
-                    return True
-                if filtro == "servicio" and rol in ["Transporte", "Packing", "Frigorífico"]:
-                    return True
-            elif rol_u == "Packing":
-                if filtro == "compra" and rol in ["Frigorífico", "Exportador"]:
-                    return True
-                if filtro == "venta" and rol in ["Productor", "Frigorífico"]:
-                    return True
-                if filtro == "servicio" and rol in ["Transporte", "Frigorífico"]:
-                    return True
-            elif rol_u == "Frigorífico":
-                if filtro == "compra" and rol in ["Packing", "Exportador"]:
-                    return True
-                if filtro == "venta" and rol in ["Productor", "Packing"]:
-                    return True
-                if filtro == "servicio" and rol in ["Transporte", "Packing"]:
-                    return True
-            elif rol_u == "Exportador":
-                if filtro == "compra" and rol in ["Exportador", "Cliente Extranjero"]:
-                    return True
-                if filtro == "venta" and rol in ["Productor", "Packing", "Frigorífico", "Exportador"]:
-                    return True
-                if filtro == "servicio" and rol in ["Transporte", "Packing", "Frigorífico", "Extraportuarios", "Agencia de Aduanas"]:
-                    return True
-
-        # 🔹 SERVICIOS
-        elif tipo_u == "servicio":
-            if rol_u == "Transporte":
-                if filtro == "servicio" and rol in ["Productor", "Packing", "Frigorífico", "Exportador"]:
-                    return True
-            elif rol_u == "Packing":
-                if filtro == "servicio" and rol in ["Productor", "Frigorífico", "Exportador", "Transporte"]:
-                    return True
-            elif rol_u == "Frigorífico":
-                if filtro == "servicio" and rol in ["Productor", "Packing", "Exportador", "Transporte"]:
-                    return True
-            elif rol_u in ["Extraportuarios", "Agencia de Aduanas"]:
-                if filtro == "servicio" and rol == "Exportador":
-                    return True
-
-        # 🔹 MIXTO
-        elif tipo_u == "mixto":
-            if rol_u == "Frigorífico":
-                if filtro == "servicio" and rol in ["Productor", "Packing", "Exportador", "Transporte"]:
-                    return True
-                if filtro == "compra" and rol in ["Packing", "Exportador"]:
-                    return True
-                if filtro == "venta" and rol in ["Productor", "Packing"]:
-                    return True
-            elif rol_u == "Packing":
-                if filtro == "servicio" and rol in ["Productor", "Frigorífico", "Exportador", "Transporte"]:
-                    return True
-                if filtro == "compra" and rol in ["Frigorífico", "Exportador"]:
-                    return True
-                if filtro == "venta" and rol in ["Productor", "Frigorífico"]:
-                    return True
-
-        # 🔹 CLIENTE EXTRANJERO
-        elif tipo_u == "extranjero" and rol_u == "Cliente Extranjero":
-            if filtro == "venta" and rol == "Exportador":
-                return True
-
-        return False
-
-    # 🔎 Recorrer empresas visibles
-    for email, info in USERS.items():
+    ocultos = HIDDEN_COMPANIES.de(user["email"])
+    limite = tamano_pagina()
+    visibles, siguiente = [], None
+    despues = cursor_de_texto(request.args.get("despues"))
+    if not (isinstance(despues, list) and len(despues) == 2 and all(isinstance(x, str) for x in despues)):
+        despues = None
+
+    # 🔎 Recorrer el bucket del perfil desde el cursor; se corta al llenar la página
+    for info in DIRECTORIO.recorrer(user.get("tipo", ""), user.get("rol", ""), filtro, despues):
         if info["email"] == user["email"]:
             continue
-        username = info.get("username", "").lower()
-        if username in ocultos:
+        if info.get("username", "").lower() in ocultos:
             continue
-        if not filtro:
-            # Si no hay filtro, mostrar solo las que pueda ver por permisos básicos
-            if puede_ver_publicacion(user, {"rol": info["rol"], "tipo": info["tipo"]}):
-                visibles.append(info)
-        else:
-            if incluir_empresa(info):
-                visibles.append(info)
+        if len(visibles) == limite:
+            siguiente = cursor_a_texto(_clave_empresa(visibles[-1]))
+            break
+        visibles.append(info)
 
-    visibles.sort(key=lambda x: x.get("empresa", "").lower())
     return render_template("clientes.html",
                            user=user,
                            clientes=visibles,
+                           siguiente=siguiente,
                            titulo=t("Empresas y Servicios Disponibles"),
                            filtro=filtro)
 
@@ -1155,15 +4015,13 @@ def clientes():
 @app.route("/clientes/<username>")
 def cliente_detalle(username):
     username = (username or "").lower().strip()
-    email_map = {u.get("username", "").lower(): e for e, u in USERS.items()}
-    email = email_map.get(username)
+    c = USERS.por_username(username)
 
-    if not email or email not in USERS:
+    if not c:
         flash(t("La empresa solicitada no fue encontrada",
                 "Requested company not found", "找不到該公司"), "warning")
         return redirect(url_for("clientes"))
 
-    c = USERS[email]
     user = get_user()
 
     # 🚫 Validación de permisos de visualización
@@ -1186,9 +4044,483 @@ def cliente_detalle(username):
         titulo=c.get("empresa", username)
     )
 
+# ---------------------------------------------------------
+# 🔎 BÚSQUEDA DE EMPRESAS (índice invertido + BM25)
+# ---------------------------------------------------------
+_STOPWORDS = {
+    "de", "del", "la", "las", "el", "los", "y", "e", "o", "en", "por", "para", "con",
+    "un", "una", "al", "a", "the", "and", "of", "for", "to", "in", "on", "with",
+}
+_RE_LATINO = re.compile(r"[a-z0-9]+")
+_RE_CJK = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+def _plegar_acentos(texto):
+    """'Frigorífico' -> 'frigorifico'."""
+    descompuesto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+def _raiz(palabra):
+    """Stemming ligero español/inglés (plurales y sufijos frecuentes)."""
+    if len(palabra) <= 3 or palabra.isdigit():
+        return palabra
+    for sufijo, reemplazo in (("aciones", "acion"), ("iciones", "icion"), ("mente", ""),
+                              ("ies", "y"), ("ing", ""), ("ed", "")):
+        if palabra.endswith(sufijo) and len(palabra) - len(sufijo) >= 3:
+            return palabra[: -len(sufijo)] + reemplazo
+    if palabra.endswith("es") and len(palabra) > 4 and palabra[-3] in "nrldzj":
+        return palabra[:-2]
+    if palabra.endswith("s") and not palabra.endswith("ss"):
+        return palabra[:-1]
+    return palabra
+
+def cediendo(iterable, cada=500):
+    """
+    Recorre `iterable` cediendo el turno cada `cada` elementos. Con gevent una
+    reconstrucción larga frenaría el hub (y todos los streams de /eventos) hasta
+    terminar; time.sleep(0) parcheado vuelve al hub, y con hilos suelta el GIL.
+    """
+    for i, elemento in enumerate(iterable, 1):
+        if not i % cada:
+            time.sleep(0)
+        yield elemento
+
+
+def tokenizar(texto):
+    """Términos de búsqueda: latinos plegados + raíz, y bigramas para CJK."""
+    if not texto:
+        return []
+    texto = _plegar_acentos(str(texto))
+    terminos = [_raiz(p) for p in _RE_LATINO.findall(texto) if p not in _STOPWORDS]
+    for bloque in _RE_CJK.findall(texto):
+        if len(bloque) == 1:
+            terminos.append(bloque)
+        else:
+            terminos.extend(bloque[i:i + 2] for i in range(len(bloque) - 1))
+    return terminos
+
+
+class IndiceBusqueda:
+    """
+    Índice invertido en proceso. Documentos: 'u:<email>' (empresa, descripción e
+    ítems de catálogo) y 'p:<id>' (producto y descripción de la publicación).
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._postings = {}      # término -> {doc_id: frecuencia}
+        self._terminos_de = {}   # doc_id -> Counter de términos
+        self._meta = {}          # doc_id -> (email dueño, publicación o None)
+        self._largo_total = 0
+        self.version_sincronizada = None
+        self._lock = threading.RLock()
+        self._armando = threading.RLock()  # una sola reconstrucción a la vez
+
+    def __len__(self):
+        return len(self._terminos_de)
+
+    def _agregar(self, doc_id, texto, email, pub=None):
+        terminos = Counter(tokenizar(texto))
+        with self._lock:
+            self.quitar(doc_id)
+            if not terminos:
+                return
+            largo = sum(terminos.values())
+            self._terminos_de[doc_id] = terminos
+            self._meta[doc_id] = (email, pub, largo)
+            self._largo_total += largo
+            for termino, frecuencia in terminos.items():
+                self._postings.setdefault(termino, {})[doc_id] = frecuencia
+
+    def quitar(self, doc_id):
+        with self._lock:
+            terminos = self._terminos_de.pop(doc_id, None)
+            if terminos is None:
+                return
+            self._largo_total -= self._meta.pop(doc_id)[2]
+            for termino in terminos:
+                docs = self._postings.get(termino)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del self._postings[termino]
+
+    def indexar_usuario(self, info):
+        textos = [info.get("empresa"), info.get("rol"), info.get("descripcion")]
+        for item in info.get("items") or []:
+            textos += [item.get("nombre"), item.get("detalle")]
+        self._agregar(f"u:{info['email']}", " ".join(x for x in textos if x), info["email"])
+
+    def indexar_publicacion(self, pub):
+        texto = " ".join(x for x in (pub.get("producto"), pub.get("descripcion")) if x)
+        self._agregar(f"p:{pub['id']}", texto, pub.get("usuario"), pub)
+
+    def quitar_publicacion(self, pub_id):
+        self.quitar(f"p:{pub_id}")
+
+    def reconstruir(self):
+        """
+        Arma un índice nuevo fuera del lock y lo cambia de una vez: mientras
+        tanto las búsquedas y las escrituras (publicar, register, perfil) siguen
+        con el anterior. Lo que se escriba durante el armado cambia la versión,
+        así que la próxima sincronización vuelve a armar.
+        """
+        with self._armando:
+            version = version_datos()
+            nuevo = IndiceBusqueda()
+            for info in cediendo(USERS.values()):
+                nuevo.indexar_usuario(info)
+            for pub in cediendo(PUBLICACIONES):
+                nuevo.indexar_publicacion(pub)
+            with self._lock:
+                self._postings, self._terminos_de, self._meta = nuevo._postings, nuevo._terminos_de, nuevo._meta
+                self._largo_total = nuevo._largo_total
+                self.version_sincronizada = version
+
+    def sincronizar(self):
+        """Reconstruye si los almacenes cambiaron por fuera (p.ej. otro worker)."""
+        if self.version_sincronizada != version_datos():
+            with self._armando:
+                # Otra petición pudo haberlo rearmado mientras se esperaba
+                if self.version_sincronizada != version_datos():
+                    self.reconstruir()
+
+    @contextmanager
+    def escritura(self):
+        """
+        Envuelve una escritura propia aplicada también en línea al índice: si el
+        índice estaba al día antes, sigue al día después (sin reconstruir).
+        """
+        with self._lock:
+            al_dia = self.version_sincronizada == version_datos()
+            yield
+            if al_dia:
+                self.version_sincronizada = version_datos()
+
+    def buscar(self, consulta, admite=None):
+        """
+        [(email, puntaje)] ordenado por BM25 (el mejor documento de cada empresa).
+        `admite(email, pub)` filtra documentos antes de puntuar.
+        """
+        terminos = set(tokenizar(consulta))
+        with self._lock:
+            n_docs = len(self._terminos_de)
+            if not terminos or not n_docs:
+                return []
+            largo_medio = self._largo_total / n_docs
+            puntajes = {}
+            for termino in terminos:
+                docs = self._postings.get(termino)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, frecuencia in docs.items():
+                    norma = self.K1 * (1 - self.B + self.B * self._meta[doc_id][2] / largo_medio)
+                    puntajes[doc_id] = (puntajes.get(doc_id, 0.0)
+                                        + idf * frecuencia * (self.K1 + 1) / (frecuencia + norma))
+            metas = {doc_id: self._meta[doc_id] for doc_id in puntajes}
+
+        por_empresa = {}
+        for doc_id, puntaje in puntajes.items():
+            email, pub, _ = metas[doc_id]
+            if admite is not None and not admite(email, pub):
+                continue
+            if puntaje > por_empresa.get(email, 0.0):
+                por_empresa[email] = puntaje
+        return sorted(por_empresa.items(), key=lambda par: -par[1])
+
+
+INDICE_BUSQUEDA = IndiceBusqueda()
+construir_al_arrancar(INDICE_BUSQUEDA)
+RESULTADOS_BUSQUEDA_MAX = 50
+
+@app.route("/buscar")
+def buscar():
+    user = get_user()
+    if not user:
+        return redirect(url_for("login"))
+
+    query = (request.args.get("q") or "").strip()
+    ocultos = HIDDEN_COMPANIES.de(user["email"])
+
+    def admite(email, pub):
+        if email == user["email"]:
+            return False
+        if pub is not None:
+            return puede_ver_publicacion(user, pub)
+        return True
+
+    resultados = []
+    if query:
+        INDICE_BUSQUEDA.sincronizar()
+        for email, _ in INDICE_BUSQUEDA.buscar(query, admite):
+            c = USERS.get(email)
+            if not c or c.get("username", "").lower() in ocultos:
+                continue
+            # Mismo criterio que /clientes y cliente_detalle para ver la empresa
+            if not puede_ver_publicacion(user, {"rol": c["rol"], "tipo": c["tipo"]}):
+                continue
+            resultados.append(c)
+            if len(resultados) >= RESULTADOS_BUSQUEDA_MAX:
+                break
+
+    return render_template("busqueda_resultados.html",
+                           user=user,
+                           query=query,
+                           resultados=resultados,
+                           titulo=t("Resultados de búsqueda", "Search Results", "搜尋結果"))
+
+# ---------------------------------------------------------
+# 💲 ÍNDICE DE PRECIOS POR UNIDAD
+# ---------------------------------------------------------
+class IndicePrecios:
+    """
+    Publicaciones e ítems de catálogo con precio estructurado: por (moneda,
+    unidad) una lista ordenada de (monto, id). Un rango de precios son dos
+    bisect sobre esa lista; sólo se recorre lo que cae dentro.
+    """
+
+    def __init__(self):
+        self._listas = {}     # (moneda, unidad) -> [(monto, id)] ordenada
+        self._entradas = {}   # id -> (clave, monto, entrada, términos)
+        self._items_de = {}   # email -> ids de su catálogo
+        self.version_sincronizada = None
+        self._lock = threading.RLock()
+        self._armando = threading.RLock()
+
+    def __len__(self):
+        return len(self._entradas)
+
+    @staticmethod
+    def version_fuente():
+        return (USERS.version, PUBLICACIONES.version)
+
+    def _agregar(self, entrada):
+        with self._lock:
+            self.quitar(entrada["id"])
+            precio = precio_de(entrada)
+            if None in precio.values():
+                return
+            clave = (precio["moneda"], precio["unidad"])
+            texto = " ".join(x for x in (entrada.get("producto"), entrada.get("descripcion")) if x)
+            insort(self._listas.setdefault(clave, []), (precio["monto"], entrada["id"]))
+            self._entradas[entrada["id"]] = (clave, precio["monto"], entrada, frozenset(tokenizar(texto)))
+
+    def quitar(self, entrada_id):
+        with self._lock:
+            previa = self._entradas.pop(entrada_id, None)
+            if previa is None:
+                return
+            clave, monto = previa[:2]
+            lista = self._listas[clave]
+            del lista[bisect_left(lista, (monto, entrada_id))]
+            if not lista:
+                del self._listas[clave]
+
+    def indexar_usuario(self, info):
+        with self._lock:
+            for item_id in self._items_de.pop(info["email"], []):
+                self.quitar(item_id)
+            items = [item for item in info.get("items") or [] if item.get("id")]
+            self._items_de[info["email"]] = [item["id"] for item in items]
+            for item in items:
+                self._agregar(_entrada_catalogo(info, item))
+
+    def indexar_publicacion(self, pub):
+        self._agregar(pub)
+
+    def quitar_publicacion(self, pub_id):
+        self.quitar(pub_id)
+
+    def reconstruir(self):
+        """Como IndiceBusqueda.reconstruir: se arma aparte y se cambia bajo el lock."""
+        with self._armando:
+            version = self.version_fuente()
+            nuevo = IndicePrecios()
+            for info in cediendo(USERS.values()):
+                nuevo.indexar_usuario(info)
+            for pub in cediendo(PUBLICACIONES):
+                nuevo._agregar(pub)
+            with self._lock:
+                self._listas, self._entradas, self._items_de = nuevo._listas, nuevo._entradas, nuevo._items_de
+                self.version_sincronizada = version
+
+    def sincronizar(self):
+        """Reconstruye si usuarios o publicaciones cambiaron por fuera (otro worker)."""
+        if self.version_sincronizada != self.version_fuente():
+            with self._armando:
+                if self.version_sincronizada != self.version_fuente():
+                    self.reconstruir()
+
+    @contextmanager
+    def escritura(self):
+        """Como IndiceBusqueda.escritura: una escritura propia aplicada en línea."""
+        with self._lock:
+            al_dia = self.version_sincronizada == self.version_fuente()
+            yield
+            if al_dia:
+                self.version_sincronizada = self.version_fuente()
+
+    def unidades(self):
+        """{moneda: [unidades con precios]} para armar los filtros."""
+        with self._lock:
+            claves = list(self._listas)
+        por_moneda = {}
+        for moneda, unidad in sorted(claves):
+            por_moneda.setdefault(moneda, []).append(unidad)
+        return por_moneda
+
+    def buscar(self, moneda, unidad, minimo=None, maximo=None, consulta=None,
+               admite=None, despues=None, limite=50):
+        """
+        Entradas de menor a mayor precio dentro de [minimo, maximo]. `consulta`
+        exige sus términos en producto/descripción; `despues` (id) continúa una
+        página anterior.
+        """
+        terminos = set(tokenizar(consulta)) if consulta else set()
+        resultados = []
+        with self._lock:
+            lista = self._listas.get((moneda, unidad), [])
+            pos = 0 if minimo is None else bisect_left(lista, minimo, key=itemgetter(0))
+            if despues in self._entradas and self._entradas[despues][0] == (moneda, unidad):
+                pos = max(pos, bisect_right(lista, (self._entradas[despues][1], despues)))
+            fin = len(lista) if maximo is None else bisect_right(lista, maximo, key=itemgetter(0))
+            for monto, entrada_id in lista[pos:fin]:
+                _, _, entrada, terminos_entrada = self._entradas[entrada_id]
+                if terminos <= terminos_entrada and (admite is None or admite(entrada)):
+                    resultados.append(entrada)
+                    if len(resultados) > limite:
+                        break
+        siguiente = resultados[limite - 1]["id"] if len(resultados) > limite else None
+        return resultados[:limite], siguiente
+
+
+INDICE_PRECIOS = IndicePrecios()
+construir_al_arrancar(INDICE_PRECIOS)
+
+def _filtros_precio():
+    """moneda, unidad, mínimo, máximo y texto pedidos en la query string."""
+    def numero(nombre):
+        try:
+            valor = float(request.args[nombre].replace(",", "."))
+        except (KeyError, ValueError):
+            return None
+        return valor if math.isfinite(valor) else None
+    return {
+        "moneda": (request.args.get("moneda") or "USD").strip().upper(),
+        "unidad": (request.args.get("unidad") or "kg").strip().lower(),
+        "minimo": numero("min"),
+        "maximo": numero("max"),
+        "consulta": (request.args.get("q") or "").strip(),
+    }
+
+def buscar_precios_para(user, filtros, despues=None, limite=50):
+    """Página de INDICE_PRECIOS con lo que `user` puede comprar (sin lo propio)."""
+    def admite(entrada):
+        return entrada.get("usuario") != user["email"] and puede_ver_publicacion(user, entrada)
+    INDICE_PRECIOS.sincronizar()
+    return INDICE_PRECIOS.buscar(admite=admite, despues=despues, limite=limite, **filtros)
+
+@app.route("/explorar")
+def explorar():
+    user = get_user()
+    if not user:
+        return redirect(url_for("login"))
+
+    filtros = _filtros_precio()
+    items, siguiente = buscar_precios_para(user, filtros, despues=request.args.get("despues"),
+                                           limite=tamano_pagina())
+    return render_template("explorar.html",
+                           user=user,
+                           items=items,
+                           siguiente=siguiente,
+                           filtros=filtros,
+                           unidades=UNIDADES_PRECIO,
+                           titulo=t("Explorar precios", "Explore prices", "瀏覽價格"))
+
+# ---------------------------------------------------------
+# ⏳ VENCIMIENTO DE PUBLICACIONES
+# ---------------------------------------------------------
+# Las publicaciones con `vence` (epoch) se retiran solas: un hilo duerme hasta
+# el próximo vencimiento (o BARRIDO_MAX, por si otro proceso publicó), pide
+# al almacén las vencidas y las quita junto con sus entradas en los índices.
+BARRIDO_MAX = 60  # segundos
+
+def retirar_publicacion(pub_id):
+    """Quita la publicación del almacén y de los índices derivados; devuelve la publicación o None."""
+    with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura():
+        pub = PUBLICACIONES.eliminar(pub_id)
+        INDICE_BUSQUEDA.quitar_publicacion(pub_id)
+        INDICE_PRECIOS.quitar_publicacion(pub_id)
+    FRAGMENTOS.invalidar()
+    return pub
+
+
+class BarredorVencimientos:
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, daemon=True, name="ws-vencimientos")
+            self._hilo.start()
+
+    def avisar(self):
+        """Hay una publicación con vencimiento nueva: recalcular la espera."""
+        self._despertar.set()
+
+    def barrer(self, ahora=None):
+        """Retira las publicaciones vencidas; devuelve cuántas."""
+        retiradas = 0
+        for pub_id in self.almacen.vencidas(int(time.time()) if ahora is None else ahora):
+            retiradas += retirar_publicacion(pub_id) is not None
+        return retiradas
+
+    def _bucle(self):
+        while True:
+            espera = BARRIDO_MAX
+            try:
+                self.barrer()
+                proximo = self.almacen.proximo_vencimiento()
+                if proximo is not None:
+                    espera = min(max(proximo - time.time(), 0), BARRIDO_MAX)
+            except Exception:  # p. ej. SQLite bloqueada: se reintenta en la próxima vuelta
+                app.logger.exception("No se pudieron retirar las publicaciones vencidas")
+            self._despertar.wait(espera)
+            self._despertar.clear()
+
+
+BARREDOR = BarredorVencimientos(PUBLICACIONES)
+
+# ---------------------------------------------------------
+# 🧵 HILOS DE FONDO
+# ---------------------------------------------------------
+# El barredor y los hilos del diario arrancan con la primera petición de cada
+# worker y no al importar: la CLI y los scripts que importan app no los
+# levantan, y con gunicorn --preload no quedan en el proceso maestro antes
+# del fork (donde no sobreviven).
+_HILOS_LOCK = threading.Lock()
+_HILOS_INICIADOS = threading.Event()
+
+def iniciar_hilos_de_fondo():
+    if _HILOS_INICIADOS.is_set():
+        return
+    with _HILOS_LOCK:
+        if not _HILOS_INICIADOS.is_set():
+            BARREDOR.iniciar()
+            if DIARIO is not None:
+                iniciar_hilos_diario(DIARIO)
+            _HILOS_INICIADOS.set()
+
+app.before_request(iniciar_hilos_de_fondo)
+
 # ---------------------------------------------------------
 # 💬 MENSAJERÍA INTERNA
 # ---------------------------------------------------------
+MENSAJES_POR_PAGINA = 20
+
 @app.route("/mensajes", methods=["GET", "POST"])
 def mensajes():
     user = get_user()
@@ -1218,13 +4550,10 @@ def mensajes():
         # 🕒 Cooldown: 3 días (72 horas)
         now = datetime.now()
         tres_dias = 3 * 24 * 3600  # segundos
-        enviados_user = [m for m in MENSAJES
-                         if m["origen"] == user["email"] and m["destino"] == destino]
+        ultimo_envio = MENSAJES.ultimo_envio(user["email"], destino)
 
-        if enviados_user:
-            ultimo_envio = max(datetime.strptime(m["fecha"], "%Y-%m-%d %H:%M")
-                               for m in enviados_user)
-            diferencia = (now - ultimo_envio).total_seconds()
+        if ultimo_envio is not None:
+            diferencia = now.timestamp() - ultimo_envio
             if diferencia < tres_dias:
                 horas_rest = int((tres_dias - diferencia) / 3600)
                 flash(t(f"Aún debes esperar {horas_rest}h para volver a contactar a esta empresa",
@@ -1232,27 +4561,333 @@ def mensajes():
                         f"您必須等待 {horas_rest} 小時才能再次聯絡此公司"), "warning")
                 return redirect(url_for("mensajes"))
 
-        # 📩 Registrar mensaje nuevo
-        MENSAJES.append({
+        # 📩 Registrar mensaje nuevo y avisar al destinatario si está conectado
+        mensaje = MENSAJES.agregar({
             "origen": user["email"],
             "destino": destino,
             "contenido": contenido,
-            "fecha": now.strftime("%Y-%m-%d %H:%M")
+            "ts": int(now.timestamp()),
         })
+        publicar_evento("mensaje", dict(mensaje))
         flash(t("Mensaje enviado correctamente",
                 "Message sent successfully", "訊息已送出"), "success")
         return redirect(url_for("mensajes"))
 
-    # 📬 Mostrar bandejas
-    recibidos = [m for m in MENSAJES if m["destino"] == user["email"]]
-    enviados = [m for m in MENSAJES if m["origen"] == user["email"]]
+    # 📬 Mostrar bandejas (paginadas por cursor, más recientes primero)
+    antes_r = request.args.get("antes_r", type=int)
+    antes_e = request.args.get("antes_e", type=int)
+    recibidos, siguiente_r = MENSAJES.recibidos(user["email"], antes_r, MENSAJES_POR_PAGINA)
+    enviados, siguiente_e = MENSAJES.enviados(user["email"], antes_e, MENSAJES_POR_PAGINA)
 
     return render_template("mensajes.html",
                            user=user,
                            recibidos=recibidos,
                            enviados=enviados,
+                           antes_r=antes_r,
+                           antes_e=antes_e,
+                           siguiente_r=siguiente_r,
+                           siguiente_e=siguiente_e,
                            titulo=t("Mensajería"))
 
+# ---------------------------------------------------------
+# 📡 EVENTOS EN TIEMPO REAL (Server-Sent Events)
+# ---------------------------------------------------------
+# /mensajes y /publicar publican en CENTRAL_EVENTOS; /eventos los empuja a los
+# suscriptores a los que les corresponden (destinatario del mensaje, o perfiles
+# que pueden ver la publicación y no ocultaron a la empresa). Los ids son
+# globales: con WS_STORAGE=sqlite el registro vive en la base compartida, cada
+# worker lo sigue por sondeo y el navegador puede reconectar a cualquier worker
+# con Last-Event-ID. Pensado para gunicorn -k gevent (conexiones ociosas sin hilos).
+app.config["EVENTOS_LATIDO"] = float(os.environ.get("WS_EVENTOS_LATIDO", 15))
+app.config["EVENTOS_DURACION"] = float(os.environ.get("WS_EVENTOS_DURACION", 300))
+app.config["EVENTOS_RETENIDOS"] = int(os.environ.get("WS_EVENTOS_RETENIDOS", 1000))
+app.config["EVENTOS_SONDEO"] = float(os.environ.get("WS_EVENTOS_SONDEO", 0.5))
+EVENTOS_REINTENTO_MS = 3000
+
+
+class RegistroEventos:
+    """Últimos eventos en memoria (un solo proceso)."""
+    compartido = False
+
+    def __init__(self, retenidos):
+        self._eventos = deque(maxlen=retenidos)
+        self._lock = threading.Lock()
+        self._ultimo = 0
+
+    def ultimo_id(self):
+        return self._ultimo
+
+    def agregar(self, tipo, datos):
+        with self._lock:
+            self._ultimo += 1
+            self._eventos.append((self._ultimo, tipo, datos))
+            return self._ultimo
+
+    def desde(self, id_evento):
+        """Eventos posteriores a id_evento, o None si ya no están todos retenidos."""
+        with self._lock:
+            eventos = list(self._eventos)
+        if id_evento > self._ultimo or (eventos and eventos[0][0] > id_evento + 1):
+            return None
+        return [e for e in eventos if e[0] > id_evento]
+
+    def recientes(self, limite):
+        with self._lock:
+            return list(self._eventos)[-limite:][::-1]
+
+
+class RegistroEventosSQLite:
+    """Registro en la base compartida: todos los workers ven los mismos ids."""
+    compartido = True
+    PURGA_CADA = 100
+
+    def __init__(self, ruta, retenidos):
+        self.ruta = ruta
+        self.retenidos = retenidos
+        self._local = _LocalDelHilo()
+        self._escrituras = 0
+        with self._conexion() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS eventos ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, tipo TEXT NOT NULL, datos TEXT NOT NULL)")
+
+    def _conexion(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = sqlite3.connect(self.ruta, timeout=10)
+        return con
+
+    def ultimo_id(self):
+        return self._conexion().execute("SELECT COALESCE(MAX(id), 0) FROM eventos").fetchone()[0]
+
+    def agregar(self, tipo, datos):
+        con = self._conexion()
+        with con:
+            id_evento = con.execute("INSERT INTO eventos (tipo, datos) VALUES (?, ?)",
+                                    (tipo, json.dumps(datos, ensure_ascii=False))).lastrowid
+            self._escrituras += 1
+            if self._escrituras % self.PURGA_CADA == 0:
+                con.execute("DELETE FROM eventos WHERE id <= ?", (id_evento - self.retenidos,))
+        return id_evento
+
+    def desde(self, id_evento):
+        con = self._conexion()
+        minimo, maximo = con.execute("SELECT MIN(id), MAX(id) FROM eventos").fetchone()
+        if id_evento > (maximo or 0) or (minimo is not None and minimo > id_evento + 1):
+            return None
+        filas = con.execute("SELECT id, tipo, datos FROM eventos WHERE id > ? ORDER BY id LIMIT ?",
+                            (id_evento, self.retenidos)).fetchall()
+        return [(i, tipo, json.loads(datos)) for i, tipo, datos in filas]
+
+    def recientes(self, limite):
+        filas = self._conexion().execute(
+            "SELECT id, tipo, datos FROM eventos ORDER BY id DESC LIMIT ?", (limite,)).fetchall()
+        return [(i, tipo, json.loads(datos)) for i, tipo, datos in filas]
+
+
+class Suscripcion:
+    """Cola de un navegador conectado a /eventos."""
+    PENDIENTES_MAX = 256  # un cliente atascado pierde los más antiguos
+
+    def __init__(self, usuario):
+        self.email = usuario["email"]
+        self.perfil = (usuario.get("tipo", ""), usuario.get("rol", ""))
+        self.pendientes = deque(maxlen=self.PENDIENTES_MAX)
+        self.aviso = threading.Event()
+
+    def entregar(self, evento):
+        self.pendientes.append(evento)
+        self.aviso.set()
+
+    def esperar(self, segundos):
+        """Eventos recibidos, esperando como mucho `segundos` si no hay ninguno."""
+        self.aviso.wait(segundos)
+        self.aviso.clear()
+        eventos = []
+        while self.pendientes:
+            eventos.append(self.pendientes.popleft())
+        return eventos
+
+
+def evento_visible_para(usuario, tipo, datos):
+    """¿Le corresponde el evento al usuario? (sin mirar empresas ocultas)"""
+    if tipo == "mensaje":
+        return datos.get("destino") == usuario["email"]
+    if tipo == "publicacion":
+        return datos.get("usuario") != usuario["email"] and puede_ver_publicacion(usuario, datos)
+    return False
+
+
+class CentralEventos:
+    """
+    Pub/sub en proceso. Los suscriptores se indexan por email (mensajes) y por
+    perfil (tipo, rol): una publicación se evalúa una vez por perfil conectado,
+    no por conexión.
+    """
+
+    def __init__(self, registro, sondeo):
+        self.registro = registro
+        self.sondeo = sondeo
+        self._lock = threading.Lock()
+        self._por_email = {}
+        self._por_perfil = {}
+        self._despachado = registro.ultimo_id()
+        self._hilo = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._por_email.values())
+
+    def suscribir(self, usuario):
+        sub = Suscripcion(usuario)
+        with self._lock:
+            self._por_email.setdefault(sub.email, set()).add(sub)
+            self._por_perfil.setdefault(sub.perfil, set()).add(sub)
+            if self.registro.compartido and (self._hilo is None or not self._hilo.is_alive()):
+                self._hilo = threading.Thread(target=self._seguir_registro, daemon=True,
+                                              name="ws-eventos")
+                self._hilo.start()
+        return sub
+
+    def cancelar(self, sub):
+        with self._lock:
+            for indice, clave in ((self._por_email, sub.email), (self._por_perfil, sub.perfil)):
+                subs = indice.get(clave)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del indice[clave]
+
+    def publicar(self, tipo, datos):
+        id_evento = self.registro.agregar(tipo, datos)
+        if not self.registro.compartido:
+            self._despachar(id_evento, tipo, datos)
+        return id_evento
+
+    def _despachar(self, id_evento, tipo, datos):
+        with self._lock:
+            if tipo == "mensaje":
+                destinatarios = list(self._por_email.get(datos.get("destino"), ()))
+            else:
+                perfiles = list(self._por_perfil.items())
+                destinatarios = [sub for (tipo_u, rol_u), subs in perfiles
+                                 if evento_visible_para({"email": None, "tipo": tipo_u, "rol": rol_u},
+                                                        tipo, datos)
+                                 for sub in subs if sub.email != datos.get("usuario")]
+        for sub in destinatarios:
+            sub.entregar((id_evento, tipo, datos))
+
+    def _seguir_registro(self):
+        """Modo compartido: trae los eventos nuevos de la base mientras haya suscriptores."""
+        while len(self):
+            time.sleep(self.sondeo)
+            try:
+                eventos = self.registro.desde(self._despachado)
+            except sqlite3.Error:
+                app.logger.exception("No se pudo leer el registro de eventos")
+                continue
+            if eventos is None:  # purgados antes de leerlos: se sigue desde el último
+                self._despachado = self.registro.ultimo_id()
+                continue
+            for id_evento, tipo, datos in eventos:
+                self._despachar(id_evento, tipo, datos)
+                self._despachado = id_evento
+
+
+def crear_registro_eventos(config):
+    if config["STORAGE_BACKEND"] == "sqlite":
+        return RegistroEventosSQLite(config["STORAGE_DB"], config["EVENTOS_RETENIDOS"])
+    return RegistroEventos(config["EVENTOS_RETENIDOS"])
+
+CENTRAL_EVENTOS = CentralEventos(crear_registro_eventos(app.config), app.config["EVENTOS_SONDEO"])
+
+def publicar_evento(tipo, datos):
+    """Publica sin que un fallo del registro tumbe la escritura que lo originó."""
+    try:
+        CENTRAL_EVENTOS.publicar(tipo, datos)
+    except sqlite3.Error:
+        app.logger.exception("No se pudo publicar el evento %s", tipo)
+
+def _evento_para_cliente(tipo, datos):
+    """Solo lo que el navegador necesita mostrar."""
+    if tipo == "mensaje":
+        return {"origen": datos.get("origen"), "contenido": datos.get("contenido"),
+                "fecha": datos.get("fecha")}
+    return {c: datos.get(c) for c in ("id", "empresa", "producto", "categoria",
+                                      "subtipo", "precio", "fecha")}
+
+def _formato_sse(id_evento, tipo, datos):
+    cuerpo = json.dumps(_evento_para_cliente(tipo, datos), ensure_ascii=False)
+    return f"id: {id_evento}\nevent: {tipo}\ndata: {cuerpo}\n\n"
+
+@app.route("/eventos")
+def eventos():
+    user = get_user()
+    if not user:
+        return app.response_class("no autorizado\n", 401, mimetype="text/plain")
+    usuario = {"email": user["email"], "tipo": user.get("tipo", ""), "rol": user.get("rol", "")}
+    ultimo = request.headers.get("Last-Event-ID", type=int)
+    latido = app.config["EVENTOS_LATIDO"]
+    duracion = app.config["EVENTOS_DURACION"]
+
+    def entregable(tipo, datos):
+        if not evento_visible_para(usuario, tipo, datos):
+            return False
+        return tipo != "publicacion" or datos.get("username", "").lower() not in HIDDEN_COMPANIES.de(usuario["email"])
+
+    # Sin contexto de petición: el generador solo usa `usuario` y los almacenes
+    def flujo():
+        sub = CENTRAL_EVENTOS.suscribir(usuario)
+        try:
+            yield f"retry: {EVENTOS_REINTENTO_MS}\n\n"
+            visto = 0
+            if ultimo is not None:
+                perdidos = CENTRAL_EVENTOS.registro.desde(ultimo)
+                if perdidos is None:
+                    yield "event: recargar\ndata: {}\n\n"
+                else:
+                    for id_evento, tipo, datos in perdidos:
+                        visto = id_evento
+                        if entregable(tipo, datos):
+                            yield _formato_sse(id_evento, tipo, datos)
+            fin = time.monotonic() + duracion
+            while time.monotonic() < fin:
+                pendientes = sub.esperar(min(latido, max(0, fin - time.monotonic())))
+                if not pendientes:
+                    yield ": latido\n\n"
+                    continue
+                for id_evento, tipo, datos in pendientes:
+                    if id_evento > visto and entregable(tipo, datos):
+                        yield _formato_sse(id_evento, tipo, datos)
+            # Al cerrar, el navegador reconecta solo y retoma desde Last-Event-ID
+        finally:
+            CENTRAL_EVENTOS.cancelar(sub)
+
+    return app.response_class(flujo(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+NOTIFICACIONES_MAX = 30
+
+@app.route("/notificaciones")
+def notificaciones():
+    user = get_user()
+    if not user:
+        return redirect(url_for("login"))
+    ocultos = HIDDEN_COMPANIES.de(user["email"])
+    lista = []
+    for _, tipo, datos in CENTRAL_EVENTOS.registro.recientes(app.config["EVENTOS_RETENIDOS"]):
+        if not evento_visible_para(user, tipo, datos):
+            continue
+        if tipo == "mensaje":
+            lista.append({"titulo": t("Nuevo mensaje de", "New message from", "新訊息來自") + " " + datos.get("origen", ""),
+                          "mensaje": datos.get("contenido", ""), "fecha": datos.get("fecha", "")})
+        elif datos.get("username", "").lower() not in ocultos:
+            lista.append({"titulo": t("Nueva publicación", "New post", "新發布") + ": " + (datos.get("producto") or ""),
+                          "mensaje": datos.get("empresa") or "", "fecha": datos.get("fecha", "")})
+        if len(lista) == NOTIFICACIONES_MAX:
+            break
+    return render_template("notificaciones.html", user=user, notificaciones=lista,
+                           titulo=t("Notificaciones del sistema"))
+
 # ---------------------------------------------------------
 # 🧩 OCULTAR EMPRESAS DE LA VISTA
 # ---------------------------------------------------------
@@ -1264,8 +4899,7 @@ def ocultar_publicacion(username):
     if not username:
         return redirect(url_for("clientes"))
 
-    key = user["email"]
-    HIDDEN_COMPANIES.setdefault(key, set()).add(username.lower())
+    HIDDEN_COMPANIES.ocultar(user["email"], username)
     flash(t("Elemento ocultado temporalmente de tu vista",
             "Item temporarily hidden from your view", "已暫時隱藏項目"), "info")
     return redirect(url_for("clientes"))
@@ -1278,9 +4912,7 @@ def mostrar_todo():
     if not user:
         return redirect(url_for("login"))
 
-    key = user["email"]
-    if key in HIDDEN_COMPANIES:
-        HIDDEN_COMPANIES[key].clear()
+    if HIDDEN_COMPANIES.mostrar_todo(user["email"]):
         flash(t("Se han restaurado todas las empresas visibles",
                 "All companies are now visible again", "所有公司已再次可見"), "success")
     else:
@@ -1289,14 +4921,386 @@ def mostrar_todo():
 
     return redirect(url_for("clientes"))
 
+# ---------------------------------------------------------
+# 🔌 API JSON v1 (lectura para integraciones)
+# ---------------------------------------------------------
+# Misma visibilidad que los paneles. El ETag fuerte sale de la versión de los
+# datos, el perfil del usuario y la consulta: un sondeo con If-None-Match recibe
+# 304 sin consultar almacenes ni serializar.
+try:
+    import msgpack  # opcional: salida application/msgpack
+except ImportError:
+    msgpack = None
+
+MIME_MSGPACK = "application/msgpack"
+CAMPOS_PUBLICACION_API = ("id", "usuario", "empresa", "rol", "tipo", "subtipo", "categoria",
+                          "producto", "descripcion", "precio", "moneda", "monto", "unidad",
+                          "servicio_objetivo", "fecha", "ts", "vence")
+CAMPOS_PRECIO_API = ("id", "usuario", "empresa", "rol", "tipo", "producto", "descripcion",
+                     "precio", "moneda", "monto", "unidad")
+CAMPOS_EMPRESA_API = ("username", "empresa", "nombre", "email", "rol", "tipo", "descripcion",
+                      "pais", "direccion", "telefono", "fecha", "items")
+
+def _error_api(estado, mensaje):
+    return jsonify({"error": mensaje}), estado
+
+def _formato_api():
+    """'json' o 'msgpack', por ?format= o por la cabecera Accept."""
+    formato = request.args.get("format")
+    if formato is None:
+        mejor = request.accept_mimetypes.best_match(["application/json", MIME_MSGPACK])
+        formato = "msgpack" if mejor == MIME_MSGPACK else "json"
+    return formato
+
+def _etag_api(user, formato):
+    clave = repr((request.endpoint, sorted(request.view_args.items()),
+                  sorted(request.args.items(multi=True)), formato,
+                  user.get("tipo"), user.get("rol"), USERS.version, PUBLICACIONES.version))
+    return hashlib.blake2b(clave.encode(), digest_size=16).hexdigest()
+
+def _proyeccion_api(permitidos):
+    """Campos pedidos en ?fields=a,b (todos si falta) y los desconocidos."""
+    pedidos = [c.strip() for c in (request.args.get("fields") or "").split(",") if c.strip()]
+    campos = pedidos or list(permitidos)
+    return campos, [c for c in campos if c not in permitidos]
+
+def api_v1(vista):
+    """
+    Sesión obligatoria, negociación de formato y ETag/304. La vista recibe el
+    usuario y devuelve los datos, o (estado, mensaje) si hay error.
+    """
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        user = get_user()
+        if not user:
+            return _error_api(401, "Sesión requerida")
+        formato = _formato_api()
+        if formato not in ("json", "msgpack"):
+            return _error_api(400, f"Formato no soportado: {formato}")
+        if formato == "msgpack" and msgpack is None:
+            return _error_api(406, "MessagePack no está disponible en este servidor")
+
+        etag = _etag_api(user, formato)
+        if request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+        else:
+            datos = vista(user, *args, **kwargs)
+            if isinstance(datos, tuple):
+                return _error_api(*datos)
+            if formato == "msgpack":
+                resp = app.response_class(msgpack.packb(datos, use_bin_type=True), mimetype=MIME_MSGPACK)
+            else:
+                resp = jsonify(datos)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        resp.vary.update(("Cookie", "Accept"))
+        return resp
+    return envoltura
+
+@app.route("/api/v1/publicaciones")
+@api_v1
+def api_publicaciones(user):
+    """Publicaciones visibles, más recientes primero; filtros ?categoria=&rol=&tipo=&subtipo=."""
+    campos, desconocidos = _proyeccion_api(CAMPOS_PUBLICACION_API)
+    if desconocidos:
+        return 400, f"Campos desconocidos: {', '.join(desconocidos)}"
+    extra = {c: request.args[c] for c in PUBLICACIONES.CAMPOS_INDICE if c in request.args}
+    pubs, siguiente = _pagina_publicaciones_para(user, **extra)
+    return {
+        "publicaciones": [{c: p.get(c) for c in campos} for p in pubs],
+        "siguiente": siguiente,
+    }
+
+@app.route("/api/v1/precios")
+@api_v1
+def api_precios(user):
+    """
+    Publicaciones e ítems de catálogo por precio ascendente en una unidad:
+    ?unidad=kg&moneda=USD&min=&max=&q=, paginado con ?despues=<id>.
+    """
+    campos, desconocidos = _proyeccion_api(CAMPOS_PRECIO_API)
+    if desconocidos:
+        return 400, f"Campos desconocidos: {', '.join(desconocidos)}"
+    filtros = _filtros_precio()
+    if filtros["unidad"] not in UNIDADES_PRECIO:
+        return 400, f"Unidad no soportada: {filtros['unidad']}"
+    items, siguiente = buscar_precios_para(user, filtros, despues=request.args.get("despues"),
+                                           limite=tamano_pagina())
+    return {
+        "resultados": [{c: i.get(c) for c in campos} for i in items],
+        "siguiente": siguiente,
+    }
+
+@app.route("/api/v1/empresas/<username>")
+@api_v1
+def api_empresa(user, username):
+    """Ficha pública de una empresa, si el usuario puede verla."""
+    campos, desconocidos = _proyeccion_api(CAMPOS_EMPRESA_API)
+    if desconocidos:
+        return 400, f"Campos desconocidos: {', '.join(desconocidos)}"
+    c = USERS.por_username(username.strip())
+    if not c or not puede_ver_publicacion(user, {"rol": c["rol"], "tipo": c["tipo"]}):
+        return 404, "Empresa no encontrada"
+    return {campo: c.get(campo) for campo in campos}
+
+# ---------------------------------------------------------
+# 📦 IMPORTACIÓN Y EXPORTACIÓN MASIVA (CSV / NDJSON)
+# ---------------------------------------------------------
+# POST /importar/<destino> (archivo en el campo "archivo" o el cuerpo tal cual)
+# y `flask importar`: las filas se leen en streaming, se validan con las mismas
+# reglas que /publicar y las publicaciones se aplican en lotes de
+# WS_IMPORTAR_LOTE, con una sola actualización de índices y cachés por lote. El
+# catálogo es un solo registro: se guarda e indexa una vez al final. GET /exportar/<conjunto> y
+# `flask exportar` generan el volcado registro a registro.
+app.config["IMPORTAR_LOTE"] = int(os.environ.get("WS_IMPORTAR_LOTE", 500))
+DESTINOS_IMPORTACION = ("publicaciones", "items")
+FORMATOS_MASIVOS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+MAX_ERRORES_INFORME = 100
+EXPORTAR_TROZO = 64 * 1024
+
+ERRORES_IMPORTACION = dict(ERRORES_PUBLICACION, **{
+    "json": ("JSON inválido", "Invalid JSON", "JSON 無效"),
+    "objeto": ("Se esperaba un objeto JSON", "A JSON object was expected", "應為 JSON 物件"),
+    "ajena": ("El id pertenece a otra empresa", "The id belongs to another company", "此 ID 屬於其他公司"),
+    "sin_nombre": ("Falta el nombre del ítem", "The item name is missing", "缺少項目名稱"),
+})
+
+def formato_masivo(explicito, mimetype, nombre):
+    """'csv', 'ndjson' o None según el parámetro, el tipo MIME o la extensión."""
+    if explicito:
+        return explicito if explicito in FORMATOS_MASIVOS else None
+    nombre = (nombre or "").lower()
+    if mimetype in ("application/x-ndjson", "application/jsonl") or nombre.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if mimetype == "text/csv" or nombre.endswith(".csv"):
+        return "csv"
+    return None
+
+def _normalizar_fila(fila):
+    return {str(k).strip().lower(): "" if v is None else str(v).strip()
+            for k, v in fila.items() if k is not None and not isinstance(v, (list, dict))}
+
+def leer_filas(flujo, formato):
+    """(n° de fila, dict normalizado o clave de error) leídos de un flujo binario."""
+    texto = io.TextIOWrapper(flujo, encoding="utf-8-sig", newline="")
+    if formato == "ndjson":
+        for numero, linea in enumerate(texto, 1):
+            if not linea.strip():
+                continue
+            try:
+                fila = json.loads(linea)
+            except ValueError:
+                yield numero, "json"
+                continue
+            yield numero, _normalizar_fila(fila) if isinstance(fila, dict) else "objeto"
+        return
+    primera = texto.readline()
+    try:
+        dialecto = csv.Sniffer().sniff(primera, delimiters=",;\t")
+    except csv.Error:
+        dialecto = csv.excel
+    # Planillas en español suelen venir separadas por ';'
+    for numero, fila in enumerate(csv.DictReader(chain([primera], texto), dialect=dialecto), 2):
+        yield numero, _normalizar_fila(fila)
+
+def _aplicar_publicaciones(lote):
+    pubs = list(lote.values())
+    with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura():
+        pubs = PUBLICACIONES.agregar_lote(pubs)
+        for pub in pubs:
+            INDICE_BUSQUEDA.indexar_publicacion(pub)
+            INDICE_PRECIOS.indexar_publicacion(pub)
+    FRAGMENTOS.invalidar()
+    if any(pub.vence is not None for pub in pubs):
+        BARREDOR.avisar()
+
+def _aplicar_items(user, items):
+    """Guarda una copia de `user` con esos ítems y la indexa; devuelve el usuario guardado."""
+    with INDICE_BUSQUEDA.escritura(), INDICE_PRECIOS.escritura(), DIRECTORIO.escritura():
+        user = USERS.guardar(dict(user, items=items))
+        INDICE_BUSQUEDA.indexar_usuario(user)
+        INDICE_PRECIOS.indexar_usuario(user)
+        DIRECTORIO.actualizar(user)
+    return user
+
+def importar_filas(user, destino, filas, reemplazar=False, traducir=None):
+    """
+    Aplica las filas de leer_filas() a las publicaciones del usuario o a su
+    catálogo (items; `reemplazar` descarta el catálogo anterior). Devuelve el
+    informe {"aceptadas", "rechazadas", "errores": [{"fila", "error"}]}.
+    """
+    traducir = traducir or (lambda es, en=None, zh=None: es)
+    tamano_lote = app.config["IMPORTAR_LOTE"]
+    informe = {"destino": destino, "aceptadas": 0, "rechazadas": 0, "errores": []}
+    lote = {}
+    items = [] if reemplazar else list(user.get("items") or [])
+
+    for numero, fila in filas:
+        error = fila if isinstance(fila, str) else None
+        if error is None and destino == "publicaciones":
+            fila.setdefault("categoria", fila.get("tipo_publicacion"))
+            pub, error = construir_publicacion(user, fila)
+            if pub is not None and fila.get("id"):
+                existente = PUBLICACIONES.get(fila["id"])
+                if existente is not None and existente.get("usuario") != user["email"]:
+                    error = "ajena"
+                pub["id"] = fila["id"]
+        elif error is None:
+            if not fila.get("nombre"):
+                error = "sin_nombre"
+            else:
+                # Id nuevo: uno derivado de la posición le cambiaría el producto y
+                # el precio a los carritos que tienen el ítem que estaba ahí
+                items.append({"id": nuevo_id_item(), "nombre": fila["nombre"],
+                              "detalle": fila.get("detalle", ""), "precio": fila.get("precio", "")})
+        if error is not None:
+            informe["rechazadas"] += 1
+            if len(informe["errores"]) < MAX_ERRORES_INFORME:
+                informe["errores"].append({"fila": numero, "error": traducir(*ERRORES_IMPORTACION[error])})
+            continue
+
+        informe["aceptadas"] += 1
+        if destino == "publicaciones":
+            lote[pub["id"]] = pub  # un id repetido dentro del lote: gana la última fila
+            if len(lote) >= tamano_lote:
+                _aplicar_publicaciones(lote)
+                lote = {}
+
+    if destino == "publicaciones":
+        if lote:
+            _aplicar_publicaciones(lote)
+    elif informe["aceptadas"]:
+        # Guardar por lotes reescribiría y reindexaría el catálogo entero cada vez
+        _aplicar_items(user, items)
+    return informe
+
+@app.route("/importar/<destino>", methods=["POST"])
+def importar(destino):
+    user = get_user()
+    if not user:
+        return _error_api(401, "Autenticación requerida")
+    if destino not in DESTINOS_IMPORTACION:
+        return _error_api(404, "Destino desconocido")
+    if destino == "publicaciones" and not puede_publicar(user):
+        return _error_api(403, "Sin permiso para publicar")
+
+    # Solo se parsea el formulario si es multipart: si no, el cuerpo es el archivo
+    archivo = request.files.get("archivo") if request.mimetype == "multipart/form-data" else None
+    if archivo is not None:
+        flujo, formato = archivo.stream, formato_masivo(request.args.get("formato"),
+                                                        archivo.mimetype, archivo.filename)
+        flujo.seek(0)
+    else:
+        flujo, formato = request.stream, formato_masivo(request.args.get("formato"), request.mimetype, "")
+    if formato is None:
+        return _error_api(415, "Formato no soportado: usa CSV o NDJSON")
+
+    reemplazar = request.args.get("reemplazar") in ("1", "true", "si")
+    informe = importar_filas(user, destino, leer_filas(flujo, formato), reemplazar, traducir=t)
+    return jsonify(informe), 200 if informe["aceptadas"] or not informe["rechazadas"] else 422
+
+CAMPOS_EXPORTACION = {
+    "publicaciones": CAMPOS_PUBLICACION_API,
+    "empresas": CAMPOS_EMPRESA_API,
+    "mensajes": ("id", "origen", "destino", "contenido", "fecha", "ts"),
+}
+
+def _registros_exportacion(conjunto):
+    # Los tres recorridos son perezosos en ambos backends
+    if conjunto == "publicaciones":
+        return PUBLICACIONES.recorrer()
+    if conjunto == "empresas":
+        return USERS.por_empresa()
+    return MENSAJES.recorrer()
+
+def _celda_csv(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, (list, dict)):
+        return json.dumps(valor, ensure_ascii=False)
+    valor = str(valor)
+    # Evita que una planilla interprete el texto como fórmula
+    return "'" + valor if valor[:1] in ("=", "+", "-", "@") else valor
+
+def exportar_registros(conjunto, formato):
+    """Genera el volcado en trozos de ~EXPORTAR_TROZO sin cargar el conjunto en memoria."""
+    campos = CAMPOS_EXPORTACION[conjunto]
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer) if formato == "csv" else None
+    if escritor is not None:
+        escritor.writerow(campos)
+    for registro in _registros_exportacion(conjunto):
+        if escritor is not None:
+            escritor.writerow([_celda_csv(registro.get(c)) for c in campos])
+        else:
+            buffer.write(json.dumps({c: registro.get(c) for c in campos}, ensure_ascii=False))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORTAR_TROZO:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@app.route("/exportar/<conjunto>")
+def exportar(conjunto):
+    user = get_user()
+    if not user:
+        return _error_api(401, "Autenticación requerida")
+    if user.get("rol") != "Administrador":
+        return _error_api(403, "Solo administradores")
+    if conjunto not in CAMPOS_EXPORTACION:
+        return _error_api(404, "Conjunto desconocido")
+    formato = request.args.get("formato", "csv")
+    if formato not in FORMATOS_MASIVOS:
+        return _error_api(400, "Formato no soportado: usa csv o ndjson")
+
+    nombre = f"ws-{conjunto}-{datetime.now():%Y%m%d}.{formato}"
+    return app.response_class(exportar_registros(conjunto, formato),
+                              mimetype=FORMATOS_MASIVOS[formato],
+                              headers={"Content-Disposition": f"attachment; filename={nombre}",
+                                       "Cache-Control": "no-store"})
+
+@app.cli.command("importar")
+@click.argument("archivo", type=click.File("rb"))
+@click.option("--usuario", required=True, help="Email de la empresa dueña de las filas.")
+@click.option("--destino", type=click.Choice(DESTINOS_IMPORTACION), default="publicaciones", show_default=True)
+@click.option("--formato", type=click.Choice(list(FORMATOS_MASIVOS)), default=None,
+              help="Por defecto según la extensión del archivo.")
+@click.option("--reemplazar", is_flag=True, help="Con --destino items: reemplaza el catálogo.")
+def importar_cli(archivo, usuario, destino, formato, reemplazar):
+    """Importa publicaciones o ítems de catálogo desde CSV / NDJSON ('-' = stdin)."""
+    user = USERS.get(usuario.strip().lower())
+    if user is None:
+        raise click.BadParameter(f"No existe el usuario {usuario}", param_hint="--usuario")
+    formato = formato_masivo(formato, None, archivo.name)
+    if formato is None:
+        raise click.UsageError("No se pudo deducir el formato: usa --formato csv|ndjson")
+    informe = importar_filas(user, destino, leer_filas(archivo, formato), reemplazar)
+    for error in informe["errores"]:
+        click.echo(f"fila {error['fila']}: {error['error']}", err=True)
+    click.echo(f"{informe['aceptadas']} aceptadas · {informe['rechazadas']} rechazadas")
+
+@app.cli.command("exportar")
+@click.argument("conjunto", type=click.Choice(list(CAMPOS_EXPORTACION)))
+@click.option("--formato", type=click.Choice(list(FORMATOS_MASIVOS)), default="csv", show_default=True)
+@click.option("--salida", type=click.File("w", encoding="utf-8"), default="-", show_default=True)
+def exportar_cli(conjunto, formato, salida):
+    """Vuelca publicaciones, empresas o mensajes a CSV / NDJSON."""
+    for trozo in exportar_registros(conjunto, formato):
+        salida.write(trozo)
+
 # ---------------------------------------------------------
 # 💡 PÁGINAS INFORMATIVAS / STATUS
 # ---------------------------------------------------------
+def _pagina_ayuda_anonima():
+    return render_template("ayuda.html", titulo=t("Centro de Ayuda"))
+
 @app.route("/ayuda")
 def ayuda():
     user = get_user()
     if not user:
-        return render_template("ayuda.html", titulo=t("Centro de Ayuda"))
+        return servir_estatica("ayuda") or _pagina_ayuda_anonima()
     # Redirige correctamente al dashboard correspondiente
     return render_template(
         "ayuda.html",
@@ -1305,9 +5309,12 @@ def ayuda():
         volver=url_for(puede_mostrar_dashboard(user))
     )
 
+def _pagina_acerca():
+    return render_template("acerca.html", titulo=t("Acerca de Window Shopping"))
+
 @app.route("/acerca")
 def acerca():
-    return render_template("acerca.html", titulo=t("Acerca de Window Shopping"))
+    return servir_estatica("acerca") or _pagina_acerca()
 
 @app.route("/status")
 def status():
@@ -1319,6 +5326,269 @@ def status():
         "estado": "OK ✅"
     }
     return jsonify(estado)
+# ---------------------------------------------------------
+# 📈 MÉTRICAS (formato de texto de Prometheus en /metrics)
+# ---------------------------------------------------------
+# Cada worker acumula en memoria contadores e histogramas por endpoint (un lock
+# y unas cuantas sumas por petición); los gauges de los almacenes se calculan
+# solo cuando alguien consulta /metrics. Con varios workers (WS_MODO=compartido
+# o WS_METRICAS_DB) cada uno vuelca su instantánea a SQLite como mucho cada
+# WS_METRICAS_INTERVALO segundos y /metrics suma las del mismo gunicorn.
+app.config["METRICAS_DB"] = os.environ.get("WS_METRICAS_DB",
+                                           app.config["SESSION_DB"] if MODO_COMPARTIDO else "")
+app.config["METRICAS_INTERVALO"] = float(os.environ.get("WS_METRICAS_INTERVALO", 5))
+app.config["METRICAS_TOKEN"] = os.environ.get("WS_METRICAS_TOKEN", "")
+
+BUCKETS_DURACION = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+BUCKETS_COOKIE = (32, 64, 128, 256, 512, 1024, 4096)
+
+# nombre -> (tipo, ayuda, buckets o None)
+DEFINICION_METRICAS = {
+    "ws_peticiones_total": ("counter", "Peticiones atendidas por endpoint, método y estado.", None),
+    "ws_peticion_duracion_segundos": ("histogram", "Latencia por endpoint y método.", BUCKETS_DURACION),
+    "ws_respuesta_bytes": ("histogram", "Tamaño del cuerpo de la respuesta por endpoint.", BUCKETS_BYTES),
+    "ws_cookie_sesion_bytes": ("histogram", "Tamaño de la cookie de sesión recibida.", BUCKETS_COOKIE),
+    "ws_peticiones_en_curso": ("gauge", "Peticiones en curso (workers vivos).", None),
+    "ws_almacen_elementos": ("gauge", "Elementos en cada almacén de datos.", None),
+    "ws_workers": ("gauge", "Workers que aportan a estas métricas.", None),
+}
+
+
+class Metricas:
+    """Contadores e histogramas del proceso; se combinan por suma entre workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = {}    # (nombre, etiquetas) -> valor
+        self.histogramas = {}   # (nombre, etiquetas) -> [conteos por bucket..., +Inf, suma]
+        self.en_curso = 0
+        self.cambios = 0
+
+    def contar(self, nombre, etiquetas, valor=1):
+        with self._lock:
+            clave = (nombre, etiquetas)
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+            self.cambios += 1
+
+    def observar(self, nombre, etiquetas, valor):
+        buckets = DEFINICION_METRICAS[nombre][2]
+        with self._lock:
+            clave = (nombre, etiquetas)
+            h = self.histogramas.get(clave)
+            if h is None:
+                h = self.histogramas[clave] = [0] * (len(buckets) + 2)
+            h[bisect_left(buckets, valor)] += 1
+            h[-1] += valor
+            self.cambios += 1
+
+    def entrar(self):
+        with self._lock:
+            self.en_curso += 1
+
+    def salir(self):
+        with self._lock:
+            self.en_curso -= 1
+
+    def instantanea(self):
+        with self._lock:
+            return {
+                "c": [[n, list(e), v] for (n, e), v in self.contadores.items()],
+                "h": [[n, list(e), list(h)] for (n, e), h in self.histogramas.items()],
+                "en_curso": self.en_curso,
+            }
+
+
+def combinar_instantaneas(instantaneas):
+    """Suma instantáneas de varios workers en (contadores, histogramas, en_curso)."""
+    contadores, histogramas, en_curso = {}, {}, 0
+    for inst, vivo in instantaneas:
+        for n, e, v in inst["c"]:
+            clave = (n, tuple(map(tuple, e)))
+            contadores[clave] = contadores.get(clave, 0) + v
+        for n, e, h in inst["h"]:
+            clave = (n, tuple(map(tuple, e)))
+            previo = histogramas.get(clave)
+            histogramas[clave] = h if previo is None else [a + b for a, b in zip(previo, h)]
+        if vivo:
+            en_curso += inst["en_curso"]
+    return contadores, histogramas, en_curso
+
+
+class MetricasSQLite:
+    """
+    Instantáneas por worker en SQLite. El grupo es el pid del padre (el maestro
+    de gunicorn): se suman los workers del mismo grupo, también los que ya
+    terminaron, y se descartan grupos cuyo maestro ya no existe.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = _LocalDelHilo()
+        with self._conexion() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS metricas ("
+                        "grupo INTEGER NOT NULL, pid INTEGER NOT NULL, ts REAL NOT NULL, "
+                        "datos TEXT NOT NULL, PRIMARY KEY (grupo, pid))")
+
+    def _conexion(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = sqlite3.connect(self.ruta, timeout=10)
+        return con
+
+    def volcar(self, instantanea):
+        con = self._conexion()
+        with con:
+            con.execute("INSERT OR REPLACE INTO metricas (grupo, pid, ts, datos) VALUES (?, ?, ?, ?)",
+                        (os.getppid(), os.getpid(), time.time(), json.dumps(instantanea)))
+
+    def leer(self):
+        """[(instantánea, vivo)] del grupo actual."""
+        con = self._conexion()
+        grupo = os.getppid()
+        resultado = []
+        muertos = set()
+        for otro_grupo, pid, datos in con.execute("SELECT grupo, pid, datos FROM metricas").fetchall():
+            if otro_grupo != grupo:
+                if not _proceso_vivo(otro_grupo):
+                    muertos.add(otro_grupo)
+                continue
+            resultado.append((json.loads(datos), _proceso_vivo(pid)))
+        if muertos:
+            with con:
+                con.executemany("DELETE FROM metricas WHERE grupo = ?", [(g_,) for g_ in muertos])
+        return resultado
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # existe pero es de otro usuario
+    return True
+
+
+METRICAS = Metricas()
+METRICAS_COMPARTIDAS = MetricasSQLite(app.config["METRICAS_DB"]) if app.config["METRICAS_DB"] else None
+_proximo_volcado = [0.0]
+
+def iniciar_medicion():
+    g.inicio_medicion = time.perf_counter()
+    METRICAS.entrar()
+    cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+    if cookie is not None:
+        METRICAS.observar("ws_cookie_sesion_bytes", (), len(cookie))
+
+# Primera en ejecutarse: la latencia incluye los demás before_request
+app.before_request_funcs.setdefault(None, []).insert(0, iniciar_medicion)
+
+@app.after_request
+def registrar_medicion(response):
+    inicio = g.get("inicio_medicion")
+    if inicio is not None:
+        endpoint = request.endpoint or "sin_ruta"
+        METRICAS.observar("ws_peticion_duracion_segundos", (("endpoint", endpoint), ("metodo", request.method)),
+                          time.perf_counter() - inicio)
+        METRICAS.contar("ws_peticiones_total", (("endpoint", endpoint), ("metodo", request.method),
+                                                ("estado", str(response.status_code))))
+        # Las respuestas en streaming (p.ej. /eventos) no se consumen para medirlas
+        tamano = response.calculate_content_length() if response.is_sequence else response.content_length
+        if tamano is not None:
+            METRICAS.observar("ws_respuesta_bytes", (("endpoint", endpoint),), tamano)
+    return response
+
+@app.teardown_request
+def cerrar_medicion(exc):
+    if g.pop("inicio_medicion", None) is None:
+        return
+    METRICAS.salir()
+    if METRICAS_COMPARTIDAS is not None and time.monotonic() >= _proximo_volcado[0]:
+        _proximo_volcado[0] = time.monotonic() + app.config["METRICAS_INTERVALO"]
+        try:
+            METRICAS_COMPARTIDAS.volcar(METRICAS.instantanea())
+        except sqlite3.Error:
+            app.logger.exception("No se pudieron volcar las métricas")
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ""
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        partes.append(f'{clave}="{valor}"')
+    return "{" + ",".join(partes) + "}"
+
+def _numero_prometheus(valor):
+    if isinstance(valor, float):
+        return "+Inf" if valor == math.inf else repr(valor)
+    return str(valor)
+
+def texto_prometheus(contadores, histogramas, gauges):
+    """Formato de exposición de texto 0.0.4."""
+    lineas = []
+    por_nombre = {}
+    for (nombre, etiquetas), valor in contadores.items():
+        por_nombre.setdefault(nombre, []).append((etiquetas, valor))
+    for (nombre, etiquetas), valor in gauges.items():
+        por_nombre.setdefault(nombre, []).append((etiquetas, valor))
+    for (nombre, etiquetas), h in histogramas.items():
+        por_nombre.setdefault(nombre, []).append((etiquetas, h))
+
+    for nombre, (tipo, ayuda, buckets) in DEFINICION_METRICAS.items():
+        series = por_nombre.get(nombre)
+        if not series:
+            continue
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        for etiquetas, valor in sorted(series, key=itemgetter(0)):
+            if tipo != "histogram":
+                lineas.append(f"{nombre}{_etiquetas_prometheus(etiquetas)} {_numero_prometheus(valor)}")
+                continue
+            acumulado = 0
+            for limite, conteo in zip(buckets + (math.inf,), valor):
+                acumulado += conteo
+                le = etiquetas + (("le", _numero_prometheus(float(limite))),)
+                lineas.append(f"{nombre}_bucket{_etiquetas_prometheus(le)} {acumulado}")
+            lineas.append(f"{nombre}_sum{_etiquetas_prometheus(etiquetas)} {_numero_prometheus(float(valor[-1]))}")
+            lineas.append(f"{nombre}_count{_etiquetas_prometheus(etiquetas)} {acumulado}")
+    return "\n".join(lineas) + "\n"
+
+@app.route("/metrics")
+def metricas():
+    token = app.config["METRICAS_TOKEN"]
+    if token and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return app.response_class("no autorizado\n", 401, {"WWW-Authenticate": "Bearer"},
+                                  mimetype="text/plain")
+
+    propia = METRICAS.instantanea()
+    propia["en_curso"] -= 1  # esta misma petición no cuenta
+    if METRICAS_COMPARTIDAS is not None:
+        METRICAS_COMPARTIDAS.volcar(propia)
+        _proximo_volcado[0] = time.monotonic() + app.config["METRICAS_INTERVALO"]
+        instantaneas = METRICAS_COMPARTIDAS.leer()
+    else:
+        instantaneas = [(propia, True)]
+    contadores, histogramas, en_curso = combinar_instantaneas(instantaneas)
+
+    # Con SQLite los almacenes son los mismos para todos: se miden una sola vez aquí
+    gauges = {
+        ("ws_peticiones_en_curso", ()): en_curso,
+        ("ws_workers", (("estado", "vivo"),)): sum(1 for _, vivo in instantaneas if vivo),
+        ("ws_workers", (("estado", "terminado"),)): sum(1 for _, vivo in instantaneas if not vivo),
+    }
+    for almacen, store in (("usuarios", USERS), ("publicaciones", PUBLICACIONES),
+                           ("mensajes", MENSAJES), ("empresas_ocultas", HIDDEN_COMPANIES),
+                           ("carritos", CARRITOS)):
+        gauges[("ws_almacen_elementos", (("almacen", almacen),))] = len(store)
+
+    response = app.response_class(texto_prometheus(contadores, histogramas, gauges),
+                                  content_type="text/plain; version=0.0.4; charset=utf-8")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
 # =========================================================
 # 🚀 Parte 5 · Cierre Final y Ejecución del Servidor Flask
 # =========================================================
@@ -1337,21 +5607,97 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # ---------------------------------------------------------
 # 🪪 MANEJO DE ERRORES BÁSICOS
 # ---------------------------------------------------------
-@app.errorhandler(404)
-def error_404(e):
+def _pagina_404():
     return render_template("error.html",
                            titulo=t("Página no encontrada"),
                            mensaje=t("La página solicitada no existe.",
                                      "The requested page does not exist.",
-                                     "找不到請求的頁面")), 404
+                                     "找不到請求的頁面"))
 
-@app.errorhandler(500)
-def error_500(e):
+def _pagina_500():
     return render_template("error.html",
                            titulo=t("Error interno del servidor"),
                            mensaje=t("Ha ocurrido un error inesperado.",
                                      "An unexpected error occurred.",
-                                     "發生意外錯誤")), 500
+                                     "發生意外錯誤"))
+
+@app.errorhandler(413)
+def error_413(e):
+    limite_mb = round(app.config["MAX_CONTENT_LENGTH"] / (1024 * 1024), 1)
+    flash(t("El archivo supera el tamaño máximo permitido",
+            "The file exceeds the maximum allowed size", "文件超过允许的最大大小")
+          + f" ({limite_mb:g} MB)", "error")
+    return redirect(request.referrer or url_for("register_router"))
+
+@app.errorhandler(404)
+def error_404(e):
+    return servir_estatica("404", 404) or (_pagina_404(), 404)
+
+@app.errorhandler(500)
+def error_500(e):
+    return servir_estatica("500", 500) or (_pagina_500(), 500)
+
+# ---------------------------------------------------------
+# 🧱 PÁGINAS PRE-RENDERIZADAS POR IDIOMA
+# ---------------------------------------------------------
+# Para visitantes anónimos sin mensajes flash pendientes estas páginas sólo
+# dependen del idioma: se renderizan al arrancar (bytes + variante gzip) y se
+# sirven sin pasar por Jinja ni t().
+PAGINAS_PRERENDER = {
+    "home": _pagina_home,
+    "acerca": _pagina_acerca,
+    "ayuda": _pagina_ayuda_anonima,
+    "404": _pagina_404,
+    "500": _pagina_500,
+}
+PAGINAS_ESTATICAS = {}  # (nombre, lang) -> (html, html_gzip, etag)
+
+def prerenderizar_paginas():
+    paginas = {}
+    for lang in LANGS:
+        with app.test_request_context("/"):
+            g.lang, g.t = lang, TRADUCTORES[lang]
+            session["lang"] = lang  # base.html lo lee para <html lang> y el selector
+            for nombre, renderizar in PAGINAS_PRERENDER.items():
+                html = renderizar().encode("utf-8")
+                etag = hashlib.blake2b(html, digest_size=16).hexdigest()
+                paginas[(nombre, lang)] = (html, gzip.compress(html, compresslevel=9, mtime=0), etag)
+    PAGINAS_ESTATICAS.clear()
+    PAGINAS_ESTATICAS.update(paginas)
+    return len(paginas)
+
+def servir_estatica(nombre, estado=200):
+    """Respuesta pre-renderizada, o None si la petición necesita render normal."""
+    if session.get("user_key") or "_flashes" in session:
+        return None
+    pagina = PAGINAS_ESTATICAS.get((nombre, g.get("lang", "es")))
+    if pagina is None:
+        return None
+    html, comprimido, etag = pagina
+
+    resp = app.response_class(status=estado, mimetype="text/html")
+    resp.vary.update(("Cookie", "Accept-Encoding"))
+    resp.headers["Cache-Control"] = "public, no-cache"
+    usar_gzip = request.accept_encodings["gzip"] > 0
+    resp.set_etag(etag + "-gz" if usar_gzip else etag)
+    if estado == 200 and request.if_none_match.contains(resp.get_etag()[0]):
+        resp.status_code = 304
+        return resp
+    if usar_gzip:
+        resp.headers["Content-Encoding"] = "gzip"
+    resp.set_data(comprimido if usar_gzip else html)
+    return resp
+
+prerenderizar_paginas()
+
+# ---------------------------------------------------------
+# 🛠️ HERRAMIENTAS DE LA CLI
+# ---------------------------------------------------------
+# generar-datos, bench, estres, instantanea, etc. viven en herramientas.py y se
+# registran en app.cli sólo cuando corre el comando flask: el servidor no las
+# importa.
+if os.environ.get("FLASK_RUN_FROM_CLI") == "true":
+    import herramientas  # noqa: F401
 
 # ---------------------------------------------------------
 # 🧭 FUNCIÓN AUXILIAR PARA ARRANQUE LIMPIO
@@ -0,0 +1,726 @@
+# =========================================================
+# 🛠️ WINDOW SHOPPING — Herramientas de la CLI
+# ---------------------------------------------------------
+# Datos sintéticos, benchmarks, prueba de estrés, verificación de la matriz
+# de visibilidad e instantáneas del diario. No es parte del servidor: app.py
+# carga este módulo sólo cuando corre el comando flask.
+# =========================================================
+from collections import Counter
+from datetime import datetime
+from itertools import chain
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import click
+
+from flask import g, session
+
+from app import (
+    app, CATEGORIAS_PUBLICACION, DIARIO, FORMATO_FECHA, LANGS, MENSAJES,
+    Mensaje, PUBLICACIONES, Publicacion, SUBTIPOS_PUBLICACION, TIPOS_ROLES, TRANSLATIONS, USERS,
+    _puede_ver_publicacion_reglas, _vocabulario_visibilidad, campos_precio, construir_publicacion,
+    dashboard_compra, escribir_instantanea, opciones_publicacion, puede_publicar,
+    puede_ver_publicacion,
+)
+
+# ---------------------------------------------------------
+# 🌐 TRADUCCIONES EN LÍNEA VS COMPILADAS
+# ---------------------------------------------------------
+@app.cli.command("bench-traducciones")
+@click.option("--n", default=300, show_default=True, help="Renders por idioma y modo.")
+def bench_traducciones(n):
+    """Tiempo de render completo de dashboard_compra con t() en línea vs compilado."""
+    def t_en_linea(text, en=None, zh=None):
+        # Implementación anterior: lee la sesión y ramifica en cada llamada
+        lang = session.get("lang", "es")
+        if lang == "es":
+            return text
+        if en or zh:
+            if lang == "en" and en:
+                return en
+            if lang == "zh" and zh:
+                return zh
+        if text in TRANSLATIONS:
+            return TRANSLATIONS[text].get(lang, text)
+        return text
+
+    email = next(e for e, u in USERS.items() if u["tipo"] == "compraventa")
+    for lang in LANGS:
+        with app.test_request_context("/dashboard_compra"):
+            session["user_key"] = email
+            session["lang"] = lang
+            app.preprocess_request()
+            compilado = g.t
+            tiempos = {}
+            for modo, traductor in (("en línea", t_en_linea), ("compilado", compilado)):
+                g.t = traductor
+                dashboard_compra()
+                inicio = time.perf_counter()
+                for _ in range(n):
+                    dashboard_compra()
+                tiempos[modo] = (time.perf_counter() - inicio) / n * 1e6
+        click.echo(f"{lang}: en línea {tiempos['en línea']:.1f} µs · "
+                   f"compilado {tiempos['compilado']:.1f} µs por render")
+
+# ---------------------------------------------------------
+# 👁️ MATRIZ DE VISIBILIDAD
+# ---------------------------------------------------------
+# flask bench-visibilidad → ns por llamada de la matriz y de las reglas, con
+# dicts y con los registros Publicacion del almacén. Que ambas digan lo mismo
+# lo comprueba tests/test_visibilidad.py.
+@app.cli.command("bench-visibilidad")
+@click.option("--n", default=200000, show_default=True, help="Llamadas por medición.")
+@click.option("--repeticiones", default=5, show_default=True, help="Se informa la mejor.")
+def bench_visibilidad(n, repeticiones):
+    """Micro-benchmark de puede_ver_publicacion: matriz vs reglas."""
+    tipos, roles = _vocabulario_visibilidad()
+    usuarios = list(USERS.values())
+    pubs = [{"tipo": tp, "rol": rp, "subtipo": st, "categoria": ct, "servicio_objetivo": rp}
+            for tp in tipos for rp in roles
+            for st in SUBTIPOS_PUBLICACION for ct in CATEGORIAS_PUBLICACION]
+    pares = [(usuarios[i % len(usuarios)], pubs[i % len(pubs)]) for i in range(n)]
+    registros = [(u, Publicacion.desde(p)) for u, p in pares]
+    for entrada, lista in (("dict", pares), ("Publicacion", registros)):
+        for nombre, fn in (("reglas", _puede_ver_publicacion_reglas), ("matriz", puede_ver_publicacion)):
+            mejor = float("inf")
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                for u, p in lista:
+                    fn(u, p)
+                mejor = min(mejor, time.perf_counter() - inicio)
+            click.echo(f"{entrada:>11} {nombre:>7}: {mejor / n * 1e9:8.1f} ns/llamada")
+
+# ---------------------------------------------------------
+# 📏 BENCHMARK DE CARGA Y LATENCIA POR RUTA
+# ---------------------------------------------------------
+# flask generar-datos → llena los almacenes configurados con datos sintéticos.
+# flask bench         → mide las rutas en proceso (test client) o contra un
+#                       gunicorn local, y guarda el resultado en JSON.
+# Con WS_STORAGE=sqlite los datos quedan en WS_DB y gunicorn los lee de ahí.
+_PRODUCTOS_BENCH = ["Cereza", "Uva de mesa", "Arándano", "Manzana", "Kiwi",
+                    "Ciruela", "Palta", "Nectarín", "Pera", "Limón"]
+_SERVICIOS_BENCH = ["Flete refrigerado", "Almacenaje en frío", "Embalaje",
+                    "Tramitación aduanera", "Consolidado en puerto"]
+_NOMBRES_BENCH = ["Agrícola", "Frutícola", "Exportadora", "Logística", "Comercial",
+                  "Valle", "Andes", "Pacífico", "Sur", "Norte"]
+_EPOCH_BENCH = 1760000000  # base fija: mismas fechas en cada corrida
+_DIAS_BENCH = 90
+
+def _fecha_bench(ts):
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(ts))
+
+def generar_datos_sinteticos(empresas, publicaciones, mensajes, semilla=1, avance=None):
+    """
+    Empresas repartidas en todas las combinaciones de TIPOS_ROLES, publicaciones
+    coherentes con opciones_publicacion() y mensajes entre empresas, en orden
+    cronológico. Determinista para una misma semilla; devuelve los emails creados.
+    """
+    rnd = random.Random(semilla)
+    perfiles = [(tipo, rol) for tipo, roles in TIPOS_ROLES.items() for rol in roles]
+    avance = avance or (lambda etapa, hechos: None)
+
+    usuarios = []
+    for i in range(empresas):
+        tipo, rol = perfiles[i % len(perfiles)]
+        nombre = f"{rnd.choice(_NOMBRES_BENCH)} {rnd.choice(_NOMBRES_BENCH)} {i}"
+        info = {
+            "nombre": nombre,
+            "email": f"bench{i}@bench.ws",
+            "password": "bench",
+            "tipo": tipo,
+            "rol": rol,
+            "empresa": nombre,
+            "descripcion": f"{rol} de {rnd.choice(_PRODUCTOS_BENCH).lower()}",
+            "fecha": _fecha_bench(_EPOCH_BENCH - rnd.randrange(_DIAS_BENCH * 86400)),
+            "username": f"bench{i}",
+            "pais": "CN" if tipo == "extranjero" else "CL",
+            "direccion": "",
+            "telefono": "",
+            "rut_doc": "",
+            "items": [{"nombre": p, "detalle": "Calibre exportación",
+                       "precio": f"USD {rnd.randint(2, 12)}/kg"}
+                      for p in rnd.sample(_PRODUCTOS_BENCH, rnd.randint(0, 3))],
+        }
+        usuarios.append(USERS.guardar(info))
+        avance("empresas", i + 1)
+
+    paso = _DIAS_BENCH * 86400 / max(publicaciones, 1)
+    for i in range(publicaciones if usuarios else 0):
+        autor = rnd.choice(usuarios)
+        subtipos, categorias = opciones_publicacion(autor["tipo"])
+        categoria = rnd.choice(categorias)
+        producto = rnd.choice(_SERVICIOS_BENCH if categoria == "servicio" else _PRODUCTOS_BENCH)
+        precio = f"USD {rnd.randint(1, 15)}/kg" if rnd.random() < 0.8 else "Consultar"
+        PUBLICACIONES.agregar({
+            "id": f"pub_bench{i}",
+            "usuario": autor["email"],
+            "empresa": autor["empresa"],
+            "rol": autor["rol"],
+            "tipo": autor["tipo"],
+            "subtipo": rnd.choice(subtipos),
+            "categoria": categoria,
+            "producto": producto,
+            "descripcion": f"{producto} temporada {2024 + rnd.randint(0, 1)}",
+            "precio": precio,
+            **campos_precio(precio),
+            "servicio_objetivo": rnd.choice(perfiles)[1] if categoria == "servicio" else None,
+            "ts": _EPOCH_BENCH - _DIAS_BENCH * 86400 + int(i * paso),
+        })
+        avance("publicaciones", i + 1)
+
+    paso = _DIAS_BENCH * 86400 / max(mensajes, 1)
+    for i in range(mensajes if len(usuarios) > 1 else 0):
+        origen, destino = rnd.sample(usuarios, 2)
+        ts = _EPOCH_BENCH - _DIAS_BENCH * 86400 + int(i * paso)
+        MENSAJES.agregar({
+            "origen": origen["email"],
+            "destino": destino["email"],
+            "contenido": f"Hola, nos interesa {rnd.choice(_PRODUCTOS_BENCH).lower()}",
+            "ts": ts,
+        })
+        avance("mensajes", i + 1)
+    return [u["email"] for u in usuarios]
+
+
+# ruta -> (método, plantilla de URL, tipo de usuario que la usa o None = cualquiera)
+RUTAS_BENCH = {
+    "dashboard_compra": ("GET", "/dashboard_compra", "compraventa"),
+    "dashboard_servicio": ("GET", "/dashboard_servicio", "servicio"),
+    "dashboard_mixto": ("GET", "/dashboard_mixto", "mixto"),
+    "dashboard_extranjero": ("GET", "/dashboard_extranjero", "extranjero"),
+    "clientes": ("GET", "/clientes?filtro={filtro}", None),
+    "mensajes": ("GET", "/mensajes", None),
+    "carrito_agregar": ("GET", "/carrito/agregar/{pub_id}", "compraventa"),
+    "publicar": ("POST", "/publicar", "compraventa"),
+}
+
+def _percentil(ordenadas, p):
+    if not ordenadas:
+        return None
+    return ordenadas[min(len(ordenadas) - 1, max(0, math.ceil(p / 100 * len(ordenadas)) - 1))]
+
+def _rss_pico_kb(pids=None):
+    """VmHWM (pico de RSS) en KB: de este proceso o el mayor entre `pids`."""
+    if pids is None:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pico = None
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for linea in f:
+                    if linea.startswith("VmHWM:"):
+                        pico = max(pico or 0, int(linea.split()[1]))
+        except OSError:
+            pass
+    return pico
+
+def _peticiones_bench(nombre, total, rnd, emails_por_tipo, pub_ids):
+    """[(método, url, email, formulario)] reproducibles para la ruta."""
+    metodo, plantilla, tipo = RUTAS_BENCH[nombre]
+    candidatos = emails_por_tipo.get(tipo) if tipo else emails_por_tipo[None]
+    peticiones = []
+    for i in range(total if candidatos else 0):
+        url = plantilla.format(filtro=rnd.choice(["", "venta", "compra", "servicio"]),
+                               pub_id=rnd.choice(pub_ids) if pub_ids else "x")
+        form = None
+        if nombre == "publicar":
+            form = {"subtipo": "oferta", "tipo_publicacion": "venta",
+                    "producto": rnd.choice(_PRODUCTOS_BENCH), "descripcion": "bench",
+                    "precio": f"USD {rnd.randint(1, 15)}/kg"}
+        peticiones.append((metodo, url, candidatos[i % len(candidatos)], form))
+    return peticiones
+
+def _medir_inproceso(peticiones, calentamiento):
+    clientes = {}
+    def cliente(email):
+        if email not in clientes:
+            c = clientes[email] = app.test_client()
+            c.post("/login", data={"email": email, "password": "bench"})
+        return clientes[email]
+
+    latencias, errores, agregados = [], 0, Counter()
+    inicio_total = None
+    for n, (metodo, url, email, form) in enumerate(peticiones):
+        c = cliente(email)
+        if n == calentamiento:
+            inicio_total = time.perf_counter()
+        inicio = time.perf_counter()
+        r = c.open(url, method=metodo, data=form)
+        duracion = time.perf_counter() - inicio
+        errores += r.status_code >= 400
+        if n >= calentamiento:
+            latencias.append(duracion)
+        if "/carrito/agregar/" in url:
+            agregados[email] += 1
+            if agregados[email] % 20 == 0:  # carrito acotado, fuera de la medición
+                c.post("/carrito/vaciar")
+    total = time.perf_counter() - inicio_total if inicio_total else 0
+    return latencias, errores, total, _rss_pico_kb()
+
+def _medir_http(peticiones, calentamiento, puerto, concurrencia, pids):
+    import http.client
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import urlencode
+
+    def pedir(metodo, url, cookie=None, form=None):
+        con = http.client.HTTPConnection("127.0.0.1", puerto, timeout=60)
+        cabeceras = {"Cookie": cookie} if cookie else {}
+        cuerpo = None
+        if form is not None:
+            cuerpo = urlencode(form)
+            cabeceras["Content-Type"] = "application/x-www-form-urlencoded"
+        inicio = time.perf_counter()
+        con.request(metodo, url, body=cuerpo, headers=cabeceras)
+        r = con.getresponse()
+        r.read()
+        duracion = time.perf_counter() - inicio
+        con.close()
+        return r, duracion
+
+    cookies = {}
+    for email in {p[2] for p in peticiones}:
+        r, _ = pedir("POST", "/login", form={"email": email, "password": "bench"})
+        cookies[email] = (r.getheader("Set-Cookie") or "").split(";")[0]
+
+    agregados, lock = Counter(), threading.Lock()
+    def una(peticion):
+        metodo, url, email, form = peticion
+        r, duracion = pedir(metodo, url, cookies[email], form)
+        if "/carrito/agregar/" in url:
+            with lock:
+                agregados[email] += 1
+                vaciar = agregados[email] % 20 == 0
+            if vaciar:  # igual que en proceso: carrito acotado, fuera de la medición
+                pedir("POST", "/carrito/vaciar", cookies[email])
+        return duracion, r.status >= 400
+
+    with ThreadPoolExecutor(concurrencia) as grupo:
+        list(grupo.map(una, peticiones[:calentamiento]))
+        inicio = time.perf_counter()
+        resultados = list(grupo.map(una, peticiones[calentamiento:]))
+        total = time.perf_counter() - inicio
+    return ([d for d, _ in resultados], sum(e for _, e in resultados), total, _rss_pico_kb(pids))
+
+@app.cli.command("generar-datos")
+@click.option("--empresas", default=1000, show_default=True)
+@click.option("--publicaciones", default=20000, show_default=True)
+@click.option("--mensajes", default=100000, show_default=True)
+@click.option("--semilla", default=1, show_default=True)
+def generar_datos(empresas, publicaciones, mensajes, semilla):
+    """Carga datos sintéticos en los almacenes configurados (WS_STORAGE / WS_DB)."""
+    inicio = time.perf_counter()
+    generar_datos_sinteticos(empresas, publicaciones, mensajes, semilla)
+    click.echo(f"{len(USERS)} usuarios · {len(PUBLICACIONES)} publicaciones · "
+               f"{len(MENSAJES)} mensajes ({time.perf_counter() - inicio:.1f} s)")
+
+@app.cli.command("bench")
+@click.option("--empresas", default=200, show_default=True, help="0 = usar los datos ya cargados.")
+@click.option("--publicaciones", default=2000, show_default=True)
+@click.option("--mensajes", default=5000, show_default=True)
+@click.option("--semilla", default=1, show_default=True)
+@click.option("--n", default=200, show_default=True, help="Peticiones medidas por ruta.")
+@click.option("--calentamiento", default=20, show_default=True)
+@click.option("--rutas", default=",".join(RUTAS_BENCH), show_default=True)
+@click.option("--modo", type=click.Choice(["inproceso", "gunicorn"]), default="inproceso", show_default=True)
+@click.option("--workers", default=4, show_default=True, help="Workers de gunicorn.")
+@click.option("--concurrencia", default=8, show_default=True, help="Clientes simultáneos contra gunicorn.")
+@click.option("--puerto", default=8765, show_default=True)
+@click.option("--salida", type=click.Path(dir_okay=False), default=None, help="Archivo JSON de resultados.")
+def bench(empresas, publicaciones, mensajes, semilla, n, calentamiento, rutas,
+          modo, workers, concurrencia, puerto, salida):
+    """p50/p95/p99, throughput y RSS pico por ruta sobre datos sintéticos."""
+    import platform
+    import subprocess
+
+    if modo == "gunicorn" and app.config["STORAGE_BACKEND"] != "sqlite":
+        raise click.UsageError("El modo gunicorn necesita WS_STORAGE=sqlite (o WS_MODO=compartido) "
+                               "para que los workers vean los datos generados.")
+    nombres = [r.strip() for r in rutas.split(",") if r.strip()]
+    desconocidas = [r for r in nombres if r not in RUTAS_BENCH]
+    if desconocidas:
+        raise click.UsageError(f"Rutas desconocidas: {', '.join(desconocidas)}")
+
+    if empresas:
+        inicio = time.perf_counter()
+        generar_datos_sinteticos(empresas, publicaciones, mensajes, semilla)
+        click.echo(f"Datos generados en {time.perf_counter() - inicio:.1f} s")
+
+    emails_por_tipo = {None: []}
+    for email, info in USERS.items():
+        if info.get("password") == "bench":
+            emails_por_tipo[None].append(email)
+            emails_por_tipo.setdefault(info.get("tipo"), []).append(email)
+    pub_ids = [p["id"] for p in PUBLICACIONES.pagina({}, limite=5000)[0]]
+    rnd = random.Random(semilla)
+
+    servidor, pids = None, None
+    if modo == "gunicorn":
+        entorno = dict(os.environ, WS_MODO="compartido")
+        entorno.pop("FLASK_RUN_FROM_CLI", None)  # gunicorn sirve app.py sin las herramientas
+        entorno.setdefault("WS_SESSION_DB", os.path.join(tempfile.mkdtemp(), "sesiones.sqlite3"))
+        servidor = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers),
+                                     "-b", f"127.0.0.1:{puerto}", "app:app"],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), env=entorno)
+        import http.client
+        for _ in range(300):
+            try:
+                con = http.client.HTTPConnection("127.0.0.1", puerto, timeout=1)
+                con.request("GET", "/status")
+                con.getresponse().read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            servidor.terminate()
+            raise click.ClickException("gunicorn no respondió en 30 s")
+        try:
+            with open(f"/proc/{servidor.pid}/task/{servidor.pid}/children") as f:
+                pids = [int(p) for p in f.read().split()]
+        except OSError:
+            pids = []
+
+    resultados = {}
+    try:
+        for nombre in nombres:
+            peticiones = _peticiones_bench(nombre, n + calentamiento, rnd, emails_por_tipo, pub_ids)
+            if not peticiones:
+                click.echo(f"{nombre:22} sin usuarios para la ruta, se omite")
+                continue
+            if modo == "gunicorn":
+                latencias, errores, total, rss = _medir_http(peticiones, calentamiento, puerto,
+                                                             concurrencia, pids)
+            else:
+                latencias, errores, total, rss = _medir_inproceso(peticiones, calentamiento)
+            ordenadas = sorted(x * 1000 for x in latencias)
+            resultados[nombre] = {
+                "n": len(ordenadas),
+                "errores": errores,
+                "p50_ms": _percentil(ordenadas, 50),
+                "p95_ms": _percentil(ordenadas, 95),
+                "p99_ms": _percentil(ordenadas, 99),
+                "media_ms": sum(ordenadas) / len(ordenadas) if ordenadas else None,
+                "rps": len(ordenadas) / total if total else None,
+                "rss_pico_kb": rss,
+            }
+            r = resultados[nombre]
+            click.echo(f"{nombre:22} p50 {r['p50_ms']:8.2f} ms · p95 {r['p95_ms']:8.2f} · "
+                       f"p99 {r['p99_ms']:8.2f} · {r['rps'] or 0:8.1f} req/s · "
+                       f"RSS {r['rss_pico_kb']} KB · errores {errores}")
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+
+    informe = {
+        "meta": {
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "modo": modo,
+            "workers": workers if modo == "gunicorn" else 1,
+            "concurrencia": concurrencia if modo == "gunicorn" else 1,
+            "almacenamiento": app.config["STORAGE_BACKEND"],
+            "python": platform.python_version(),
+            "semilla": semilla,
+            "datos": {"usuarios": len(USERS), "publicaciones": len(PUBLICACIONES),
+                      "mensajes": len(MENSAJES)},
+            "n": n,
+            "calentamiento": calentamiento,
+        },
+        "rutas": resultados,
+    }
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=1, sort_keys=True)
+        click.echo(f"Resultados en {salida}")
+
+# ---------------------------------------------------------
+# 🧵 THROUGHPUT CONCURRENTE
+# ---------------------------------------------------------
+# flask estres → varios hilos publican, eliminan y piden dashboards a la vez
+# sobre la misma app (lo que hace gunicorn --threads) y se mide cuántas
+# operaciones por segundo salen con 1, 2, 4... hilos. Falla si hay 5xx o si con
+# más hilos el throughput cae por debajo de --escala-minima veces el de la
+# primera corrida. Las invariantes de los almacenes bajo concurrencia las
+# comprueba tests/test_concurrencia.py.
+_DASHBOARD_DE = {"compraventa": "/dashboard_compra", "servicio": "/dashboard_servicio",
+                 "mixto": "/dashboard_mixto", "extranjero": "/dashboard_extranjero"}
+
+def _usuario_estres(n):
+    """Empresa dedicada al hilo n (tipos alternados); se crea la primera vez."""
+    tipo = list(_DASHBOARD_DE)[n % len(_DASHBOARD_DE)]
+    info = {
+        "nombre": f"Estrés {n}",
+        "email": f"estres{n}@estres.ws",
+        "password": "estres",
+        "tipo": tipo,
+        "rol": TIPOS_ROLES[tipo][0],
+        "empresa": f"Estrés {n}",
+        "descripcion": "Empresa de la prueba de estrés",
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "username": f"estres{n}",
+        "pais": "CL",
+        "items": [],
+    }
+    return USERS.crear(info) or USERS.get(info["email"])
+
+def _hilo_estres(n, hasta, barrera, semilla, resultado):
+    """Bucle de un hilo: 50% dashboard, 30% publicar, 20% eliminar una publicación propia."""
+    rnd = random.Random(semilla * 1000 + n)
+    user = _usuario_estres(n)
+    subtipos, categorias = opciones_publicacion(user["tipo"])
+    c = app.test_client()
+    c.post("/login", data={"email": user["email"], "password": "estres"})
+    propias = resultado["propias"]
+    barrera.wait()
+    i = 0
+    while time.perf_counter() < hasta[0]:
+        i += 1
+        op = rnd.random()
+        inicio = time.perf_counter()
+        if op < 0.5:
+            r = c.get(_DASHBOARD_DE[user["tipo"]])
+        elif op < 0.8 or not propias:
+            r = c.post("/publicar", data={"subtipo": rnd.choice(subtipos),
+                                          "tipo_publicacion": rnd.choice(categorias),
+                                          "producto": f"estres-{n}-{i}", "descripcion": "estrés",
+                                          "precio": f"USD {rnd.randint(1, 15)}/kg"})
+            propias.update(p["id"] for p in PUBLICACIONES.pagina({}, limite=8)[0]
+                           if p["usuario"] == user["email"])
+        else:
+            pub_id = propias.pop()
+            r = c.get(f"/publicacion/eliminar/{pub_id}")
+        resultado["latencias"].append(time.perf_counter() - inicio)
+        resultado["errores"] += r.status_code >= 500
+
+@app.cli.command("estres")
+@click.option("--empresas", default=100, show_default=True, help="0 = usar los datos ya cargados.")
+@click.option("--publicaciones", default=2000, show_default=True)
+@click.option("--hilos", default="1,2,4,8", show_default=True, help="Cantidades de hilos a probar.")
+@click.option("--segundos", default=3.0, show_default=True, help="Duración de cada corrida.")
+@click.option("--calentamiento", default=2.0, show_default=True,
+              help="Segundos de una corrida previa sin medir (plantillas y cachés frías).")
+@click.option("--semilla", default=1, show_default=True)
+@click.option("--escala-minima", default=0.8, show_default=True,
+              help="Throughput mínimo de cada corrida respecto de la primera.")
+@click.option("--salida", type=click.Path(dir_okay=False), default=None, help="Archivo JSON de resultados.")
+def estres(empresas, publicaciones, hilos, segundos, calentamiento, semilla, escala_minima, salida):
+    """Publicar / eliminar / dashboards en paralelo: throughput y latencia por hilos."""
+    try:
+        cantidades = [int(h) for h in hilos.split(",") if h.strip()]
+    except ValueError:
+        raise click.UsageError("--hilos debe ser una lista de enteros separados por comas")
+    if empresas:
+        generar_datos_sinteticos(empresas, publicaciones, 0, semilla)
+
+    if calentamiento:
+        # Sin esto la primera corrida paga la compilación de plantillas y las
+        # cachés frías, y la escala de las demás sale inflada
+        _corrida_estres(max(cantidades), calentamiento, semilla)
+    corridas = []
+    for cantidad in cantidades:
+        corrida = _corrida_estres(cantidad, segundos, semilla)
+        corrida["escala"] = (corrida["ops_s"] / corridas[0]["ops_s"]
+                             if corridas and corridas[0]["ops_s"] else 1.0)
+        corridas.append(corrida)
+        click.echo(f"{cantidad:3} hilos · {corrida['operaciones']:6} ops · {corrida['ops_s']:8.1f} ops/s "
+                   f"(x{corrida['escala']:.2f}) · p50 {corrida['p50_ms'] or 0:7.2f} ms · "
+                   f"p99 {corrida['p99_ms'] or 0:7.2f} ms · 5xx {corrida['errores_5xx']}")
+
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump({"almacenamiento": app.config["STORAGE_BACKEND"], "segundos": segundos,
+                       "semilla": semilla, "corridas": corridas},
+                      f, ensure_ascii=False, indent=1, sort_keys=True)
+        click.echo(f"Resultados en {salida}")
+    errores = sum(c["errores_5xx"] for c in corridas)
+    if errores:
+        raise click.ClickException(f"{errores} respuestas 5xx")
+    lentas = [c for c in corridas if c["escala"] < escala_minima]
+    if lentas:
+        raise click.ClickException(
+            "El throughput cae con más hilos: " + ", ".join(
+                f"{c['hilos']} hilos x{c['escala']:.2f}" for c in lentas)
+            + f" (mínimo x{escala_minima:.2f})")
+
+def _corrida_estres(cantidad, segundos, semilla):
+    """Una corrida de `segundos` con `cantidad` hilos; resumen de throughput y latencia."""
+    usuarios = [_usuario_estres(n) for n in range(cantidad)]
+    resultados = [{"propias": {p["id"] for p in PUBLICACIONES if p["usuario"] == u["email"]},
+                   "latencias": [], "errores": 0}
+                  for u in usuarios]
+    barrera = threading.Barrier(cantidad + 1)
+    hasta = [float("inf")]
+    hilos = [threading.Thread(target=_hilo_estres, args=(n, hasta, barrera, semilla, resultados[n]))
+             for n in range(cantidad)]
+    for h in hilos:
+        h.start()
+    barrera.wait()
+    inicio = time.perf_counter()
+    hasta[0] = inicio + segundos
+    for h in hilos:
+        h.join()
+    duracion = time.perf_counter() - inicio
+
+    latencias = sorted(x * 1000 for r in resultados for x in r["latencias"])
+    return {
+        "hilos": cantidad,
+        "operaciones": len(latencias),
+        "ops_s": len(latencias) / duracion if duracion else None,
+        "p50_ms": _percentil(latencias, 50),
+        "p99_ms": _percentil(latencias, 99),
+        "errores_5xx": sum(r["errores"] for r in resultados),
+    }
+
+# ---------------------------------------------------------
+# ⏱️ INSTANTÁNEAS Y TIEMPO DE ARRANQUE
+# ---------------------------------------------------------
+# flask instantanea → escribe ya la instantánea del diario activo (WS_DIARIO_DIR).
+# flask bench-arranque → genera datos con el diario en un directorio temporal y
+# mide, en procesos nuevos, cuánto tarda el arranque reaplicando todo el diario
+# y cuánto desde la instantánea mapeada más una cola corta.
+@app.cli.command("instantanea")
+def instantanea():
+    """Escribe la instantánea de los almacenes en memoria y recorta el diario."""
+    if DIARIO is None:
+        raise click.UsageError("Necesita WS_DIARIO_DIR con el backend en memoria")
+    click.echo(json.dumps(escribir_instantanea(DIARIO), ensure_ascii=False))
+
+def _arranque_medido(entorno):
+    """Importa la app en un proceso nuevo; devuelve el resumen de restauración y el tiempo total."""
+    import subprocess
+
+    codigo = ("import json, time; inicio = time.perf_counter(); import app; "
+              "print(json.dumps(dict(app.DIARIO.resumen, importar=round(time.perf_counter() - inicio, 3), "
+              "usuarios=len(app.USERS), publicaciones=len(app.PUBLICACIONES), mensajes=len(app.MENSAJES))))")
+    salida = subprocess.run([sys.executable, "-c", codigo], env=entorno, check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(salida.strip().splitlines()[-1])
+
+@app.cli.command("bench-arranque")
+@click.option("--empresas", default=1000, show_default=True)
+@click.option("--publicaciones", default=20000, show_default=True)
+@click.option("--mensajes", default=1_000_000, show_default=True)
+@click.option("--cola", default=5000, show_default=True, help="Mensajes escritos después de la instantánea.")
+@click.option("--semilla", default=1, show_default=True)
+def bench_arranque(empresas, publicaciones, mensajes, cola, semilla):
+    """Arranque reaplicando el diario completo vs instantánea + cola del diario."""
+    import shutil
+    import subprocess
+
+    directorio = tempfile.mkdtemp(prefix="ws-diario-")
+    entorno = dict(os.environ, WS_STORAGE="memoria", WS_DIARIO_DIR=directorio,
+                   WS_INSTANTANEA_CADA=str(10 ** 9), WS_INSTANTANEA_ENTRADAS=str(10 ** 12),
+                   WS_DIARIO_FSYNC_MS="1000", FLASK_APP="app")
+    entorno.pop("WS_MODO", None)
+    entorno.pop("FLASK_RUN_FROM_CLI", None)  # el arranque medido no carga las herramientas
+    flask = [sys.executable, "-m", "flask"]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        subprocess.run(flask + ["generar-datos", "--empresas", str(empresas), "--publicaciones",
+                                str(publicaciones), "--mensajes", str(mensajes), "--semilla", str(semilla)],
+                       env=entorno, cwd=cwd, check=True, capture_output=True)
+        completo = _arranque_medido(entorno)
+        click.echo(f"Diario completo:  {completo}")
+        subprocess.run(flask + ["instantanea"], env=entorno, cwd=cwd, check=True, capture_output=True)
+        # Cola: mensajes nuevos después de la instantánea (los reaplica el próximo arranque)
+        subprocess.run([sys.executable, "-c",
+                        "import app\n"
+                        f"emails = sorted(app.USERS)[:50]\n"
+                        f"for i in range({cola}):\n"
+                        "    app.MENSAJES.agregar({'origen': emails[i % 50], 'destino': emails[(i + 1) % 50], "
+                        "'contenido': 'cola', 'fecha': ''})\n"
+                        "app.DIARIO.cerrar()"],
+                       env=entorno, cwd=cwd, check=True, capture_output=True)
+        desde = _arranque_medido(entorno)
+        click.echo(f"Instantánea+cola: {desde}")
+        tamano = sum(os.path.getsize(os.path.join(directorio, n)) for n in os.listdir(directorio))
+        click.echo(f"Directorio: {tamano / 2 ** 20:.1f} MiB")
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+# ---------------------------------------------------------
+# 📏 MEMORIA POR REGISTRO
+# ---------------------------------------------------------
+# flask bench-memoria → bytes por publicación y por mensaje (sys.getsizeof) con
+# el dict que arman /publicar y /mensajes y con el registro compacto que
+# guardan los almacenes en memoria. Los textos que llegan del formulario se
+# copian para que cada registro tenga los suyos, como en una petición real.
+def _texto_formulario(texto):
+    return texto.encode().decode()
+
+def _dict_publicacion(autor, rnd):
+    subtipos, categorias = opciones_publicacion(autor["tipo"])
+    categoria = rnd.choice(categorias)
+    producto = rnd.choice(_SERVICIOS_BENCH if categoria == "servicio" else _PRODUCTOS_BENCH)
+    pub, _ = construir_publicacion(autor, {
+        "subtipo": _texto_formulario(rnd.choice(subtipos)),
+        "categoria": _texto_formulario(categoria),
+        "producto": _texto_formulario(producto),
+        "descripcion": f"{producto} temporada {2024 + rnd.randint(0, 1)}",
+        "precio": f"USD {rnd.randint(1, 15)}/kg",
+    })
+    return pub
+
+def _dict_mensaje(origen, destino, i, rnd):
+    ahora = datetime.now()
+    return {"id": i, "origen": origen["email"], "destino": _texto_formulario(destino["email"]),
+            "contenido": f"Hola, nos interesa {rnd.choice(_PRODUCTOS_BENCH).lower()}",
+            "fecha": ahora.strftime(FORMATO_FECHA), "ts": int(ahora.timestamp())}
+
+def _bytes_vivos(registros):
+    """Bytes de los registros y de lo que referencian, contando una sola vez cada objeto compartido."""
+    vistos, total = set(), 0
+    for registro in registros:
+        total += sys.getsizeof(registro)
+        valores = chain(registro.keys(), registro.values()) if isinstance(registro, dict) else registro.fila()
+        for valor in valores:
+            if id(valor) not in vistos:
+                vistos.add(id(valor))
+                total += sys.getsizeof(valor)
+    return total
+
+def _bytes_por_registro(fabrica, clase, n):
+    """(bytes por dict, bytes por registro compacto) con n registros vivos."""
+    dicts = [fabrica(i) for i in range(n)]
+    registros = [clase.desde(d) for d in dicts]
+    return _bytes_vivos(dicts) / n, _bytes_vivos(registros) / n
+
+@app.cli.command("bench-memoria")
+@click.option("--n", "cantidades", default="100000,1000000", show_default=True,
+              help="Cantidades de registros a medir.")
+@click.option("--semilla", default=1, show_default=True)
+@click.option("--salida", type=click.Path(dir_okay=False), default=None, help="Archivo JSON de resultados.")
+def bench_memoria(cantidades, semilla, salida):
+    """Bytes por publicación y por mensaje: dict vs registro compacto."""
+    try:
+        cantidades = [int(n) for n in cantidades.split(",") if n.strip()]
+    except ValueError:
+        raise click.UsageError("--n debe ser una lista de enteros separados por comas")
+    rnd = random.Random(semilla)
+    perfiles = [(tipo, rol) for tipo, roles in TIPOS_ROLES.items() for rol in roles]
+    autores = [{"email": f"bench{i}@bench.ws", "empresa": f"Empresa {i}", "tipo": tipo, "rol": rol}
+               for i, (tipo, rol) in enumerate(perfiles * 20)]
+    autores = [a for a in autores if puede_publicar(a)]
+
+    resultados = []
+    for n in cantidades:
+        for nombre, fabrica, clase in (
+                ("publicaciones", lambda i: _dict_publicacion(rnd.choice(autores), rnd), Publicacion),
+                ("mensajes", lambda i: _dict_mensaje(*rnd.sample(autores, 2), i, rnd), Mensaje)):
+            antes, despues = _bytes_por_registro(fabrica, clase, n)
+            resultados.append({"registros": nombre, "n": n, "bytes_dict": round(antes),
+                               "bytes_compacto": round(despues), "ahorro": round(1 - despues / antes, 3)})
+            click.echo(f"{nombre:14} {n:>9} · dict {antes:7.0f} B · compacto {despues:7.0f} B · "
+                       f"-{100 * (1 - despues / antes):.0f}% · {n * (antes - despues) / 2 ** 20:7.1f} MiB menos")
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump({"semilla": semilla, "resultados": resultados}, f, ensure_ascii=False, indent=1,
+                      sort_keys=True)
+        click.echo(f"Resultados en {salida}")
@@ -0,0 +1,299 @@
+# =========================================================
+# 🧵 CONCURRENCIA DE LOS ALMACENES
+# ---------------------------------------------------------
+# Varios hilos publican, eliminan y piden dashboards a la vez sobre la misma
+# app (lo que hace gunicorn --threads); al terminar los almacenes tienen que
+# seguir consistentes. Usa el backend que configure el entorno, p. ej.:
+#   WS_STORAGE=sqlite WS_DB=/tmp/ws.sqlite3 python -m pytest tests
+# =========================================================
+from datetime import datetime
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+import app as ws
+
+HILOS = 4
+SEGUNDOS = 2.0
+DASHBOARD_DE = {"compraventa": "/dashboard_compra", "servicio": "/dashboard_servicio",
+                "mixto": "/dashboard_mixto", "extranjero": "/dashboard_extranjero"}
+
+
+@pytest.fixture
+def intercalado():
+    # Con el intervalo por defecto (5 ms) el GIL casi nunca corta una escritura
+    # a la mitad y las carreras no aparecen en unos segundos de prueba
+    previo = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    yield
+    sys.setswitchinterval(previo)
+
+
+def _usuario(n):
+    """Empresa dedicada al hilo n (tipos alternados); se crea la primera vez."""
+    tipo = list(DASHBOARD_DE)[n % len(DASHBOARD_DE)]
+    info = {
+        "nombre": f"Concurrencia {n}",
+        "email": f"concurrencia{n}@pruebas.ws",
+        "password": "pruebas",
+        "tipo": tipo,
+        "rol": ws.TIPOS_ROLES[tipo][0],
+        "empresa": f"Concurrencia {n}",
+        "descripcion": "Empresa de la prueba de concurrencia",
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "username": f"concurrencia{n}",
+        "pais": "CL",
+        "items": [],
+    }
+    return ws.USERS.crear(info) or ws.USERS.get(info["email"])
+
+
+def _en_paralelo(objetivo, cantidad, segundos):
+    """Corre objetivo(n, hasta) en `cantidad` hilos que arrancan juntos y paran a los `segundos`."""
+    barrera = threading.Barrier(cantidad + 1)
+    hasta = [float("inf")]
+
+    def correr(n):
+        barrera.wait()
+        objetivo(n, hasta)
+
+    hilos = [threading.Thread(target=correr, args=(n,)) for n in range(cantidad)]
+    for h in hilos:
+        h.start()
+    barrera.wait()
+    hasta[0] = time.perf_counter() + segundos
+    for h in hilos:
+        h.join()
+
+
+def _invariantes_publicaciones(propias_de):
+    """Problemas de consistencia de PUBLICACIONES (lista vacía = ok)."""
+    problemas = []
+    todas = list(ws.PUBLICACIONES)
+    if len(todas) != len(ws.PUBLICACIONES):
+        problemas.append(f"len() = {len(ws.PUBLICACIONES)} pero se recorren {len(todas)}")
+    ids = [p["id"] for p in todas]
+    if len(set(ids)) != len(ids):
+        problemas.append("ids repetidos al recorrer")
+    for email, propias in propias_de.items():
+        vivas = {p["id"] for p in todas if p["usuario"] == email}
+        if vivas != propias:
+            problemas.append(f"{email}: {len(vivas)} publicadas, se esperaban {len(propias)}")
+    for campo in ws.PUBLICACIONES.CAMPOS_INDICE:
+        for valor in {p.get(campo) for p in todas}:
+            esperado = {p["id"] for p in todas if p.get(campo) == valor}
+            if {p["id"] for p in ws.PUBLICACIONES.buscar({campo: valor})} != esperado:
+                problemas.append(f"índice {campo}={valor!r} desalineado")
+    recientes = [p["id"] for p in ws.PUBLICACIONES.pagina({}, limite=len(todas) + 1)[0]]
+    if recientes != [p["id"] for p in ws.PUBLICACIONES.buscar({})][::-1]:
+        problemas.append("pagina() no es buscar() al revés")
+    return problemas
+
+
+def test_publicar_eliminar_y_dashboards(intercalado):
+    usuarios = [_usuario(n) for n in range(HILOS)]
+    resultados = [{"propias": {p["id"] for p in ws.PUBLICACIONES if p["usuario"] == u["email"]},
+                   "operaciones": 0, "errores_5xx": 0, "problemas": []}
+                  for u in usuarios]
+
+    def hilo(n, hasta):
+        """50% dashboard, 30% publicar, 20% eliminar una publicación propia."""
+        rnd = random.Random(n)
+        user, resultado = usuarios[n], resultados[n]
+        propias = resultado["propias"]
+        subtipos, categorias = ws.opciones_publicacion(user["tipo"])
+        c = ws.app.test_client()
+        c.post("/login", data={"email": user["email"], "password": "pruebas"})
+        i = 0
+        while time.perf_counter() < hasta[0]:
+            i += 1
+            op = rnd.random()
+            try:
+                if op < 0.5:
+                    r = c.get(DASHBOARD_DE[user["tipo"]])
+                    # Lecturas concurrentes: un filtro nunca mezcla buckets
+                    pagina, _ = ws.PUBLICACIONES.pagina({"tipo": user["tipo"]}, limite=20)
+                    pagina += ws.PUBLICACIONES.buscar({"tipo": user["tipo"],
+                                                       "categoria": rnd.choice(categorias)})
+                    if any(p["tipo"] != user["tipo"] for p in pagina):
+                        resultado["problemas"].append("página con publicaciones de otro tipo")
+                elif op < 0.8 or not propias:
+                    marca = f"concurrencia-{n}-{i}"
+                    r = c.post("/publicar", data={"subtipo": rnd.choice(subtipos),
+                                                  "tipo_publicacion": rnd.choice(categorias),
+                                                  "producto": marca, "descripcion": "concurrencia",
+                                                  "precio": f"USD {rnd.randint(1, 15)}/kg"})
+                    # Recién publicada: está entre las más nuevas aunque otros hilos publiquen
+                    nueva = next((p for p in ws.PUBLICACIONES.pagina({}, limite=256)[0]
+                                  if p["producto"] == marca), None)
+                    if nueva is None:
+                        resultado["problemas"].append(f"{marca} no quedó publicada")
+                    else:
+                        propias.add(nueva["id"])
+                else:
+                    pub_id = rnd.choice(sorted(propias))
+                    r = c.get(f"/publicacion/eliminar/{pub_id}")
+                    propias.discard(pub_id)
+                    if pub_id in ws.PUBLICACIONES:
+                        resultado["problemas"].append(f"{pub_id} sigue publicada tras eliminarla")
+            except Exception as e:  # cualquier excepción es una carrera
+                resultado["problemas"].append(f"{type(e).__name__}: {e}")
+                continue
+            resultado["operaciones"] += 1
+            resultado["errores_5xx"] += r.status_code >= 500
+
+    _en_paralelo(hilo, HILOS, SEGUNDOS)
+
+    assert [p for r in resultados for p in r["problemas"]] == []
+    assert sum(r["errores_5xx"] for r in resultados) == 0
+    assert all(r["operaciones"] for r in resultados)
+    assert _invariantes_publicaciones({u["email"]: r["propias"]
+                                       for u, r in zip(usuarios, resultados)}) == []
+
+
+def test_agregar_y_eliminar_directo_en_el_almacen(intercalado):
+    # Sin pasar por las rutas (que además toman los locks de los índices): el
+    # almacén tiene que aguantar solo escritores y lectores simultáneos
+    usuarios = [_usuario(n) for n in range(HILOS)]
+    propias_de = {u["email"]: {p["id"] for p in ws.PUBLICACIONES if p["usuario"] == u["email"]}
+                  for u in usuarios}
+    problemas = []
+
+    def hilo(n, hasta):
+        """Agrega y elimina publicaciones propias; cada tanto pagina todo el almacén."""
+        rnd = random.Random(n)
+        user = usuarios[n]
+        propias = propias_de[user["email"]]
+        subtipos, categorias = ws.opciones_publicacion(user["tipo"])
+        i = 0
+        while time.perf_counter() < hasta[0]:
+            i += 1
+            try:
+                op = rnd.random()
+                if op < 0.5 or not propias:
+                    pub, _ = ws.construir_publicacion(user, {
+                        "subtipo": rnd.choice(subtipos), "categoria": rnd.choice(categorias),
+                        "producto": f"directo-{n}-{i}", "descripcion": "concurrencia",
+                        "precio": f"USD {rnd.randint(1, 15)}/kg"})
+                    propias.add(ws.PUBLICACIONES.agregar(pub)["id"])
+                elif op < 0.8:
+                    pub_id = rnd.choice(sorted(propias))
+                    propias.discard(pub_id)
+                    if ws.PUBLICACIONES.eliminar(pub_id) is None:
+                        problemas.append(f"{pub_id} ya no estaba al eliminarla")
+                else:
+                    pagina, _ = ws.PUBLICACIONES.pagina({"tipo": user["tipo"]}, limite=50)
+                    if any(p["tipo"] != user["tipo"] for p in pagina):
+                        problemas.append("página con publicaciones de otro tipo")
+            except Exception as e:  # cualquier excepción es una carrera
+                problemas.append(f"{type(e).__name__}: {e}")
+
+    _en_paralelo(hilo, HILOS, SEGUNDOS)
+
+    assert problemas == []
+    assert _invariantes_publicaciones(propias_de) == []
+
+
+def test_guardar_usuarios_mientras_se_recorre_el_directorio(intercalado):
+    usuarios = [_usuario(n) for n in range(HILOS)]
+    # Quien cambia de empresa cambia de lugar en el directorio; el resto tiene
+    # que aparecer exactamente una vez en cada recorrido
+    fijos = set(ws.USERS) - {u["email"] for u in usuarios[::2]}
+    problemas = []
+
+    def hilo(n, hasta):
+        """Los hilos pares renombran su empresa; los impares recorren el directorio."""
+        user = usuarios[n]
+        i = 0
+        while time.perf_counter() < hasta[0]:
+            i += 1
+            try:
+                if n % 2 == 0:
+                    user = ws.USERS.guardar(dict(user, empresa=f"Concurrencia {n} v{i}"))
+                else:
+                    emails = [u["email"] for u in ws.USERS.por_empresa()]
+                    vistos = [e for e in emails if e in fijos]
+                    if len(vistos) != len(fijos) or set(vistos) != fijos:
+                        problemas.append(f"el directorio mostró {len(vistos)} de {len(fijos)} fijos")
+                    for u in usuarios:
+                        if ws.USERS.por_username(u["username"]) is None:
+                            problemas.append(f"{u['username']} desapareció")
+            except Exception as e:  # cualquier excepción es una carrera
+                problemas.append(f"{type(e).__name__}: {e}")
+
+    _en_paralelo(hilo, HILOS, SEGUNDOS)
+
+    assert problemas == []
+    directorio = list(ws.USERS.por_empresa())
+    assert sorted(u["email"] for u in directorio) == sorted(ws.USERS)
+    claves = [ws._clave_empresa(u) for u in directorio]
+    assert claves == sorted(claves)
+    for n in range(0, HILOS, 2):
+        assert ws.USERS.get(usuarios[n]["email"])["empresa"].startswith(f"Concurrencia {n} v")
+
+
+def test_recorrer_el_directorio_mientras_una_empresa_se_mueve():
+    # recorrer() sigue su bucket fuera del lock: si actualizar() lo tocara en
+    # sitio, una empresa que pasa al principio corre a las demás y el
+    # recorrido repite la que estaba leyendo
+    user = _usuario(0)
+    ws.DIRECTORIO.sincronizar()
+    # Un perfil que ve a la empresa y a alguna otra antes que ella
+    perfil = next((tipo, rol) for tipo, roles in ws.TIPOS_ROLES.items() for rol in roles
+                  if user["email"] in [info["email"] for info in ws.DIRECTORIO.recorrer(tipo, rol, "")][1:])
+    recorrido = ws.DIRECTORIO.recorrer(*perfil, "")
+    antes = [next(recorrido)["email"]]
+    movido = dict(user, empresa="0000 Primera")
+    ws.DIRECTORIO.actualizar(movido)
+    try:
+        emails = antes + [info["email"] for info in recorrido]
+        assert len(emails) == len(set(emails))
+    finally:
+        ws.DIRECTORIO.actualizar(user)
+
+
+@pytest.mark.parametrize("nombre", ["INDICE_BUSQUEDA", "INDICE_PRECIOS"])
+def test_publicar_mientras_se_rearma_el_indice(monkeypatch, nombre):
+    # El índice se rearma fuera de su lock: una escritura no espera a que
+    # termine, y lo escrito entretanto aparece en la sincronización siguiente
+    indice = getattr(ws, nombre)
+    user = _usuario(0)
+    subtipos, categorias = ws.opciones_publicacion(user["tipo"])
+    armando, seguir = threading.Event(), threading.Event()
+
+    def frenado(iterable, cada=500):
+        for elemento in iterable:
+            armando.set()
+            seguir.wait(5)
+            yield elemento
+
+    monkeypatch.setattr(ws, "cediendo", frenado)
+    rearmado = threading.Thread(target=indice.reconstruir)
+    rearmado.start()
+    armando.wait(5)
+
+    def publicar():
+        pub, _ = ws.construir_publicacion(user, {
+            "subtipo": subtipos[0], "categoria": categorias[0], "producto": "zapallorearmado",
+            "descripcion": "concurrencia", "precio": "USD 3/kg"})
+        with indice.escritura():
+            indice.indexar_publicacion(ws.PUBLICACIONES.agregar(pub))
+
+    escritura = threading.Thread(target=publicar)
+    escritura.start()
+    escritura.join(2)
+    bloqueada = escritura.is_alive()
+    seguir.set()
+    escritura.join()
+    rearmado.join()
+
+    assert not bloqueada
+    indice.sincronizar()
+    if indice is ws.INDICE_BUSQUEDA:
+        assert user["email"] in dict(indice.buscar("zapallorearmado"))
+    else:
+        encontradas, _ = indice.buscar("USD", "kg", consulta="zapallorearmado")
+        assert user["email"] in {p["usuario"] for p in encontradas}
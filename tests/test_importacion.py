@@ -0,0 +1,56 @@
+# =========================================================
+# 📦 IMPORTACIÓN MASIVA
+# =========================================================
+import app as ws
+
+
+def _catalogo(email):
+    return [(item["id"], item["nombre"]) for item in ws.USERS.get(email)["items"]]
+
+
+def test_reemplazar_catalogo_no_cambia_lo_que_hay_en_los_carritos():
+    productor = ws.USERS.get("productor@ws.com")
+    viejo_id, viejo_nombre = _catalogo(productor["email"])[0]
+    comprador = "cliente@ws.com"
+    ws.CARRITOS.vaciar(comprador)
+    ws.CARRITOS.agregar(comprador, [viejo_id])
+
+    informe = ws.importar_filas(productor, "items",
+                                [(2, {"nombre": "Totally different", "precio": "USD 999/kg"})],
+                                reemplazar=True)
+
+    assert informe["aceptadas"] == 1
+    [(nuevo_id, nombre)] = _catalogo(productor["email"])
+    assert nombre == "Totally different"
+    assert nuevo_id != viejo_id
+    assert ws.USERS.item_catalogo(viejo_id) is None
+    # El carrito sigue apuntando al ítem anterior, que ya no está: no al nuevo
+    [entrada] = ws.contenido_carrito(comprador)
+    assert entrada == {"id": viejo_id, "cantidad": 1, "disponible": False}
+    ws.CARRITOS.vaciar(comprador)
+
+
+def test_importar_dos_veces_da_ids_distintos():
+    productor = ws.USERS.get("productor@ws.com")
+    filas = [(2, {"nombre": "Kiwi", "precio": "USD 3/kg"})]
+    ws.importar_filas(productor, "items", filas, reemplazar=True)
+    [(primero, _)] = _catalogo(productor["email"])
+    ws.importar_filas(ws.USERS.get(productor["email"]), "items", filas, reemplazar=True)
+    [(segundo, _)] = _catalogo(productor["email"])
+    assert primero != segundo
+
+
+def test_importar_catalogo_lo_guarda_una_sola_vez(monkeypatch):
+    # Guardar por lotes reescribía e indexaba el catálogo creciente en cada lote
+    monkeypatch.setitem(ws.app.config, "IMPORTAR_LOTE", 2)
+    guardados = []
+    guardar = ws.USERS.guardar
+    monkeypatch.setattr(ws.USERS, "guardar", lambda info: guardados.append(info) or guardar(info))
+    productor = ws.USERS.get("productor@ws.com")
+    filas = [(n + 2, {"nombre": f"Fruta {n}", "precio": "USD 3/kg"}) for n in range(7)]
+
+    informe = ws.importar_filas(productor, "items", filas, reemplazar=True)
+
+    assert informe["aceptadas"] == 7
+    assert len(guardados) == 1
+    assert [nombre for _, nombre in _catalogo(productor["email"])] == [f"Fruta {n}" for n in range(7)]
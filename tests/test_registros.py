@@ -0,0 +1,20 @@
+# =========================================================
+# 🗜️ REGISTROS COMPACTOS
+# =========================================================
+import pytest
+
+import app as ws
+
+
+def test_fila_de_otro_largo_falla_en_vez_de_rellenar():
+    user = ws.USERS.get("productor@ws.com")
+    subtipos, categorias = ws.opciones_publicacion(user["tipo"])
+    pub, _ = ws.construir_publicacion(user, {"subtipo": subtipos[0], "categoria": categorias[0],
+                                             "producto": "Ciruela", "descripcion": "registro",
+                                             "precio": "USD 2/kg"})
+    fila = ws.Publicacion.desde(pub).fila()
+    assert dict(ws.Publicacion(*fila)) == dict(ws.Publicacion.desde(pub))
+    with pytest.raises(ValueError):
+        ws.Publicacion(*fila[:-1])
+    with pytest.raises(ValueError):
+        ws.Publicacion(*fila, None)
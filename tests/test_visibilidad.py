@@ -0,0 +1,75 @@
+# =========================================================
+# 🧮 MATRIZ DE VISIBILIDAD
+# ---------------------------------------------------------
+# puede_ver_publicacion (matriz precompilada) tiene que decir lo mismo que
+# _puede_ver_publicacion_reglas en todas las combinaciones del vocabulario,
+# con valores fuera de él, vacíos y None.
+# =========================================================
+import copy
+
+import app as ws
+
+
+def _combinaciones():
+    tipos, roles = ws._vocabulario_visibilidad()
+    tipos_u = sorted(tipos) + ["", "desconocido"]
+    roles_u = sorted(roles) + ["", "desconocido"]
+    tipos_p = tipos_u + [None]
+    roles_p = roles_u + [None]
+    subtipos = list(ws.SUBTIPOS_PUBLICACION) + ["", "otro", None]
+    categorias = list(ws.CATEGORIAS_PUBLICACION) + ["", "otra", None]
+    for tipo_u in tipos_u:
+        for rol_u in roles_u:
+            usuario = {"tipo": tipo_u, "rol": rol_u}
+            objetivos = [None, "", rol_u, f"  {rol_u.upper()} ", "Transporte"]
+            for tipo_pub in tipos_p:
+                for rol_pub in roles_p:
+                    for subtipo in subtipos:
+                        for categoria in categorias:
+                            for objetivo in objetivos:
+                                yield usuario, {"tipo": tipo_pub, "rol": rol_pub, "subtipo": subtipo,
+                                                "categoria": categoria, "servicio_objetivo": objetivo}
+
+
+def test_matriz_igual_a_las_reglas():
+    casos, diferencias = 0, []
+    for usuario, pub in _combinaciones():
+        casos += 1
+        if ws.puede_ver_publicacion(usuario, pub) != ws._puede_ver_publicacion_reglas(usuario, pub):
+            diferencias.append((usuario, pub))
+    assert casos == 831600
+    assert diferencias[:10] == []
+
+
+def test_matriz_igual_a_las_reglas_con_registros():
+    # Las publicaciones del almacén son Publicacion: su clave sale por atributos
+    tipos, roles = ws._vocabulario_visibilidad()
+    for usuario, pub in _combinaciones():
+        if pub["tipo"] in tipos and pub["subtipo"] in ws.SUBTIPOS_PUBLICACION and pub["servicio_objetivo"]:
+            registro = ws.Publicacion.desde(pub)
+            assert (ws.puede_ver_publicacion(usuario, registro)
+                    == ws._puede_ver_publicacion_reglas(usuario, pub)), (usuario, pub)
+
+
+def test_entradas_vacias():
+    assert ws.puede_ver_publicacion(None, {"tipo": "compraventa"}) is False
+    assert ws.puede_ver_publicacion({"tipo": "compraventa", "rol": "Exportador"}, {}) is False
+    assert ws.puede_ver_publicacion({"tipo": "compraventa", "rol": "Exportador"}, None) is False
+
+
+def test_recompilar_tras_cambiar_permisos():
+    originales = copy.deepcopy(ws.PERMISOS)
+    usuario = {"tipo": "compraventa", "rol": "Exportador"}
+    pub = {"tipo": "servicio", "rol": "Rol nuevo", "subtipo": "oferta", "categoria": "servicio"}
+    version = ws._MATRIZ_VISIBILIDAD["version"]
+    try:
+        ws.PERMISOS["compraventa"]["Exportador"].setdefault("puede_comprar_servicios", []).append("Rol nuevo")
+        ws.recompilar_visibilidad()
+        assert ws._MATRIZ_VISIBILIDAD["version"] == version + 1
+        assert ws.puede_ver_publicacion(usuario, pub) is True
+        assert ws._puede_ver_publicacion_reglas(usuario, pub) is True
+    finally:
+        ws.PERMISOS.clear()
+        ws.PERMISOS.update(originales)
+        ws.recompilar_visibilidad()
+    assert ws.puede_ver_publicacion(usuario, pub) is ws._puede_ver_publicacion_reglas(usuario, pub)